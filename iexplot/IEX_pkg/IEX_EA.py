@@ -1,6 +1,7 @@
 import os
 
 from iexplot.pynData.nEA import nEA
+from iexplot.pynData.pynData_ARPES import EA_accumulator
 
 class IEX_EA():
     """
@@ -99,3 +100,25 @@ class IEX_EA():
             d.update({shortlist[i]:EA})
         return d
         
+
+    def load_sum(self,shortlist,keep_raw=False,**kwargs):
+        """
+        loads the EA scans in shortlist one at a time and sums them as they are loaded
+        returns an EA_accumulator
+            acc.result() => summed EA (nARPES object)
+            acc.raw => dictionary of loaded EA scans if keep_raw = True
+        
+        keep_raw = False (default); each image is dropped after it is added to the sum
+                 = True; keeps the loaded EA scans in acc.raw
+        **kwargs: same as load
+        """
+        kwargs.setdefault("debug",False)
+        
+        acc = EA_accumulator(keep_raw=keep_raw)
+        for scanNum in shortlist:
+            fname = kwargs['prefix']+str.zfill(str(scanNum),kwargs['nzeros'])+kwargs['suffix']+"."+kwargs['ext']
+            fullpath=os.path.join(kwargs['path'],fname)
+            if kwargs["debug"]:
+                print("EA fullpath: ",fullpath)
+            acc.add(nEA((fullpath),**kwargs),scanNum)
+        return acc
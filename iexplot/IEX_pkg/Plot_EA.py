@@ -7,8 +7,8 @@ from scipy import interpolate
 
 from iexplot.utilities import _shortlist, make_num_list, get_nested_dict_value 
 from iexplot.plotting import plot_1D, plot_2D, plot_3D
-from iexplot.pynData.pynData_ARPES import stack_EAs 
-from iexplot.fitting import fit_box, fit_gaussian, fit_lorentzian, fit_poly, fit_step, fit_shirley_background
+from iexplot.pynData.pynData_ARPES import stack_EAs, EA_accumulator
+from iexplot.fitting import fit_box, fit_gaussian, fit_lorentzian, fit_poly, fit_step, fit_shirley_background, fit_tougaard_background, fit_cache
 
 from iexplot.pynData.pynData import stack_attributes
 
@@ -62,21 +62,31 @@ class Plot_EA:
     def EA_spectra_sum(self,scanNum, EAnum=np.inf,**kwargs):
         """
         return pyndata object of summed EA data 
-        EAnum = np.inf, sums all             
+        EAnum = np.inf, sums all
+              = (start,stop,countby) => sums a subset
+
+        **kwargs:
+            avg = True/False to average instead of sum (default: False)
+
+        the images and EDCs are added one at a time into float64 buffers (see EA_accumulator)
         """
-        #creating shortlist of selected EAnum
-      
-        
-        EA = self._EA_obj(self,scanNum,EAnum)
-        EAlist = list(EA.keys())
+        kwargs.setdefault('avg',False)
 
-        EAsummed = copy.deepcopy(EA[EAlist[0]])
+        if self.dtype == "EA":
+            EA = self.EA
+        else:
+            EA = self.mda[scanNum].EA
+        EAlist = list(EA.keys())
         
-        img = np.nansum(tuple(EA[EAnum].data for EAnum in EAlist),axis=0)
-        edc = np.nansum(tuple(EA[EAnum].EDC.data for EAnum in EAlist),axis=0)
+        #creating shortlist of selected EAnum
+        if EAnum != np.inf:
+            EAnum = EAnum if type(EAnum) in [tuple,list] else (EAnum,)
+            EAlist = _shortlist(*EAnum, llist = EAlist)  
 
-        EAsummed.data = img
-        EAsummed.EDC.data = edc
+        acc = EA_accumulator(keep_raw=False)
+        for n in EAlist:
+            acc.add(EA[n])
+        EAsummed = acc.result(avg=kwargs['avg'])
         
         return EAsummed
     
@@ -139,7 +149,7 @@ class Plot_EA:
     def fit_EDC(self,scanNum,fit_type,EAnum=1,BE=False,**kwargs):
         """
         simple fitting of EDC data
-        fit_type = 'box', 'gaussian', 'lorentzian', 'poly', 'step:', 'shirley'
+        fit_type = 'box', 'gaussian', 'lorentzian', 'poly', 'step', 'shirley', 'tougaard'
 
         EAnum = scan/sweep number 
                 = inf => will sum all spectra
@@ -148,9 +158,12 @@ class Plot_EA:
         BE = True; Binding Energy scaling
            where BE = hv-KE-wk (wk=None uses workfunction defined in the metadata)
         
+        **kwargs
+            cache = True/False reuses previous fits of the same EDC (default=False), see FitCache
         """
         kwargs.setdefault('show_legend',False)
         kwargs.setdefault('plot',True)
+        kwargs.setdefault('cache',False)
 
         x,y,xlabel = self.EA_EDC(scanNum,EAnum=EAnum,BE=BE)
     
@@ -159,13 +172,17 @@ class Plot_EA:
             'gaussian':fit_gaussian,
             'lorentzian':fit_lorentzian,
             'poly':fit_poly,
-            'step:':fit_step,
+            'step':fit_step,
             'shirley':fit_shirley_background,
+            'tougaard':fit_tougaard_background,
         }
 
         if fit_type not in fit_funcs.keys():
-            print('Not a valid fit_type use one of the following'+list(fit_funcs.keys()) )
-            #return
+            print('Not a valid fit_type use one of the following: '+str(list(fit_funcs.keys())))
+            return
+
+        if kwargs.pop('cache'):
+            return fit_cache.fit(x,y,fit_type,**kwargs)
 
         fit_func = fit_funcs[fit_type]
         ff = fit_func(x,y,**kwargs)
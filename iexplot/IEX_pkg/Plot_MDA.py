@@ -3,11 +3,14 @@ import re
 
 from IPython.display import display_markdown
 
+import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 
 from iexplot.utilities import make_num_list
 from iexplot.plotting import *
 from iexplot.XAS_utilities import plot_Norm2Edge,Norm2Edge
+from iexplot.fitting import fit_series
 from iexplot.pynData.pynData import ndstack
 
 
@@ -341,6 +344,67 @@ class Plot_MDA:
         d.updateUnit('y',pv)
         return d
     
+    def fit_mda_series(self,*scans,detNum=1,fit_type='gaussian',pv=None,**kwargs):
+        """
+        fits the same peak in a series of 1D mda scans, each fit starts from the result of the 
+        previous scan (see iexplot.fitting.fit_series)
+
+        *scans => same as make_num_list (e.g. first,last or first,last,countby)
+        detNum = detector number
+        fit_type = 'box','gaussian','lorentzian','step','voigt'
+        pv = extra pv in the mda header to add as a column (e.g. temperature or position)
+
+        **kwargs
+            posx_Num => to fit verses a different x-positioner number
+            xrange=[x_first,x_last] to fit subrange 
+            coefs_0 = initial guess for the first scan, otherwise autoguess
+            warm_start = True (default)
+            nprocs = 1 (default); number of processes 
+            plot = True/False plots the center vs scanNum (or pv) (default = False)
+
+        returns a pandas DataFrame indexed by scanNum with the fit values (center, FWHM...), their errors and pv
+        """
+        kwargs.setdefault('posx_Num',0)
+        kwargs.setdefault('plot',False)
+        plot = kwargs.pop('plot')
+        posx_Num = kwargs.pop('posx_Num')
+
+        scanNums, xs, ys = [], [], []
+        for scanNum in make_num_list(*scans):
+            if scanNum not in self.mda:
+                print('mda scan '+str(scanNum)+' is not loaded')
+                continue
+            scanNums.append(scanNum)
+            xs.append(self.mda_positioner(scanNum,posNum=posx_Num,ax='x'))
+            ys.append(self.mda_detector(scanNum,detNum))
+        
+        fits = fit_series(xs,ys,fit_type,**kwargs)
+        if fits is None:
+            return
+        coefs, errs, fit_vals, fit_errs = fits
+
+        table = pd.DataFrame(index=pd.Index(scanNums,name='scanNum'))
+        for key in fit_vals:
+            table[key] = fit_vals[key]
+            table[key+'_err'] = fit_errs[key]
+        if pv is not None:
+            vals = []
+            for scanNum in scanNums:
+                try:
+                    vals.append(float(self.mda_extra_pvs(scanNum,pv,verbose=False)))
+                except (TypeError, ValueError, KeyError, IndexError) as e:
+                    print('mda scan '+str(scanNum)+': no single value for '+pv+', '+str(e))
+                    vals.append(np.nan)
+            table[pv] = vals
+
+        if plot:
+            x = table[pv] if pv is not None else table.index
+            plt.errorbar(x,table['center'],yerr=table['center_err'],marker='o',linestyle='None')
+            plt.xlabel(pv if pv is not None else 'scanNum')
+            plt.ylabel('center')
+
+        return table
+    
     def mda_extra_pvs_all(self,scanNum):
         """
         returns a dictionary with all the adder info from the mda scan
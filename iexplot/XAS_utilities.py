@@ -1,4 +1,5 @@
 import numpy as np
+import numpy.polynomial.polynomial as poly
 from iexplot.plotting import find_closest, plot_1D
 
 
@@ -107,3 +108,77 @@ def plot_Norm2Edge(x,y,**kwargs):
         
         plot_1D(x[i0:i1],y[i0:i1],marker="x")
         plot_1D(x[i2:i3],y[i2:i3],marker="x")
+
+def _Norm2Edge_rows(x,Y,**kwargs):
+    """
+    Norm2Edge for each row of Y with the shared x
+    """
+    i0,i1,i2,i3 = _Norm2Edge_index(x,**kwargs)
+    pre, post = slice(i0,i1), slice(i2,i3)
+    positive = Y[:,0] < Y[:,-1]
+
+    if kwargs['pre_edge_fit'] is None:
+        base_pos = np.mean(Y[:,pre],axis=1,keepdims=True)
+        base_neg = np.mean(Y[:,post],axis=1,keepdims=True)
+    else:
+        rank = 1 if kwargs['pre_edge_fit'] == 'linear' else int(kwargs['pre_edge_fit'])
+        base_pos = poly.polyval(x,poly.polyfit(x[pre],Y[:,pre].T,rank))
+        base_neg = poly.polyval(x,poly.polyfit(x[post],Y[:,post].T,rank))
+
+    #positive edge jump: pre-edge is the baseline, negative: post-edge
+    yN = np.where(positive[:,np.newaxis], Y - base_pos, Y - base_neg)
+    edge = np.where(positive, np.mean(yN[:,post],axis=1), np.mean(yN[:,pre],axis=1))
+    sign = np.where(positive, 1, -1)
+    return sign[:,np.newaxis]*yN/edge[:,np.newaxis], edge
+
+def Norm2Edge_stack(x,Y,**kwargs):
+    """
+    return the Normalized data for an edge jump for many spectra at once (see Norm2Edge)
+    if the signal is negative it invertes to a positive edge jump
+
+    x = np.array (n), shared energy scale for all the rows of Y
+    Y = np.array (rows,n)
+      = list of nData objects (e.g. [data.mda[scanNum].det[detNum] for scanNum in scans]), 
+        x = None uses each object's scale['x'], the spectra are grouped by energy scale 
+        and the edge windows are found once per group 
+
+    **kwargs
+        pre_edge ='index'/'x',first,last
+        post_edge ='index'/'x',first,last
+        pre_edge_fit = None (default), subtracts the average of the pre-edge region
+                     = 'linear' or rank of the polynomial fit to the pre-edge region to subtract
+                       (post-edge region for negative signals, same as the average)
+        verbose = True/False, prints edge jump
+
+    returns np.array (rows,n) for an array Y, a list of np.arrays for a list of nData
+    """
+    kwargs.setdefault('pre_edge',('index',1,6))
+    kwargs.setdefault('post_edge',('index',-6,-1))
+    kwargs.setdefault('pre_edge_fit',None)
+    kwargs.setdefault('verbose',False)
+    kwargs.setdefault('debug',False)
+
+    if not isinstance(Y,(list,tuple)):
+        Y = np.atleast_2d(np.asarray(Y,dtype=float))
+        yN, edge = _Norm2Edge_rows(np.asarray(x),Y,**kwargs)
+        if kwargs['verbose']:
+            print('Edge jump: ', edge)
+        return yN
+
+    #grouping the spectra with the same energy scale
+    groups = {}
+    for i,d in enumerate(Y):
+        xi = np.asarray(d.scale['x'] if x is None else x)
+        key = (xi.shape, xi.tobytes())
+        groups.setdefault(key,(xi,[]))[1].append(i)
+
+    out = [None]*len(Y)
+    edges = np.full(len(Y),np.nan)
+    for xi, idx in groups.values():
+        yN, edge = _Norm2Edge_rows(xi,np.array([Y[i].data for i in idx],dtype=float),**kwargs)
+        for j,i in enumerate(idx):
+            out[i] = yN[j]
+        edges[idx] = edge
+    if kwargs['verbose']:
+        print('Edge jump: ', edges)
+    return out
@@ -1,9 +1,17 @@
+import os
+import copy
+import hashlib
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from math import sqrt
 import numpy as np
 import numpy.polynomial.polynomial as poly
 from numpy import log as ln
-from scipy.optimize import curve_fit
-from scipy.special import erfc,wofz
+from scipy.optimize import curve_fit, least_squares
+from scipy import sparse
+from scipy.signal import fftconvolve
+from scipy.special import erf,erfc,wofz,expit
 import matplotlib.pyplot as plt
 import lmfit
 
@@ -47,6 +55,14 @@ def _gaussian(x,*coefs):
     A, x0, sigma, bkgd = coefs
     return bkgd + A*np.exp(-(x-x0)**2/(2.*sigma**2))
 
+def _gaussian_jac(x,*coefs):
+    """
+    analytic partial derivatives of _gaussian with respect to [A,x0,sigma,bkgd]
+    """
+    A, x0, sigma, bkgd = coefs
+    e = np.exp(-(x-x0)**2/(2.*sigma**2))
+    return [e, A*e*(x-x0)/sigma**2, A*e*(x-x0)**2/sigma**3, np.ones_like(e)]
+
 def fit_gaussian(x,y,**kwargs):
     """
     fits a gaussian and returns fit_x, fit_y, coefs, covar 
@@ -77,7 +93,7 @@ def fit_gaussian(x,y,**kwargs):
     bkgd = np.mean(y_fit)
     coefs_0 = [A, x0, sigma, bkgd] if 'coefs_0' not in kwargs else kwargs['coefs_0']
 
-    coefs, covar = curve_fit(_gaussian, x_fit, y_fit, coefs_0)
+    coefs, covar = curve_fit(_gaussian, x_fit, y_fit, coefs_0, jac=_curve_fit_jac(_gaussian_jac))
     y_fit= _gaussian(x_fit, *coefs)
     fit_vals = {
         'Amp':coefs[0],
@@ -102,9 +118,18 @@ def _lorentzian(x,*coefs):
     #return bkgd + A*Gamma**2/(Gamma**2+(x-x0)**2)
     return bkgd + A/np.pi * sig / ((x-x0)**2+(sig)**2)
 
+def _lorentzian_jac(x,*coefs):
+    """
+    analytic partial derivatives of _lorentzian with respect to [A,x0,sig,bkgd]
+    """
+    A, x0, sig, bkgd = coefs
+    D = (x-x0)**2+sig**2
+    return [sig/np.pi/D, 2*A/np.pi*sig*(x-x0)/D**2, A/np.pi*((x-x0)**2-sig**2)/D**2, np.ones_like(D)]
+
 def fit_lorentzian(x,y,**kwargs):
     """
-    fits a lorentzian and returns fit_x, fit_y, coefs, covar 
+    fits a lorentzian and returns fit_x, fit_y, coefs, covar, fit_vals
+    fit_vals['FWHM'] = 2*sig (sig is the half width gamma, see _lorentzian)
 
     x,y np.arrays of the the x,y data
 
@@ -133,12 +158,12 @@ def fit_lorentzian(x,y,**kwargs):
     coefs_0 = [A, x0, sigma, bkgd] if 'coefs_0' not in kwargs else kwargs['coefs_0']
 
 
-    coefs, covar = curve_fit(_lorentzian, x_fit, y_fit, coefs_0)
+    coefs, covar = curve_fit(_lorentzian, x_fit, y_fit, coefs_0, jac=_curve_fit_jac(_lorentzian_jac))
     y_fit= _lorentzian(x_fit, *coefs)
     fit_vals = {
         'Amp':coefs[0],
         'center':coefs[1],
-        'FWHM':sqrt(8*ln(2))*coefs[2]
+        'FWHM':2*coefs[2]    #sig is the half width gamma
         }
 
     if kwargs['plot']:
@@ -156,6 +181,15 @@ def _step(x,*coefs):
     A, x0, width, bkgd = coefs
     return bkgd + A*erfc((x -x0)/width) 
 
+def _step_jac(x,*coefs):
+    """
+    analytic partial derivatives of _step with respect to [A,x0,width,bkgd]
+    """
+    A, x0, width, bkgd = coefs
+    u = (x-x0)/width
+    g = 2/np.sqrt(np.pi)*np.exp(-u**2)
+    return [erfc(u), A*g/width, A*g*u/width, np.ones_like(u)]
+
 def fit_step(x,y,**kwargs):
     """
     fits a lorentzian and returns fit_x, fit_y, coefs, covar 
@@ -187,7 +221,7 @@ def fit_step(x,y,**kwargs):
 
     coefs_0 = [A, x0, width, bkgd] if 'coefs_0' not in kwargs else kwargs['coefs_0']
 
-    coefs, covar = curve_fit(_step, x_fit, y_fit, coefs_0)
+    coefs, covar = curve_fit(_step, x_fit, y_fit, coefs_0, jac=_curve_fit_jac(_step_jac))
     y_fit= _step(x_fit, *coefs)
     fit_vals={
         'height':coefs[0],
@@ -201,6 +235,43 @@ def fit_step(x,y,**kwargs):
     return  x_fit,y_fit,coefs,covar,fit_vals
 
 
+def _fermi(x,*coefs):
+    """
+    Function for a Fermi edge with a linear density of states
+    coefs = [A,EF,width,slope,bkgd]
+    returns f(x) = bkgd + (A + slope*(x-EF))/(exp((x-EF)/width)+1)
+    width = kB*T (plus resolution)
+    """
+    A, EF, width, slope, bkgd = coefs
+    fd = expit(-(x-EF)/width)
+    return bkgd + (A + slope*(x-EF))*fd
+
+def _fermi_jac(x,*coefs):
+    """
+    analytic partial derivatives of _fermi with respect to [A,EF,width,slope,bkgd]
+    """
+    A, EF, width, slope, bkgd = coefs
+    u = (x-EF)/width
+    fd = expit(-u)
+    L = A + slope*(x-EF)
+    dfd = fd*(1-fd)
+    return [fd, -slope*fd + L*dfd/width, L*dfd*u/width, (x-EF)*fd, np.ones_like(fd)]
+
+def _fermi_guess(x,Y):
+    """
+    initial guesses for _fermi for each row of Y (x increasing, nan padded)
+    returns coefs_0 with shape (rows,5)
+    """
+    m,n = Y.shape
+    edge = max(n//10,1)
+    y_first = np.nanmean(Y[:,:edge],axis=1)
+    bkgd = np.nanmean(Y[:,-edge:],axis=1)
+    grad = np.gradient(np.nan_to_num(Y,nan=0.0),axis=1)
+    grad[np.isnan(Y)] = np.inf
+    EF = x[np.arange(m),np.argmin(grad,axis=1)]
+    width = np.maximum((np.nanmax(x,axis=1)-np.nanmin(x,axis=1))/100,1e-3)
+    return np.stack((y_first-bkgd,EF,width,np.zeros(m),bkgd),axis=1)
+
 def fit_voigt(x,y,**kwargs): #lmfit can't guess for a composite model, try pseudo voigt? AJE
     kwargs.setdefault('plot',True)
     kwargs.setdefault('xrange',[np.inf,np.inf])
@@ -217,7 +288,9 @@ def fit_voigt(x,y,**kwargs): #lmfit can't guess for a composite model, try pseud
         _plot_fit(x,y,x_fit,y_fit.best_fit,**kwargs)
     
     coefs = [y_fit.params['height'].value, y_fit.params['center'].value, y_fit.params['fwhm'].value]
-    covar = 'still need to implement'
+    #height and fwhm are derived parameters, only their errors are available
+    errs = [y_fit.params[key].stderr for key in ['height','center','fwhm']]
+    covar = np.diag([np.nan if e is None else e**2 for e in errs])
     return x_fit,y_fit.best_fit, coefs, covar
 
 def _box(x, *p):
@@ -230,6 +303,26 @@ def _box(x, *p):
     return bkgd + A*((x0 - width/2) < x)*(x < (x0 + width/2))
 
 
+def _box_smooth(x,*coefs):
+    """
+    Function for a box with error function edges (differentiable version of _box)
+    coefs = [A,x0,width,bkgd,edge]
+    returns f(x) = bkgd + A/2*(erf((x-x0+width/2)/edge) - erf((x-x0-width/2)/edge))
+    """
+    A, x0, width, bkgd, edge = coefs
+    return bkgd + A/2*(erf((x-x0+width/2)/edge) - erf((x-x0-width/2)/edge))
+
+def _box_smooth_jac(x,*coefs):
+    """
+    analytic partial derivatives of _box_smooth with respect to [A,x0,width,bkgd,edge]
+    """
+    A, x0, width, bkgd, edge = coefs
+    u1 = (x-x0+width/2)/edge
+    u2 = (x-x0-width/2)/edge
+    g1 = np.exp(-u1**2)/np.sqrt(np.pi)
+    g2 = np.exp(-u2**2)/np.sqrt(np.pi)
+    return [(erf(u1)-erf(u2))/2, -A*(g1-g2)/edge, A*(g1+g2)/2/edge, np.ones_like(u1), -A*(g1*u1-g2*u2)/edge]
+
 def fit_box(x,y,**kwargs):
     """
     fits a box and returns fit_x, fit_y, coefs, covar 
@@ -240,6 +333,7 @@ def fit_box(x,y,**kwargs):
         plot: True/False plots the data and the fit (default=True)
         xrange=[x_first,x_last] to fit subrange 
         coefs_0=[Amplitude,x0,sigma,bkgd] to specifiy initial guesses, otherwise autoguess
+        smooth: True/False fits _box_smooth with error function edges, coefs_0=[Amplitude,x0,sigma,bkgd,edge] (default=False)
 
     Usage examples:
         x,y = EA_Spectrum(ScanNum,EnergyAxis)
@@ -248,6 +342,7 @@ def fit_box(x,y,**kwargs):
     """
     kwargs.setdefault('plot',True)
     kwargs.setdefault('xrange',[np.inf,np.inf])
+    kwargs.setdefault('smooth',False)
 
     #subrange
     x_fit, y_fit = _xrange(x,y,kwargs['xrange'])
@@ -259,10 +354,20 @@ def fit_box(x,y,**kwargs):
     sigma = abs(x1-x0)/2
     bkgd = np.min(y_fit) 
 
-    coefs_0 = [A, x0, sigma, bkgd] if 'coefs_0' not in kwargs else kwargs['coefs_0']
-
-    coefs, covar = curve_fit(_box, x_fit, y_fit, coefs_0)
-    y_fit= _box(x_fit, *coefs)
+    if kwargs['smooth']:
+        #height, centroid and width from the area above the background
+        y_sub = np.array(y_fit) - bkgd
+        height = np.max(y_sub)
+        dx = np.abs(x_fit[-1]-x_fit[0])/max(len(x_fit)-1,1)
+        x0 = np.sum(x_fit*y_sub)/np.sum(y_sub)
+        width = max(np.sum(y_sub)*dx/height,dx)
+        coefs_0 = [height, x0, width, bkgd, width/10] if 'coefs_0' not in kwargs else kwargs['coefs_0']
+        coefs, covar = curve_fit(_box_smooth, x_fit, y_fit, coefs_0, jac=_curve_fit_jac(_box_smooth_jac))
+        y_fit= _box_smooth(x_fit, *coefs)
+    else:
+        coefs_0 = [A, x0, sigma, bkgd] if 'coefs_0' not in kwargs else kwargs['coefs_0']
+        coefs, covar = curve_fit(_box, x_fit, y_fit, coefs_0)
+        y_fit= _box(x_fit, *coefs)
     fit_vals={
         'height':coefs[0],
         'center':coefs[1],
@@ -274,6 +379,24 @@ def fit_box(x,y,**kwargs):
 
     return  x_fit,y_fit,coefs,covar,fit_vals
 
+def _curve_fit_jac(jac):
+    """
+    wraps an analytic jacobian (list of partial derivatives) into the (n,k) array used by curve_fit(jac=...)
+    """
+    def _jac(x,*coefs):
+        return np.stack(np.broadcast_arrays(*jac(x,*coefs)),axis=-1)
+    return _jac
+
+#models with analytic jacobians: func(x,*coefs), jac(x,*coefs), coefs
+#func and jac are vectorized, x and coefs can be arrays which broadcast (i.e. x (rows,n) and coefs (rows,1))
+fit_models = {
+    'gaussian':{'func':_gaussian,'jac':_gaussian_jac,'coefs':['A','x0','sigma','bkgd']},
+    'lorentzian':{'func':_lorentzian,'jac':_lorentzian_jac,'coefs':['A','x0','sig','bkgd']},
+    'step':{'func':_step,'jac':_step_jac,'coefs':['A','x0','width','bkgd']},
+    'fermi':{'func':_fermi,'jac':_fermi_jac,'coefs':['A','EF','width','slope','bkgd']},
+    'box_smooth':{'func':_box_smooth,'jac':_box_smooth_jac,'coefs':['A','x0','width','bkgd','edge']},
+}
+
 def fit_poly(x,y,rank=3,**kwargs):
     """
     fits a box and returns fit_x, fit_y, coefs, covar 
@@ -296,7 +419,7 @@ def fit_poly(x,y,rank=3,**kwargs):
     #subrange
     x_fit, y_fit = _xrange(x,y,kwargs['xrange'])
     
-    coefs = poly.polyfit(x, y, rank)
+    coefs = poly.polyfit(x_fit, y_fit, rank)
     y_fit = poly.polyval(x_fit, coefs)
     fit_vals={}
     for i,c in enumerate(coefs):
@@ -308,6 +431,53 @@ def fit_poly(x,y,rank=3,**kwargs):
 
 
 
+def fit_poly_stack(x,Y,rank=3,**kwargs):
+    """
+    fits a polynomial to every row of Y with a single least squares solve 
+    (the Vandermonde matrix is shared by all rows) and returns x_fit, y_fit, coefs, residuals, fit_vals
+
+    x = np.array (n)
+    Y = np.array (rows,n), rows with nan are fit separately using the finite points
+
+    **kwargs:
+        xrange=[x_first,x_last] to fit subrange 
+
+    x_fit = np.array (n)
+    y_fit = np.array (rows,n)
+    coefs = np.array (rows,rank+1), lowest order first (same as fit_poly)
+    residuals = np.array (rows), sum of the squared residuals
+    fit_vals = dictionary of arrays (rows) 'c0','c1'...
+
+    Usage examples:
+        x_fit, bkgd, coefs, residuals, fit_vals = fit_poly_stack(EA.scale['x'],EA.data,rank=1)
+    """
+    kwargs.setdefault('xrange',[np.inf,np.inf])
+
+    Y = np.atleast_2d(np.asarray(Y,dtype=float))
+    x_fit, idx = _xrange(np.asarray(x,dtype=float),np.arange(len(x)),kwargs['xrange'])
+    Y_sub = Y[:,idx]
+
+    #scaling the columns for the conditioning (as in polyfit)
+    V = poly.polyvander(x_fit,rank)
+    scl = np.sqrt(np.sum(V**2,axis=0))
+    scl[scl == 0] = 1
+    
+    coefs = np.full((Y.shape[0],rank+1),np.nan)
+    good = ~np.isnan(Y_sub).any(axis=1)
+    if good.any():
+        c = np.linalg.lstsq(V/scl,Y_sub[good].T,rcond=None)[0]
+        coefs[good] = (c/scl[:,np.newaxis]).T
+    for j in np.nonzero(~good)[0]:
+        finite = ~np.isnan(Y_sub[j])
+        if np.sum(finite) > rank:
+            coefs[j] = poly.polyfit(x_fit[finite],Y_sub[j,finite],rank)
+    
+    y_fit = coefs @ V.T
+    residuals = np.nansum((Y_sub - y_fit)**2,axis=1)
+    fit_vals = {'c'+str(i):coefs[:,i] for i in range(rank+1)}
+
+    return x_fit, y_fit, coefs, residuals, fit_vals
+
 def _plot_fit(x,y,x_fit,y_fit,fit_vals={},**kwargs):
     """
     appends data and fit
@@ -341,7 +511,7 @@ def _plot_fit(x,y,x_fit,y_fit,fit_vals={},**kwargs):
         plt.legend()
     #plt.show()
 
-def find_EF_offset(EA_list, E_unit,fit_type,xrange, plot = False): #need to rewrite this in a more intelligent way AJE
+def find_EF_offset(EA_list, E_unit,fit_type,xrange, plot = False, cache = False): #need to rewrite this in a more intelligent way AJE
         '''
         finds and applies the Fermi level offset for each scan in EA_list
         
@@ -349,6 +519,7 @@ def find_EF_offset(EA_list, E_unit,fit_type,xrange, plot = False): #need to rewr
         E_unit = KE or BE
         fit_type = function to fit data to, 'step', 'gaussian', 'lorentzian', or 'voigt'
         xrange = subrange of each scan to be fit
+        cache = True reuses previous fits of the same EDC (default = False), see FitCache
         '''
         
         f = {}
@@ -364,8 +535,11 @@ def find_EF_offset(EA_list, E_unit,fit_type,xrange, plot = False): #need to rewr
             y = EA.EDC.data
 
             if fit_type in fit_dict:
-                fit_func = fit_dict[fit_type]
-                fi = fit_func(x,y,xrange=xrange, plot=plot)
+                if cache:
+                    fi = fit_cache.fit(x,y,fit_type,xrange=xrange, plot=plot)
+                else:
+                    fit_func = fit_dict[fit_type]
+                    fi = fit_func(x,y,xrange=xrange, plot=plot)
                 f[i] = fi
                 cen.append(fi[2][1])
 
@@ -373,43 +547,508 @@ def find_EF_offset(EA_list, E_unit,fit_type,xrange, plot = False): #need to rewr
                 print(fit_type + ' is not a valid fitting function, see doc string')
         return np.array(cen)
 
+def _lm_batch(func,jac,x,Y,coefs_0,**kwargs):
+    """
+    Levenberg-Marquardt least squares fit of all rows of Y at the same time
+
+    func(x,*coefs) = model; jac(x,*coefs) = list of partial derivatives for each coef 
+        both are called with x.shape = (rows,n) and each coef with shape (rows,1)
+    x = np.array (n) shared by all rows or (rows,n)
+    Y = np.array (rows,n), nan are ignored (i.e. for padding different lengths)
+    coefs_0 = initial guess (k) or (rows,k)
+
+    **kwargs:
+        max_iter = maximum number of iterations (default = 200)
+        tol = relative tolerance on the cost and the step (default = 1e-10)
+
+    returns coefs (rows,k), covar (rows,k,k), success (rows)
+    """
+    kwargs.setdefault('max_iter',200)
+    kwargs.setdefault('tol',1e-10)
+    tol = kwargs['tol']
+
+    Y = np.atleast_2d(np.asarray(Y,dtype=float))
+    m,n = Y.shape
+    x = np.broadcast_to(np.asarray(x,dtype=float),(m,n))
+    mask = ~np.isnan(Y) & ~np.isnan(x)
+    Y = np.where(mask,Y,0.0)
+    x = np.where(mask,x,0.0)
+    coefs = np.array(np.broadcast_to(coefs_0,(m,np.shape(coefs_0)[-1])),dtype=float)
+    k = coefs.shape[1]
+    diag = np.arange(k)
+
+    def _resid(rows,P):
+        r = func(x[rows],*P.T[:,:,np.newaxis]) - Y[rows]
+        return np.where(mask[rows],r,0.0)
+
+    def _jac(rows,P):
+        J = [np.broadcast_to(j,(len(rows),n)) for j in jac(x[rows],*P.T[:,:,np.newaxis])]
+        return np.stack(J,axis=-1)*mask[rows][:,:,np.newaxis]
+
+    def _solve(A,b):
+        try:
+            return np.linalg.solve(A,b[:,:,np.newaxis])[:,:,0]
+        except np.linalg.LinAlgError:
+            return np.einsum('mkl,ml->mk',np.linalg.pinv(A),b)
+
+    all_rows = np.arange(m)
+    r = _resid(all_rows,coefs)
+    cost = np.sum(r**2,axis=1)
+    lam = np.full(m,1e-3)
+    active = np.isfinite(cost)
+    success = np.zeros(m,dtype=bool)
+
+    with np.errstate(over='ignore',invalid='ignore',divide='ignore'):
+        for i in range(kwargs['max_iter']):
+            rows = np.nonzero(active)[0]
+            if rows.shape[0] == 0:
+                break
+            P = coefs[rows]
+            J = _jac(rows,P)
+            JtJ = np.einsum('mnk,mnl->mkl',J,J)
+            g = np.einsum('mnk,mn->mk',J,r[rows])
+            A = JtJ.copy()
+            A[:,diag,diag] += lam[rows,np.newaxis]*np.maximum(JtJ[:,diag,diag],1e-12)
+            dp = _solve(A,-g)
+
+            P_new = P + dp
+            r_new = _resid(rows,P_new)
+            cost_new = np.sum(r_new**2,axis=1)
+            better = np.isfinite(cost_new) & (cost_new <= cost[rows])
+
+            #accepting improved rows
+            acc = rows[better]
+            coefs[acc] = P_new[better]
+            r[acc] = r_new[better]
+            small_cost = (cost[acc]-cost_new[better]) <= tol*cost[acc]
+            small_step = np.linalg.norm(dp[better],axis=1) <= tol*(np.linalg.norm(P[better],axis=1)+tol)
+            cost[acc] = cost_new[better]
+            lam[acc] = np.maximum(lam[acc]/10,1e-12)
+            lam[rows[~better]] *= 10
+
+            done = acc[small_cost | small_step]
+            success[done] = True
+            active[done] = False
+            active[lam > 1e12] = False
+
+        #covariance as in curve_fit
+        J = _jac(all_rows,coefs)
+        JtJ = np.einsum('mnk,mnl->mkl',J,J)
+        dof = np.maximum(mask.sum(axis=1)-k,1)
+        covar = np.linalg.pinv(JtJ)*(cost/dof)[:,np.newaxis,np.newaxis]
+    
+    return coefs, covar, success
+
+def _pad_rows(xs,ys):
+    """
+    returns x, Y as 2D arrays padded with nan for a list of 1D arrays of different lengths
+    """
+    n = max(len(y) for y in ys)
+    x = np.full((len(ys),n),np.nan)
+    Y = np.full((len(ys),n),np.nan)
+    for i,(xi,yi) in enumerate(zip(xs,ys)):
+        x[i,:len(xi)] = xi
+        Y[i,:len(yi)] = yi
+    return x, Y
+
+def _stack_guess(x,Y,fit_type):
+    """
+    initial guesses for each row of Y, same as the guesses in fit_gaussian, fit_step ...
+    x = np.array (n)
+    Y = np.array (rows,n)
+    returns coefs_0 with shape (rows,4)
+    """
+    rows = np.arange(Y.shape[0])
+    dx = np.min(np.abs(np.diff(x))) if len(x) > 1 else 1.0
+    mean = np.mean(Y,axis=1)
+    if fit_type in ['gaussian','lorentzian']:
+        A = np.max(Y,axis=1)
+        x0 = x[np.argmax(Y,axis=1)]
+        x1 = x[np.argmin(np.abs(Y-A[:,np.newaxis]/2),axis=1)]
+        width = np.abs(x1-x0)/2
+        bkgd = mean
+    else: 
+        A = np.mean(np.sign(Y),axis=1)*(np.max(Y,axis=1)-np.min(Y,axis=1))/2
+        x0 = x[np.argmin(np.abs(Y-mean[:,np.newaxis]),axis=1)]
+        x1 = x[np.argmin(np.abs(Y-1.25*mean[:,np.newaxis]),axis=1)]
+        width = np.abs(x1-x0) if fit_type == 'step' else np.abs(x1-x0)/2
+        bkgd = np.min(Y,axis=1)
+    width = np.where(width > 0,width,dx)
+    return np.stack((A,x0,width,bkgd),axis=1)
+
+def _stack_fit_vals(fit_type,coefs):
+    """
+    fit_vals dictionary for fit_stack, same keys as fit_gaussian, fit_step ...
+    """
+    if fit_type == 'poly':
+        return {'c'+str(i):coefs[:,i] for i in range(coefs.shape[1])}
+    if fit_type == 'gaussian':
+        return {'Amp':coefs[:,0], 'center':coefs[:,1], 'FWHM':sqrt(8*ln(2))*coefs[:,2]}
+    if fit_type == 'lorentzian':
+        #sig is the half width gamma
+        return {'Amp':coefs[:,0], 'center':coefs[:,1], 'FWHM':2*coefs[:,2]}
+    return {'height':coefs[:,0], 'center':coefs[:,1], 'width':coefs[:,2]}
+
+def _fit_stack_chunk(args):
+    """
+    process pool worker for fit_stack
+    """
+    x, Y, fit_type, kwargs = args
+    return fit_stack(x,Y,fit_type,**kwargs)
+
+def fit_stack(x,Y,fit_type,**kwargs):
+    """
+    fits every row of Y (i.e. each line profile of an image) and 
+    returns x_fit, y_fit, coefs, covar, fit_vals, success
+    
+    x = np.array (n) 
+    Y = np.array (rows,n)
+    fit_type = 'gaussian','lorentzian','step' => all rows are fit at once (see _lm_batch) using the analytic Jacobian
+             = 'poly' => linear least squares for all rows at once
+             = 'box' => curve_fit for each row (the box has no useful derivatives)
+
+    **kwargs:
+        xrange=[x_first,x_last] to fit subrange 
+        coefs_0 = initial guesses (4) or (rows,4), otherwise autoguess
+        rank = 3 (default) for 'poly'
+        nprocs = 1 (default); > 1 splits the rows into chunks which are fit in a process pool 
+        max_iter, tol => see _lm_batch
+
+    x_fit = np.array (n)
+    y_fit, coefs = np.array (rows,n), (rows,k)
+    covar = np.array (rows,k,k), nan for 'poly'
+    fit_vals = dictionary of arrays (rows) with the same keys as fit_gaussian, fit_step ...
+    success = np.array (rows) of bool
+    """
+    kwargs.setdefault('xrange',[np.inf,np.inf])
+    kwargs.setdefault('rank',3)
+    kwargs.setdefault('nprocs',1)
+
+    fit_funcs = {key:(fit_models[key]['func'],fit_models[key]['jac']) for key in ['gaussian','lorentzian','step']}
+    fit_funcs.update({'box':(_box,None),'poly':(None,None)})
+    if fit_type not in fit_funcs.keys():
+        print('Not a valid fit_type use one of the following: '+str(list(fit_funcs.keys())))
+        return
+    
+    Y = np.atleast_2d(np.asarray(Y,dtype=float))
+    x = np.asarray(x,dtype=float)
+    m = Y.shape[0]
+
+    #subrange, same for all rows
+    x_fit, idx = _xrange(x,np.arange(len(x)),kwargs['xrange'])
+    Y_sub = Y[:,idx]
+
+    nprocs = max(min(int(kwargs['nprocs'] or 1),m),1)
+    if nprocs > 1:
+        chunks = np.array_split(np.arange(m),nprocs)
+        #each chunk applies xrange itself, so the subrange is only taken once
+        chunk_kwargs = {key:val for key,val in kwargs.items() if key != 'nprocs'}
+        args = []
+        for c in chunks:
+            ckw = dict(chunk_kwargs)
+            if np.ndim(kwargs.get('coefs_0')) == 2:
+                ckw['coefs_0'] = np.asarray(kwargs['coefs_0'])[c]
+            args.append((x,Y[c],fit_type,ckw))
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            results = list(pool.map(_fit_stack_chunk,args))
+        y_fit = np.concatenate([r[1] for r in results])
+        coefs = np.concatenate([r[2] for r in results])
+        covar = np.concatenate([r[3] for r in results])
+        success = np.concatenate([r[5] for r in results])
+        return x_fit, y_fit, coefs, covar, _stack_fit_vals(fit_type,coefs), success
+    
+    func, jac = fit_funcs[fit_type]
+    if fit_type == 'poly':
+        x_fit, y_fit, coefs = fit_poly_stack(x,Y,kwargs['rank'],xrange=kwargs['xrange'])[:3]
+        covar = np.full((m,coefs.shape[1],coefs.shape[1]),np.nan)
+        success = ~np.isnan(coefs).any(axis=1)
+    else:
+        coefs_0 = _stack_guess(x_fit,Y_sub,fit_type) if 'coefs_0' not in kwargs else kwargs['coefs_0']
+        if jac is not None:
+            lm_kwargs = {key:kwargs[key] for key in ['max_iter','tol'] if key in kwargs}
+            coefs, covar, success = _lm_batch(func,jac,x_fit,Y_sub,coefs_0,**lm_kwargs)
+        else:
+            coefs_0 = np.broadcast_to(coefs_0,(m,4))
+            coefs = np.full((m,4),np.nan)
+            covar = np.full((m,4,4),np.nan)
+            success = np.zeros(m,dtype=bool)
+            for j in range(m):
+                try:
+                    coefs[j], covar[j] = curve_fit(func,x_fit,Y_sub[j],coefs_0[j])
+                    success[j] = True
+                except (RuntimeError,ValueError):
+                    pass
+        y_fit = func(x_fit,*coefs.T[:,:,np.newaxis])
+    
+    return x_fit, y_fit, coefs, covar, _stack_fit_vals(fit_type,coefs), success
+
+def fit_fermi_stack(x,Y,**kwargs):
+    """
+    fits a Fermi edge (see _fermi) to every row of Y at once 
+    returns coefs, covar, success 
+        coefs[:,1] = EF for each row
+
+    x = np.array (n) or (rows,n), needs to be increasing (KE scaling), can be padded with nan 
+    Y = np.array (rows,n)
+
+    **kwargs:
+        coefs_0 = initial guess (5) or (rows,5), otherwise autoguess
+        warm_start = True (default); rows which do not converge are refit starting 
+                     from the result of the nearest converged row
+        max_iter, tol => see _lm_batch
+    """
+    kwargs.setdefault('warm_start',True)
+    
+    Y = np.atleast_2d(np.asarray(Y,dtype=float))
+    x = np.broadcast_to(np.asarray(x,dtype=float),Y.shape)
+    coefs_0 = _fermi_guess(x,Y) if 'coefs_0' not in kwargs else kwargs['coefs_0']
+    lm_kwargs = {key:kwargs[key] for key in ['max_iter','tol'] if key in kwargs}
+    
+    coefs, covar, success = _lm_batch(_fermi,_fermi_jac,x,Y,coefs_0,**lm_kwargs)
+
+    if kwargs['warm_start'] and success.any() and not success.all():
+        good = np.nonzero(success)[0]
+        bad = np.nonzero(~success)[0]
+        nearest = good[np.argmin(np.abs(bad[:,np.newaxis]-good[np.newaxis,:]),axis=1)]
+        c, cv, s = _lm_batch(_fermi,_fermi_jac,x[bad],Y[bad],coefs[nearest],**lm_kwargs)
+        coefs[bad], covar[bad], success[bad] = c, cv, s
+
+    return coefs, covar, success
+
+def _series_vals(fit_type,coefs,errs):
+    """
+    fit_vals and their errors for fit_series
+    """
+    if fit_type == 'gaussian':
+        names, scale = ['Amp','center','FWHM'], [1,1,sqrt(8*ln(2))]
+    elif fit_type == 'lorentzian':
+        #sig is the half width gamma
+        names, scale = ['Amp','center','FWHM'], [1,1,2]
+    elif fit_type == 'voigt':
+        names, scale = ['height','center','fwhm'], [1,1,1]
+    else:
+        names, scale = ['height','center','width'], [1,1,1]
+    fit_vals = {key:s*coefs[:,i] for i,(key,s) in enumerate(zip(names,scale))}
+    fit_errs = {key:s*errs[:,i] for i,(key,s) in enumerate(zip(names,scale))}
+    return fit_vals, fit_errs
+
+def _fit_series_chunk(args):
+    """
+    fits a list of x,y pairs in order, each fit starts from the result of the previous successful one
+    index = position of each pair in the series, for the error messages
+    returns coefs, errs (nan if the fit failed)
+    """
+    index, xs, ys, fit_type, kwargs = args
+    fit_funcs = {'box':fit_box,'gaussian':fit_gaussian,'lorentzian':fit_lorentzian,'step':fit_step,'voigt':fit_voigt}
+    k = 3 if fit_type == 'voigt' else 4
+    coefs = np.full((len(ys),k),np.nan)
+    errs = np.full((len(ys),k),np.nan)
+    coefs_0 = kwargs.get('coefs_0',None)
+    for i,(x,y) in enumerate(zip(xs,ys)):
+        fit_kwargs = {'xrange':kwargs.get('xrange',[np.inf,np.inf]),'plot':False}
+        if coefs_0 is not None and fit_type != 'voigt':
+            fit_kwargs['coefs_0'] = coefs_0
+        try:
+            fi = fit_funcs[fit_type](np.asarray(x,dtype=float),np.asarray(y,dtype=float),**fit_kwargs)
+        except (RuntimeError, ValueError, TypeError, IndexError) as e:
+            #IndexError from the autoguess when there is no data in xrange
+            print('fit_series: fit '+str(index[i])+' failed, '+str(e))
+            continue
+        coefs[i] = fi[2]
+        errs[i] = np.sqrt(np.abs(np.diag(fi[3])))
+        if kwargs.get('warm_start',True):
+            coefs_0 = np.array(fi[2])
+    return coefs, errs
+
+def fit_series(xs,ys,fit_type,**kwargs):
+    """
+    fits the same peak in a series of 1D data sets (i.e. a list of scans)
+    each fit is seeded with the result of the previous one
+
+    xs, ys = lists of np.arrays (can be different lengths)
+    fit_type = 'box','gaussian','lorentzian','step','voigt'
+
+    **kwargs:
+        xrange=[x_first,x_last] to fit subrange 
+        coefs_0 = initial guess for the first fit, otherwise autoguess
+        warm_start = True (default); False => each fit uses the autoguess
+        nprocs = 1 (default); > 1 splits the series into consecutive chunks which are fit in 
+                 a process pool, each chunk is warm started from its own first fit
+
+    returns coefs, errs, fit_vals, fit_errs
+        coefs, errs = np.array (len(ys),k), nan for failed fits
+        fit_vals, fit_errs = dictionaries of arrays with the same keys as fit_gaussian, fit_step...
+    """
+    kwargs.setdefault('nprocs',1)
+    if fit_type not in ['box','gaussian','lorentzian','step','voigt']:
+        print('Not a valid fit_type use one of the following: '+str(['box','gaussian','lorentzian','step','voigt']))
+        return
+
+    n = len(ys)
+    nprocs = max(min(int(kwargs['nprocs'] or 1),n),1)
+    chunk_kwargs = {key:val for key,val in kwargs.items() if key != 'nprocs'}
+    chunks = np.array_split(np.arange(n),nprocs)
+    args = [(list(c),[xs[i] for i in c],[ys[i] for i in c],fit_type,chunk_kwargs) for c in chunks]
+    if nprocs == 1:
+        results = [_fit_series_chunk(args[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            results = list(pool.map(_fit_series_chunk,args))
+    coefs = np.concatenate([r[0] for r in results])
+    errs = np.concatenate([r[1] for r in results])
+    fit_vals, fit_errs = _series_vals(fit_type,coefs,errs)
+
+    return coefs, errs, fit_vals, fit_errs
+
+def find_EF_offset_batch(EA_list, E_unit='KE', fit_type='fermi', xrange=[np.inf,np.inf], **kwargs):
+    '''
+    fits the Fermi edge of the EDC for all scans in EA_list and returns an array with
+    the Fermi level for each EA (same as find_EF_offset without plotting)
+
+    EA_list = list of EA scans 
+    E_unit = KE or BE
+    fit_type = 'fermi' (default) => Fermi-Dirac x linear background, all EDCs are fit at once (see fit_fermi_stack)
+             = 'step', 'gaussian', 'lorentzian', or 'voigt' => fit in a process pool
+    xrange = subrange of each scan to be fit
+
+    **kwargs:
+        warm_start = True (default); starts each fit from the result of the previous EDC
+        nprocs = number of processes for the process pool (default: os.cpu_count())
+        offsets = False (default) returns the Fermi level
+                = True returns E_offset for each EA so that BE = 0 at the Fermi level
+    '''
+    kwargs.setdefault('warm_start',True)
+    kwargs.setdefault('nprocs',os.cpu_count())
+    kwargs.setdefault('offsets',False)
+
+    xs, ys = [], []
+    for EA in EA_list:
+        x = np.array(EA.BEscale if E_unit == 'BE' else EA.KEscale,dtype=float)
+        x_sub, y_sub = _xrange(x,np.asarray(EA.EDC.data,dtype=float),xrange)
+        xs.append(x_sub)
+        ys.append(y_sub)
+
+    if fit_type == 'fermi':
+        #occupied states are at positive BE, so fit vs -BE
+        sign = -1 if E_unit == 'BE' else 1
+        x, Y = _pad_rows([sign*x for x in xs],ys)
+        order = np.argsort(np.where(np.isnan(x),np.inf,x),axis=1)
+        x = np.take_along_axis(x,order,axis=1)
+        Y = np.take_along_axis(Y,order,axis=1)
+        coefs, covar, success = fit_fermi_stack(x,Y,warm_start=kwargs['warm_start'])
+        cen = sign*coefs[:,1]
+        cen[~success] = np.nan
+    
+    elif fit_type in ['step','gaussian','lorentzian','voigt']:
+        coefs = fit_series(xs,ys,fit_type,warm_start=kwargs['warm_start'],nprocs=kwargs['nprocs'])[0]
+        cen = coefs[:,1]
+    
+    else:
+        print(fit_type + ' is not a valid fitting function, see doc string')
+        return
+
+    if kwargs['offsets']:
+        if E_unit == 'BE':
+            return np.array([EA.E_offset - c for c,EA in zip(cen,EA_list)])
+        return np.array([c + EA.wk - EA.hv for c,EA in zip(cen,EA_list)])
+    return cen
+
 def _shirley(y,**kwargs):
     """
     # Shirley formula: background at i = y_min + (y_max - y_min) * (integral from i to end of (y-y_bg)) / (total integral)
     
+    y = np.array (n) or (rows,n), one background per row
+    the integrals are reverse cumulative sums so each iteration is O(n)
 
+    **kwargs:
+        tol = 1e-5 (default)
+        max_iter = 200 (default)
+
+    returns y_bkg, fit_vals (values are arrays (rows) if y is 2D)
     """
     kwargs.setdefault('tol',1e-5)
     kwargs.setdefault('max_iter',200)
     kwargs.setdefault('debug',False)
     
-    y_bkg = np.zeros_like(y)
+    y = np.asarray(y,dtype=float)
+    Y = np.atleast_2d(y)
+    y_first, y_last = Y[:,:1], Y[:,-1:]
+    y_bkg = np.zeros_like(Y)
+    tol = np.full(Y.shape[0],np.inf)
+    iterations = np.zeros(Y.shape[0],dtype=int)
+    integral_total = np.zeros(Y.shape[0])
+    active = np.arange(Y.shape[0])
     for i in range(kwargs['max_iter']):
-        y_bg_i = y_bkg.copy()
-        integral_total = np.sum(y - y_bkg)
-        #integrating over n
-        for n in range(y.shape[0]):
-            integral_n = np.sum(y[n:] - y_bkg[n:])
- 
-            y_bkg[n] = y[-1] + (y[0] - y[-1]) * (integral_n / integral_total if integral_total != 0 else 0)
-            tol = np.max(np.abs(y_bkg - y_bg_i))
-            fit_vals = {'iterations':n,
-                         'integral_total': integral_total,
-                         'tolerance': tol,
-                         }
-            if  tol < kwargs['tol']:
-                return y_bkg, fit_vals
+        if active.shape[0] == 0:
+            break
+        diff = Y[active] - y_bkg[active]
+        integral_n = np.cumsum(diff[:,::-1],axis=1)[:,::-1]
+        total = integral_n[:,:1]
+        frac = np.divide(integral_n,total,out=np.zeros_like(integral_n),where=total!=0)
+        y_bkg_i = y_last[active] + (y_first[active] - y_last[active])*frac
         
+        tol[active] = np.max(np.abs(y_bkg_i - y_bkg[active]),axis=1)
+        integral_total[active] = total[:,0]
+        iterations[active] = i
+        y_bkg[active] = y_bkg_i
+        active = active[tol[active] >= kwargs['tol']]
+        if kwargs['debug']:
+            print(i, np.max(tol))
+    
+    fit_vals = {'iterations':iterations,
+                'integral_total': integral_total,
+                'tolerance': tol,
+                }
+    if y.ndim == 1:
+        return y_bkg[0], {key:val[0] for key,val in fit_vals.items()}
+    return y_bkg, fit_vals
+
+def _tougaard(x,y,**kwargs):
+    """
+    # Tougaard formula: background at i = B * integral from i to end of K(x'-x_i) * (y(x')-y_end) 
+    # with the universal cross section K(T) = T/(C+T**2)**2, B is set so that the background = y at the start
+    
+    x = np.array (n), evenly spaced energies
+    y = np.array (n) or (rows,n), one background per row
+    the integral is a correlation done with an fft, O(n log n)
+
+    **kwargs:
+        C = 1643 eV**2 (default) 
+
+    returns y_bkg, fit_vals (values are arrays (rows) if y is 2D)
+    """
+    kwargs.setdefault('C',1643)
+
+    y = np.asarray(y,dtype=float)
+    Y = np.atleast_2d(y)
+    n = Y.shape[1]
+    dx = np.abs(x[-1]-x[0])/(n-1) if n > 1 else 1.0
+    T = np.arange(n)*dx
+    K = T/(kwargs['C']+T**2)**2
+
+    #integral_i = sum_k K[k] * y[i+k], correlation along the rows
+    diff = Y - Y[:,-1:]
+    integral_n = fftconvolve(diff,K[np.newaxis,::-1],mode='full',axes=1)[:,n-1:]*dx
+    B = np.divide(Y[:,0]-Y[:,-1],integral_n[:,0],out=np.zeros(Y.shape[0]),where=integral_n[:,0]!=0)
+    y_bkg = Y[:,-1:] + B[:,np.newaxis]*integral_n
+
+    fit_vals = {'B':B,
+                'C':np.full(Y.shape[0],kwargs['C'],dtype=float),
+                }
+    if y.ndim == 1:
+        return y_bkg[0], {key:val[0] for key,val in fit_vals.items()}
+    return y_bkg, fit_vals
+
 def fit_shirley_background(x,y,**kwargs):
     """
     fits a Shirley background to the data
 
     x,y np.arrays of the the x,y data where x= energy, y = intensity
+    y can be 2D (rows,n) to get the background for each row (i.e. EDCs of an image)
 
     **kwargs:
         plot: True/False plots the data and the fit (default=True)
         xrange=[x_first,x_last] to fit subrange 
-        coefs_0=[Amplitude,x0,sigma,bkgd] to specifiy initial guesses, otherwise autoguess
         max_iter: maximum number of iterations (default=200)
         tolerance = 1e-5
     Usage examples:
@@ -421,12 +1060,478 @@ def fit_shirley_background(x,y,**kwargs):
     kwargs.setdefault('xrange',[np.inf,np.inf])
 
     #subrange
-    x_fit, y_fit = _xrange(x,y,kwargs['xrange'])
+    x_fit, idx = _xrange(x,np.arange(len(x)),kwargs['xrange'])
+    y_fit = np.asarray(y)[...,idx]
 
     #do fit
     y_fit, fit_vals = _shirley(y_fit,**kwargs)
 
-    if kwargs['plot']:
+    if kwargs['plot'] and np.ndim(y) == 1:
+        _plot_fit(x,y,x_fit,y_fit,fit_vals,**kwargs)
+
+    return  x_fit,y_fit,fit_vals
+
+def fit_tougaard_background(x,y,**kwargs):
+    """
+    fits a Tougaard background to the data
+
+    x,y np.arrays of the the x,y data where x= energy, y = intensity
+    y can be 2D (rows,n) to get the background for each row (i.e. EDCs of an image)
+
+    **kwargs:
+        plot: True/False plots the data and the fit (default=True)
+        xrange=[x_first,x_last] to fit subrange 
+        C = 1643 eV**2 (default), see _tougaard
+    Usage examples:
+        x,y = EA_Spectrum(ScanNum,EnergyAxis)
+        x,y,x_name,y_name = mda_1D(ScanNum,detNum)
+
+    """
+    kwargs.setdefault('plot',True)
+    kwargs.setdefault('xrange',[np.inf,np.inf])
+
+    #subrange
+    x_fit, idx = _xrange(x,np.arange(len(x)),kwargs['xrange'])
+    y_fit = np.asarray(y)[...,idx]
+
+    #do fit
+    y_fit, fit_vals = _tougaard(x_fit,y_fit,**kwargs)
+
+    if kwargs['plot'] and np.ndim(y) == 1:
         _plot_fit(x,y,x_fit,y_fit,fit_vals,**kwargs)
 
-    return  x_fit,y_fit,fit_vals
\ No newline at end of file
+    return  x_fit,y_fit,fit_vals
+
+def _peak_partials(shape,x,amp,center,width):
+    """
+    peak and its partial derivatives with respect to amp, center, width (no background)
+    x = np.array (rows,n); amp, center, width = np.array (rows,1)
+    """
+    if shape == 'gaussian':
+        f = _gaussian(x,amp,center,width,0)
+        d = _gaussian_jac(x,amp,center,width,0)
+    elif shape == 'lorentzian':
+        f = _lorentzian(x,amp,center,width,0)
+        d = _lorentzian_jac(x,amp,center,width,0)
+    return f, {'amp':d[0],'center':d[1],'width':d[2]}
+
+def _revcumsum(a):
+    """
+    reverse cumulative sum along the last axis (integral from i to the end, see _shirley)
+    """
+    return np.cumsum(a[...,::-1],axis=-1)[...,::-1]
+
+class _GlobalPeakModel:
+    """
+    parameter bookkeeping for fit_peaks_global
+    
+    each peak parameter ('amp','center','width') is one of:
+        local  => one value per spectrum
+        global => one value for all the spectra
+        fixed  => kept at the initial value
+        linked => to the same parameter of a previous peak, 
+                  '+' => ref + offset, '*' => ref * ratio, '=' => ref
+                  offset and ratio are global (or fixed)
+    each spectrum also has a Shirley background: bkgd = c + k * integral from i to end of the peaks
+    """
+    names = ['amp','center','width']
+
+    def __init__(self,peaks,rows):
+        self.peaks = peaks
+        self.rows = rows
+        self.slots = []      #(peak index, name, kind)
+        for p,peak in enumerate(peaks):
+            shared = peak.get('shared',[])
+            fix = peak.get('fix',[])
+            link = peak.get('link',{})
+            for name in self.names:
+                if name in link and link[name][0] == '=':
+                    continue
+                if name in fix:
+                    kind = 'fixed'
+                elif name in shared or name in link:
+                    kind = 'global'
+                else:
+                    kind = 'local'
+                self.slots.append((p,name,kind))
+        self.global_slots = [s for s in self.slots if s[2] == 'global']
+        self.local_slots = [s for s in self.slots if s[2] == 'local']
+        self.fixed_slots = [s for s in self.slots if s[2] == 'fixed']
+        self.nG = len(self.global_slots)
+        self.nL = len(self.local_slots)+2  #+ c,k for the background
+        self.nparams = self.nG + rows*self.nL
+
+    def unpack(self,params,fixed):
+        """
+        returns a dictionary of slot values (rows,1) and the background c,k (rows,1)
+        """
+        vals = {}
+        for j,(p,name,kind) in enumerate(self.global_slots):
+            vals[(p,name)] = np.full((self.rows,1),params[j])
+        L = params[self.nG:].reshape(self.rows,self.nL)
+        for j,(p,name,kind) in enumerate(self.local_slots):
+            vals[(p,name)] = L[:,j:j+1]
+        for (p,name,kind) in self.fixed_slots:
+            vals[(p,name)] = np.full((self.rows,1),fixed[(p,name)])
+        return vals, L[:,-2:-1], L[:,-1:]
+
+    def effective(self,vals):
+        """
+        peak parameters after applying the links
+        """
+        eff = {}
+        for p,peak in enumerate(self.peaks):
+            link = peak.get('link',{})
+            for name in self.names:
+                if name in link:
+                    op, ref = link[name]
+                    if op == '+':
+                        eff[(p,name)] = eff[(ref,name)] + vals[(p,name)]
+                    elif op == '*':
+                        eff[(p,name)] = eff[(ref,name)] * vals[(p,name)]
+                    else:
+                        eff[(p,name)] = eff[(ref,name)]
+                else:
+                    eff[(p,name)] = vals[(p,name)]
+        return eff
+
+def fit_peaks_global(x,Y,peaks,**kwargs):
+    """
+    fits the same set of peaks plus a Shirley background to a series of spectra (i.e. hv or temperature series) 
+    all at once, parameters can be shared across the spectra or linked between peaks (i.e. spin-orbit splitting)
+
+    x = np.array (n), shared energy scale
+    Y = np.array (rows,n), i.e. np.array([EA.EDC.data for EA in EA_list]) from make_EA_list
+    peaks = list of dictionaries, one per peak:
+        'shape' = 'gaussian' or 'lorentzian' (see _gaussian, _lorentzian)
+        'center', 'width' = initial values
+        'amp' = initial value (optional, otherwise guessed from the data at center)
+        'shared' = list of parameters with the same value for all the spectra, i.e. ['width']
+        'fix' = list of parameters kept at their initial values
+        'link' = {name:(op,ref_peak)} links the parameter to the one from a previous peak
+                 op = '+' => center = center[ref_peak] + splitting (one global splitting)
+                 op = '*' => amp = amp[ref_peak] * ratio (one global ratio, add 'amp' to 'fix' to keep it fixed)
+                 op = '=' => width = width[ref_peak]
+            
+            example for a spin-orbit doublet with the same width and a 1:2 branching ratio
+                peaks = [{'shape':'gaussian','center':71.0,'width':0.4,'shared':['width']},
+                         {'shape':'gaussian','center':74.7,'width':0.4,'amp':0.5,'link':{'center':('+',0),'amp':('*',0),'width':('=',0)},'fix':['amp']}]
+                the initial 'amp' of a '*' linked peak is the ratio
+
+    **kwargs:
+        xrange=[x_first,x_last] to fit subrange 
+        max_nfev = maximum number of function evaluations (default = None, least_squares default)
+        covar = True (default) calculates the errors if the number of parameters is less than 5000
+
+    Jacobian is analytic and sparse (each spectrum only depends on its own and the global parameters), 
+    solved with scipy.optimize.least_squares(method='trf', tr_solver='lsmr')
+
+    returns x_fit, y_fit, bkgd, params, errors, fit_vals
+        y_fit, bkgd = np.array (rows,n) with the total fit and the Shirley background
+        params, errors = dictionaries of the free parameters, keys 'amp0','center1'... (global parameters are floats, 
+                         local parameters arrays (rows)), linked parameters are the offset/ratio
+        fit_vals = dictionary with arrays (rows) for every peak parameter after the links
+    """
+    kwargs.setdefault('xrange',[np.inf,np.inf])
+    kwargs.setdefault('max_nfev',None)
+    kwargs.setdefault('covar',True)
+
+    Y = np.atleast_2d(np.asarray(Y,dtype=float))
+    x_fit, idx = _xrange(np.asarray(x,dtype=float),np.arange(len(x)),kwargs['xrange'])
+    Ys = Y[:,idx]
+    rows, n = Ys.shape
+    X = np.broadcast_to(x_fit,(rows,n))
+    mask = ~np.isnan(Ys)
+    Yz = np.where(mask,Ys,0.0)
+
+    for p,peak in enumerate(peaks):
+        if peak.get('shape','gaussian') not in ['gaussian','lorentzian']:
+            print('Not a valid peak shape: '+str(peak.get('shape'))+", use 'gaussian' or 'lorentzian'")
+            return
+        for name,(op,ref) in peak.get('link',{}).items():
+            if ref >= p:
+                print('peaks can only be linked to a previous peak')
+                return
+    model = _GlobalPeakModel(peaks,rows)
+    
+    #initial values
+    y_min = np.nanmin(Ys,axis=1)
+    init = {}
+    for p,peak in enumerate(peaks):
+        shape = peak.get('shape','gaussian')
+        link = peak.get('link',{})
+        init[(p,'center')] = peak['center'] - (peaks[link['center'][1]]['center'] if link.get('center',('',0))[0] == '+' else 0)
+        init[(p,'width')] = peak['width'] / (peaks[link['width'][1]]['width'] if link.get('width',('',0))[0] == '*' else 1)
+        if 'amp' in peak:
+            init[(p,'amp')] = peak['amp']
+        else:
+            height = Ys[:,np.argmin(np.abs(x_fit-peak['center']))] - y_min
+            init[(p,'amp')] = np.nanmean(height)*(np.pi*peak['width'] if shape == 'lorentzian' else 1)
+            if link.get('amp',('',0))[0] == '*':
+                init[(p,'amp')] /= init[(link['amp'][1],'amp')]
+    fixed = {(p,name):init[(p,name)] for (p,name,kind) in model.fixed_slots}
+    
+    params_0 = np.zeros(model.nparams)
+    params_0[:model.nG] = [init[(p,name)] for (p,name,kind) in model.global_slots]
+    L = np.zeros((rows,model.nL))
+    for j,(p,name,kind) in enumerate(model.local_slots):
+        L[:,j] = init[(p,name)]
+    vals, c, k = model.unpack(np.concatenate((params_0[:model.nG],L.ravel())),fixed)
+    total = sum(_peak_partials(peak.get('shape','gaussian'),X,*[model.effective(vals)[(p,nm)] for nm in model.names])[0] for p,peak in enumerate(peaks))
+    S0 = np.sum(total,axis=1)
+    L[:,-2] = np.nan_to_num(Ys[:,-1])
+    L[:,-1] = np.divide(np.nan_to_num(Ys[:,0]-Ys[:,-1]),S0,out=np.zeros(rows),where=S0!=0)
+    params_0[model.nG:] = L.ravel()
+
+    def _evaluate(params):
+        vals, c, k = model.unpack(params,fixed)
+        eff = model.effective(vals)
+        total = np.zeros((rows,n))
+        D = {}
+        for p,peak in enumerate(peaks):
+            f, d = _peak_partials(peak.get('shape','gaussian'),X,*[eff[(p,nm)] for nm in model.names])
+            total += f
+            for nm in model.names:
+                #derivative of peaks + k*Shirley with respect to the effective parameter
+                D[(p,nm)] = d[nm] + k*_revcumsum(d[nm])
+        S = _revcumsum(total)
+        return total + c + k*S, S, D, vals, eff
+
+    def _resid(params):
+        y_fit = _evaluate(params)[0]
+        return np.where(mask,y_fit-Yz,0.0).ravel()
+
+    def _jac(params):
+        y_fit, S, D, vals, eff = _evaluate(params)
+        #chain rule through the links, from the last peak to the first
+        G = {}
+        for p in reversed(range(len(peaks))):
+            link = peaks[p].get('link',{})
+            for nm in model.names:
+                if nm in link:
+                    op, ref = link[nm]
+                    if op == '+':
+                        D[(ref,nm)] = D[(ref,nm)] + D[(p,nm)]
+                        G[(p,nm)] = D[(p,nm)]
+                    elif op == '*':
+                        D[(ref,nm)] = D[(ref,nm)] + D[(p,nm)]*vals[(p,nm)]
+                        G[(p,nm)] = D[(p,nm)]*eff[(ref,nm)]
+                    else:
+                        D[(ref,nm)] = D[(ref,nm)] + D[(p,nm)]
+                else:
+                    G[(p,nm)] = D[(p,nm)]
+
+        rows_idx = np.arange(rows*n).reshape(rows,n)
+        r_list, c_list, v_list = [], [], []
+        for j,(p,nm,kind) in enumerate(model.global_slots):
+            r_list.append(rows_idx.ravel())
+            c_list.append(np.full(rows*n,j))
+            v_list.append(np.where(mask,G[(p,nm)],0.0).ravel())
+        local = [G[(p,nm)] for (p,nm,kind) in model.local_slots] + [np.ones((rows,n)), S]
+        for j,d in enumerate(local):
+            r_list.append(rows_idx.ravel())
+            c_list.append(np.repeat(model.nG + np.arange(rows)*model.nL + j,n))
+            v_list.append(np.where(mask,np.broadcast_to(d,(rows,n)),0.0).ravel())
+        return sparse.csr_matrix((np.concatenate(v_list),(np.concatenate(r_list),np.concatenate(c_list))),
+                                 shape=(rows*n,model.nparams))
+
+    result = least_squares(_resid,params_0,jac=_jac,method='trf',tr_solver='lsmr',x_scale='jac',max_nfev=kwargs['max_nfev'])
+
+    y_fit, S, D, vals, eff = _evaluate(result.x)
+    vals, c, k = model.unpack(result.x,fixed)
+    bkgd = c + k*S
+
+    #errors from the covariance = inv(JtJ)*s**2
+    err = np.full(model.nparams,np.nan)
+    if kwargs['covar'] and model.nparams < 5000:
+        JtJ = (result.jac.T @ result.jac).toarray() if sparse.issparse(result.jac) else result.jac.T @ result.jac
+        dof = max(np.sum(mask)-model.nparams,1)
+        err = np.sqrt(np.abs(np.diag(np.linalg.pinv(JtJ))*np.sum(result.fun**2)/dof))
+    err_L = err[model.nG:].reshape(rows,model.nL)
+
+    params, errors = {}, {}
+    for j,(p,nm,kind) in enumerate(model.global_slots):
+        params[nm+str(p)], errors[nm+str(p)] = result.x[j], err[j]
+    for j,(p,nm,kind) in enumerate(model.local_slots):
+        params[nm+str(p)], errors[nm+str(p)] = vals[(p,nm)][:,0], err_L[:,j]
+    params['bkgd_c'], errors['bkgd_c'] = c[:,0], err_L[:,-2]
+    params['bkgd_k'], errors['bkgd_k'] = k[:,0], err_L[:,-1]
+    fit_vals = {nm+str(p):eff[(p,nm)][:,0] for p in range(len(peaks)) for nm in model.names}
+
+    return x_fit, y_fit, bkgd, params, errors, fit_vals
+
+_fit_key_display = ['plot','title','data_label','fit_label','show_legend','plot_fits1D','plot_fits2D']
+
+def _fit_key(x,y,fit_type,**kwargs):
+    """
+    hash of the data, fit_type and all the kwargs which can change the result 
+    (display only kwargs like plot and title are ignored)
+    """
+    h = hashlib.sha1()
+    for a in (x,y):
+        a = np.ascontiguousarray(a)
+        h.update(str((a.shape,a.dtype.str)).encode())
+        h.update(a.tobytes())
+    kwargs.setdefault('xrange',[np.inf,np.inf])
+    extra = []
+    for key in sorted(kwargs):
+        if key in _fit_key_display:
+            continue
+        val = kwargs[key]
+        if isinstance(val,(list,tuple,np.ndarray)):
+            val = np.asarray(val)
+            val = (val.astype(float) if val.dtype.kind in 'iuf' else val).tolist()
+        extra.append((key,val))
+    h.update(repr((fit_type,extra)).encode())
+    return h.hexdigest()
+
+class FitCache:
+    """
+    memoizes fit results keyed on (data hash, fit_type, kwargs)
+    
+    maxsize = number of results kept in memory, least recently used are dropped (default = 256)
+    path = directory for an on disk store of the results (default = None, memory only)
+
+    usage:
+        fit_cache.fit(x,y,'gaussian',xrange=[1,2])
+    """
+    fit_funcs = {
+        'box':fit_box,
+        'gaussian':fit_gaussian,
+        'lorentzian':fit_lorentzian,
+        'poly':fit_poly,
+        'step':fit_step,
+        'voigt':fit_voigt,
+        'shirley':fit_shirley_background,
+        'tougaard':fit_tougaard_background,
+    }
+    warm_types = ['box','gaussian','lorentzian','step']
+
+    def __init__(self,maxsize=256,path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._data = OrderedDict()
+        self._last = {}
+        if path is not None:
+            os.makedirs(path,exist_ok=True)
+
+    def _fpath(self,key):
+        return os.path.join(self.path,key+'.pkl')
+
+    def get(self,key):
+        """
+        returns the cached result for key or None
+        """
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+        if self.path is not None and os.path.exists(self._fpath(key)):
+            with open(self._fpath(key),'rb') as f:
+                result = pickle.load(f)
+            self._put_mem(self._results,key,result)
+            return result
+        return None
+
+    def _put_mem(self,d,key,val):
+        d[key] = val
+        d.move_to_end(key)
+        while len(d) > self.maxsize:
+            d.popitem(last=False)
+
+    def put(self,key,result):
+        """
+        stores result in memory (and on disk if path is set)
+        """
+        self._put_mem(self._results,key,result)
+        if self.path is not None:
+            with open(self._fpath(key),'wb') as f:
+                pickle.dump(result,f)
+
+    def load(self,key,loader):
+        """
+        memoizes loaded data, returns loader() the first time and a copy of the stored value after that
+        key needs to be hashable (include the file modification time to catch updated files)
+        """
+        if key in self._data:
+            self._data.move_to_end(key)
+            return copy.deepcopy(self._data[key])
+        val = loader()
+        if val is not None:
+            self._put_mem(self._data,key,copy.deepcopy(val))
+        return val
+
+    def clear(self,disk=False):
+        """
+        empties the memory cache; disk = True to also delete the on disk store
+        """
+        self._results.clear()
+        self._data.clear()
+        self._last.clear()
+        if disk and self.path is not None:
+            for fname in os.listdir(self.path):
+                if fname.endswith('.pkl'):
+                    os.remove(os.path.join(self.path,fname))
+
+    def warm_start(self,fit_type,xrange=[np.inf,np.inf]):
+        """
+        returns the coefs of the last fit with the same fit_type and xrange, or None
+        """
+        return self._last.get((fit_type,tuple(float(v) for v in xrange)))
+
+    def fit(self,x,y,fit_type,**kwargs):
+        """
+        same as fit_gaussian, fit_step... but returns a copy of the stored result if the same fit was already done
+
+        fit_type = 'box','gaussian','lorentzian','poly','step','voigt','shirley','tougaard'
+
+        **kwargs:
+            warm_start = False (default); True => coefs_0 from the last fit with the same fit_type and xrange
+                         (i.e. neighboring scans), only used if coefs_0 is not specified,
+                         the result is stored with that coefs_0 so it only matches the same warm start
+            see fit_gaussian... for the others
+        """
+        kwargs.setdefault('plot',True)
+        kwargs.setdefault('xrange',[np.inf,np.inf])
+        warm_start = kwargs.pop('warm_start',False)
+
+        if fit_type not in self.fit_funcs.keys():
+            print('Not a valid fit_type use one of the following: '+str(list(self.fit_funcs.keys())))
+            return
+
+        x = np.asarray(x)
+        y = np.asarray(y)
+        #the warm start coefs_0 is part of the key, the result depends on it
+        if warm_start and 'coefs_0' not in kwargs and fit_type in self.warm_types:
+            coefs_0 = self.warm_start(fit_type,kwargs['xrange'])
+            if coefs_0 is not None:
+                kwargs['coefs_0'] = coefs_0
+        key = _fit_key(x,y,fit_type,**kwargs)
+        result = self.get(key)
+
+        if result is None:
+            self.misses += 1
+            result = self.fit_funcs[fit_type](x,y,**kwargs)
+            self.put(key,copy.deepcopy(result))
+        else:
+            self.hits += 1
+            result = copy.deepcopy(result)
+            if kwargs['plot']:
+                fit_vals = result[-1] if isinstance(result[-1],dict) else {}
+                plot_kwargs = {k:kwargs[k] for k in ['data_label','fit_label','show_legend'] if k in kwargs}
+                _plot_fit(x,y,result[0],result[1],fit_vals,**plot_kwargs)
+
+        if fit_type in self.warm_types:
+            self._last[(fit_type,tuple(float(v) for v in kwargs['xrange']))] = np.array(result[2])
+        
+        return result
+
+fit_cache = FitCache()
+
+def cached_fit(x,y,fit_type,**kwargs):
+    """
+    fits using the default fit_cache, see FitCache.fit
+    """
+    return fit_cache.fit(x,y,fit_type,**kwargs)
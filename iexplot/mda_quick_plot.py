@@ -1,7 +1,7 @@
 
 
 from os import listdir
-from os.path import join, isfile, dirname
+from os.path import join, isfile, dirname, getmtime
 
 ### Data analysis:
 from scipy.optimize import curve_fit
@@ -18,7 +18,7 @@ except:
     print('netCDF4 not loaded')
 
 ##### APS / 29ID-IEX:
-from iexplot.fitting import fit_gaussian, fit_lorentzian,fit_box,fit_step,fit_poly
+from iexplot.fitting import fit_gaussian, fit_lorentzian,fit_box,fit_step,fit_poly,fit_cache
 from iexplot.mda import readMDA,scanDim
 try:
     import iexcode.instruments.cfg as iex
@@ -550,6 +550,7 @@ def fit_mda(scanNum,detNum,fit_type,**kwargs):
         coefs_0=[Amplitude,x0,sigma,bkgd] to specifiy initial guesses, otherwise autoguess
         path: to load data in a different path
         prefix: to load data with a different prefix
+        cache: True/False reuses the loaded data and previous fits (default=False), see FitCache
 
     """
     kwargs.setdefault('hkl_positioner',False)
@@ -557,15 +558,22 @@ def fit_mda(scanNum,detNum,fit_type,**kwargs):
     kwargs.setdefault('plot',True)
     kwargs.setdefault('path',None)
     kwargs.setdefault('prefix',None)
+    kwargs.setdefault('cache',False)
     title=kwargs['title']
 
-
     if kwargs['hkl_positioner']:
         hkl_positioner=kwargs['hkl_positioner']
         d={'h':46,'k':47,'l':48,'tth':54,'th':55,'chi':56,'phi':57}
-        x,y,x_name,y_name=mda_1D_vsDet(scanNum,detNum,d[hkl_positioner.lower()],1,0,kwargs['path'],kwargs['prefix'])
+        loader = lambda: mda_1D_vsDet(scanNum,detNum,d[hkl_positioner.lower()],1,0,kwargs['path'],kwargs['prefix'])
+    else:
+        loader = lambda: mda_1D(scanNum,detNum,1,0,kwargs['path'],kwargs['prefix'])
+    
+    mtime = _mda_mtime(scanNum,kwargs['path'],kwargs['prefix']) if kwargs['cache'] else None
+    if mtime is not None:
+        key = ('mda_1D',scanNum,detNum,kwargs['hkl_positioner'],kwargs['path'],kwargs['prefix'],mtime)
+        x,y,x_name,y_name = fit_cache.load(key,loader)
     else:
-        x,y,x_name,y_name=mda_1D(scanNum,detNum,1,0,kwargs['path'],kwargs['prefix'])
+        x,y,x_name,y_name = loader()
     
     
     try:
@@ -584,7 +592,12 @@ def fit_mda(scanNum,detNum,fit_type,**kwargs):
         plt.grid(color='lightgray', linestyle='-', linewidth=0.5)
         plt.ticklabel_format(style='sci', axis='y', scilimits=(0,0))
 
-    if fit_type == 'gauss':
+    fit_types = {'gauss':'gaussian','lorz':'lorentzian','erf':'step','box':'box','poly':'poly'}
+    if kwargs['cache'] and fit_type in fit_types:
+        fit_kwargs = {key:val for key,val in kwargs.items() if key not in ['hkl_positioner','path','prefix','cache']}
+        x_fit,y_fit,coefs,covar,fit_vals = fit_cache.fit(x,y,fit_types[fit_type],**fit_kwargs)
+
+    elif fit_type == 'gauss':
         x_fit,y_fit,coefs,covar,fit_vals = fit_gaussian(x,y,**kwargs)
         
     elif fit_type == 'lorz':
@@ -606,6 +619,20 @@ def fit_mda(scanNum,detNum,fit_type,**kwargs):
     return fit_vals['center']
 
 
+def _mda_mtime(scanNum,path=None,prefix=None):
+    """
+    returns the modification time of the mda file or None if the file can't be found
+    """
+    try:
+        if path is None:
+            path = mda_filepath()
+        if prefix is None:
+            prefix = mda_prefix()
+        return getmtime(join(path,prefix+'{:04}.mda'.format(scanNum)))
+    except:
+        return None
+
+
 def fit_centroid(scanNum,detNum=25):
     fit_mda(scanNum,detNum,'poly',plot=False)
 
@@ -21,6 +21,54 @@ def find_closest(x, x_val):
     value = x[index]
     return index, value
 
+def rebin_array(a, factors):
+    """
+    block mean of a, ignoring NaNs (a block of only NaNs is NaN)
+        a = np.array
+        factors = int or list of ints, one per axis, the trailing points that do not fill a block are dropped
+    
+    Usage:
+        img_small = rebin_array(img,(4,4)); 4x4 binned image
+    """
+    a = np.asarray(a)
+    factors = [int(factors)]*a.ndim if np.ndim(factors) == 0 else [int(f) for f in factors]
+    trim = tuple(slice(0,(n//f)*f) for n,f in zip(a.shape,factors))
+    shape = []
+    for n,f in zip(a.shape,factors):
+        shape += [n//f,f]
+    block_axes = tuple(range(1,2*a.ndim,2))
+    blocks = a[trim].reshape(shape)
+    if not np.issubdtype(blocks.dtype,np.floating) or not np.isnan(blocks).any():
+        return blocks.mean(axis=block_axes)
+    valid = ~np.isnan(blocks)
+    total = np.where(valid,blocks,0).sum(axis=block_axes)
+    count = valid.sum(axis=block_axes)
+    return np.divide(total,count,out=np.full(total.shape,np.nan),where=count>0)
+
+def downsample_factors(shape, max_shape):
+    """
+    returns the smallest integer rebin factors so that shape fits in max_shape
+    """
+    return [max(int(np.ceil(n/m)),1) if m else 1 for n,m in zip(shape,max_shape)]
+
+#largest image (rows, columns) drawn by plot_2D, plot_dimage and plot_3D before it is downsampled
+MAX_SHAPE = (1000,1000)
+
+def downsample_image(img, scales, max_shape):
+    """
+    rebins an image for display when it is larger than max_shape
+        img = 2D numpy array (y,x)
+        scales = [yscale,xscale]
+        max_shape = (rows, columns), i.e. MAX_SHAPE
+    returns img, scales (unchanged if it already fits)
+    """
+    factors = downsample_factors(np.shape(img), max_shape)
+    if max(factors) == 1:
+        return img, scales
+    img = rebin_array(img, factors)
+    scales = [rebin_array(scale, f) for scale,f in zip(scales,factors)]
+    return img, scales
+
 ########################################################################    
 """ useful plotting routines """
 ########################################################################
@@ -104,12 +152,17 @@ def plot_2D(img,scales,units,ax=None,**kwargs):
     
     ax = axis for subplots otherwise plt.gca
     cbar = True/False add colorbar
+    downsample = True (default) the image is block averaged down to max_shape
+                (see downsample_image), False to plot every pixel
+    max_shape = (rows, columns) for downsample (default: MAX_SHAPE), independent of the figure size and dpi
     
     **kwargs = pcolormesh keywords
         kwargs.setdefault('shading','auto')
         
     """
     kwargs.setdefault('shading','auto')
+    downsample = kwargs.pop('downsample',True)
+    max_shape = kwargs.pop('max_shape',MAX_SHAPE)
     
 
     yscale,xscale = scales
@@ -122,6 +175,8 @@ def plot_2D(img,scales,units,ax=None,**kwargs):
         if ax == None:
             ax = plt.gca()
 
+        if downsample:
+            img,(yscale,xscale) = downsample_image(img,[yscale,xscale],max_shape)
         im1 = ax.pcolormesh(xscale, yscale, img, **kwargs)
         ax.set_xlabel(xunit)
         ax.set_ylabel(yunit)
@@ -148,6 +203,14 @@ def reduce2d(x,y, **kwargs):
         del kwargs['column']
     return x,y,kwargs
 
+def _pcolormesh(ax,img,yscale,xscale,max_shape,pltkwargs):
+    """
+    pcolormesh of img on ax, downsampled to max_shape unless max_shape = None
+    """
+    if max_shape is not None:
+        img,(yscale,xscale) = downsample_image(img,[yscale,xscale],max_shape)
+    return ax.pcolormesh(xscale, yscale, img, **pltkwargs)
+
 def plot_dimage(dataArray,scaleArray,unitArray, **kwargs):
     """
     dataArray is a 3D np.array(data[y][x]) => images are row by column data
@@ -161,6 +224,9 @@ def plot_dimage(dataArray,scaleArray,unitArray, **kwargs):
         yCen = cursor y value (default: np.nan => puts in the middle)
         yWidthPix = number of pixels to bin in y
         cmap = colormap ('BuPu'=default)
+        downsample = True (default) the displayed image is block averaged down to max_shape, 
+                    profiles use the full data
+        max_shape = (rows, columns) for downsample (default: MAX_SHAPE)
 
     returns a dictionary of the images and profiles where
         dictionary={'images':(image,imageH,imageV),'profiles':(profileH,profileV,profileD),'scales':scales}
@@ -179,10 +245,13 @@ def plot_dimage(dataArray,scaleArray,unitArray, **kwargs):
     kwargs.setdefault('cmap','BuPu')
     kwargs.setdefault('shading','auto')
     kwargs.setdefault('debug',False)
+    kwargs.setdefault('downsample',True)
+    kwargs.setdefault('max_shape',MAX_SHAPE)
        
-    datakwargs=['ax','xCen','xWidthPix','yCen','yWidthPix','debug','dim2']
+    datakwargs=['ax','xCen','xWidthPix','yCen','yWidthPix','debug','dim2','downsample','max_shape']
     pltkeys=[key for key in kwargs if key not in datakwargs]
     pltkwargs={key:kwargs[key] for key in pltkeys}
+    max_shape = kwargs['max_shape'] if kwargs['downsample'] else None
    
     yScale,xScale = scaleArray
     yUnit,xUnit = unitArray
@@ -234,8 +303,7 @@ def plot_dimage(dataArray,scaleArray,unitArray, **kwargs):
     #cursors=False
     #plotting main image
     ax1 = fig.add_subplot(gs[1:, :-1])
-    scaleMesh = np.meshgrid(scales[1], scales[0])
-    im1 = ax1.pcolormesh(scaleMesh[0], scaleMesh[1],image,**pltkwargs)
+    im1 = _pcolormesh(ax1,image,scales[0],scales[1],max_shape,pltkwargs)
     ax1.set_xlabel(units[1]) 
     ax1.set_ylabel(units[0])  
     if cursors:
@@ -295,6 +363,9 @@ def plot_3D(dataArray,scaleArray,unitArray, **kwargs):
         zCen = cursor y value (default: np.nan => puts in the middle)
         zWidthPix = number of pixels to bin in y
         cmap = colormap ('BuPu'=default)
+        downsample = True (default) the displayed images are block averaged down to max_shape, 
+                    profiles use the full data
+        max_shape = (rows, columns) for downsample (default: MAX_SHAPE)
 
     returns a dictionary of the images and profiles where
         dictionary={'images':(image,imageH,imageV),'profiles':(profileH,profileV,profileD),'scales':scales}
@@ -318,10 +389,13 @@ def plot_3D(dataArray,scaleArray,unitArray, **kwargs):
     kwargs.setdefault('cmap','BuPu')
     kwargs.setdefault('shading','auto')
     kwargs.setdefault('debug',False)
+    kwargs.setdefault('downsample',True)
+    kwargs.setdefault('max_shape',MAX_SHAPE)
        
-    datakwargs=['ax','xCen','xWidthPix','yCen','yWidthPix','zCen','zWidthPix','debug','dim3','dim2']
+    datakwargs=['ax','xCen','xWidthPix','yCen','yWidthPix','zCen','zWidthPix','debug','dim3','dim2','downsample','max_shape']
     pltkeys=[key for key in kwargs if key not in datakwargs]
     pltkwargs={key:kwargs[key] for key in pltkeys}
+    max_shape = kwargs['max_shape'] if kwargs['downsample'] else None
    
     yScale,xScale,zScale = scaleArray
     yUnit,xUnit,zUnit = unitArray
@@ -408,8 +482,7 @@ def plot_3D(dataArray,scaleArray,unitArray, **kwargs):
     #cursors=False
     #plotting main image
     ax1 = fig.add_subplot(gs[2:4, 0:2])
-    scaleMesh = np.meshgrid(scales[1], scales[0])
-    im1 = ax1.pcolormesh(scaleMesh[0], scaleMesh[1],image,**pltkwargs)
+    im1 = _pcolormesh(ax1,image,scales[0],scales[1],max_shape,pltkwargs)
     ax1.set_xlabel(units[1]) 
     ax1.set_ylabel(units[0])  
     if cursors:
@@ -428,8 +501,7 @@ def plot_3D(dataArray,scaleArray,unitArray, **kwargs):
     if plot:
         #plotting imageV
         ax4 = fig.add_subplot(gs[2:4, 2:3])
-        scaleMesh = np.meshgrid(scales[2], scales[0])
-        im4 = ax4.pcolormesh(scaleMesh[0], scaleMesh[1], imageV,**pltkwargs)        
+        im4 = _pcolormesh(ax4,imageV,scales[0],scales[2],max_shape,pltkwargs)
         ax4.set_xlabel(units[2]) 
         ax4.set_ylabel(units[0]) 
         ax4.yaxis.set_visible(False)
@@ -449,8 +521,7 @@ def plot_3D(dataArray,scaleArray,unitArray, **kwargs):
     if plot:
         #plotting imageH
         ax5 = fig.add_subplot(gs[1:2, 0:2])
-        scaleMesh = np.meshgrid(scales[1], scales[2]) 
-        im5 = ax5.pcolormesh(scaleMesh[0], scaleMesh[1], np.transpose(imageH),**pltkwargs)
+        im5 = _pcolormesh(ax5,np.transpose(imageH),scales[2],scales[1],max_shape,pltkwargs)
         ax5.set_xlabel(units[1]) 
         ax5.set_ylabel(units[2]) 
         ax5.xaxis.set_visible(False)
@@ -5,7 +5,7 @@ import math
 import numpy as np
 import matplotlib.pyplot as plt
 import ast
-from scipy import interpolate
+from scipy import interpolate, ndimage
 
 #==============================================================================
 # Global variables in science
@@ -80,9 +80,11 @@ def k_to_thetaY(KE, kx, ky):
 
 def k_to_kz(kx, ky, KE, V0):
     """
+    free electron final state
+    kz = sqrt(c**2*(KE + V0) - (kx**2 + ky**2))
     """
     c = np.sqrt(2*me)/hbar
-    kz2 = c**2*(KE - V0) - (kx**2 +ky**2)
+    kz2 = c**2*(KE + V0) - (kx**2 +ky**2)
     return np.sqrt(kz2)
     
 
@@ -96,7 +98,54 @@ def BE_to_KE(BE, hv, wk, E_offset=0):
     KE = (hv+E_offset) - wk - BE 
     return KE
     
-def ARPES_angle_k(k_new,img,KE_scale,angle_scale,polar_angle,KE_offset,slit='V'):
+def ARPES_angle_k_coords(k_new,KE_scale,angle_scale,polar_angle,KE_offset,slit='V'):
+    """
+    returns the pixel coordinates in the original image for every point of the k-image, 
+    for use with scipy.ndimage.map_coordinates (see ARPES_angle_k)
+
+    k_new = interpolated k scaling (slitV => ky, slitH => kx)
+    KE_scale = Kinetic energy scaling for img
+    angle scale = of image (slitV => thetaY, slitH => thetaX), needs to be monotonic
+    polar_angle =  polar angle of manipulator (for slitH then added to detector angle)
+    KE_offset = to adjust for Fermi level drift (can be float, or np.array of the same length as the KE_scale )
+    slit = slit direction: 'V' or 'H'
+
+    coords only depend on the scaling, so they can be reused for all images with the same KE/angle scales
+        slitV => coords.shape = (2,len(k_new),len(KE_scale))
+        slitH => coords.shape = (2,len(KE_scale),len(k_new))
+    points outside of the original image are set to -1 (i.e. filled with nan by map_coordinates)
+    """
+    k_new = np.asarray(k_new,dtype=float)
+    KE = np.asarray(KE_scale,dtype=float) + KE_offset
+    angle_scale = np.asarray(angle_scale,dtype=float)
+    c = np.sqrt(2*me)/hbar
+
+    #inverting k => angle for the whole image at once (k_new along the rows, KE along the columns)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        if slit == 'H':
+            angle = np.arcsin(k_new[:,np.newaxis]/(c*np.sqrt(KE)))*180/np.pi - polar_angle
+        elif slit == 'V':
+            angle = np.arcsin(k_new[:,np.newaxis]/(c*np.sqrt(KE)*np.cos(polar_angle*np.pi/180.)))*180/np.pi
+        else:
+            print('slit needs to be "H" or "V"')
+            return 
+
+    #converting angle to fractional pixel
+    pix = np.arange(angle_scale.shape[0],dtype=float)
+    if angle_scale[0] > angle_scale[-1]:
+        angle_pix = np.interp(angle,angle_scale[::-1],pix[::-1],left=-1,right=-1)
+    else:
+        angle_pix = np.interp(angle,angle_scale,pix,left=-1,right=-1)
+    angle_pix[np.isnan(angle)] = -1
+    KE_pix = np.broadcast_to(np.arange(KE.shape[0],dtype=float),angle_pix.shape)
+
+    if slit == 'H':
+        coords = np.stack((KE_pix.T,angle_pix.T))
+    elif slit == 'V':
+        coords = np.stack((angle_pix,KE_pix))
+    return coords
+
+def ARPES_angle_k(k_new,img,KE_scale,angle_scale,polar_angle,KE_offset,slit='V',coords=None):
     """
     k_new = interpolated k scaling (slitV => ky, slitH => kx)
     
@@ -107,29 +156,16 @@ def ARPES_angle_k(k_new,img,KE_scale,angle_scale,polar_angle,KE_offset,slit='V')
     polar_angle =  polar angle of manipulator (for slitH then added to detector angle)
     KE_offset = to adjust for Fermi level drift (can be float, or np.array of the same length as the image )
     slit = slit direction: 'V' or 'H'
+    coords = precomputed coordinates from ARPES_angle_k_coords (default: None => calculated)
+             pass the same coords to convert a series of images with the same scaling
     
     Currently only works for E_new = KE_scale
     """
-    img_new = np.empty((angle_scale.shape[0],KE_scale.shape[0]))
-    
-    for j,KE in enumerate(KE_scale):
-        
-        if slit == 'H':
-            y = img[j,:] #Intensity vs ThetaX
-            x = theta_to_kx(KE+KE_offset,polar_angle+angle_scale)
-        elif slit == 'V':
-            y = img[:,j] #Intensity vs ThetaY
-            x = theta_to_ky(KE+KE_offset,polar_angle,angle_scale) #converting thetaY to ky units
-        else:
-            print('slit needs to be "H" or "V"')
-            return 
-        
-        f = interpolate.interp1d(x,y,bounds_error=False, fill_value=np.nan)
-        x_new = k_new
-        y_new = f(x_new)
-        if slit == 'H':
-            img_new[j,:] = y_new
-        elif slit == 'V':    
-            img_new[:,j] = y_new
+    if coords is None:
+        coords = ARPES_angle_k_coords(k_new,KE_scale,angle_scale,polar_angle,KE_offset,slit)
+        if coords is None:
+            return
+
+    img_new = ndimage.map_coordinates(np.asarray(img,dtype=float),coords,order=1,mode='constant',cval=np.nan)
         
-    return img_new
\ No newline at end of file
+    return img_new
@@ -5,5 +5,6 @@ from .pynData_imgProc import *
 from .pynData_plot import *
 from .pynData_fitting import *
 from .pynData import *
+from .pynData_chunked import *
 
 
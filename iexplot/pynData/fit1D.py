@@ -25,11 +25,13 @@ import glob
 import h5py
 import time
 import itertools
+from concurrent.futures import ProcessPoolExecutor
 
 # importing the workhorse
 import numpy as np
 import pandas as pd
 from scipy import io, signal, interpolate, ndimage
+from scipy.special import expit
 
 # tiff packages
 import tifffile
@@ -82,16 +84,30 @@ def _lim_to_bounds(x, ROI):
     return idmin, idmax
 
 
+def _params_jac(params, derivs):
+    '''
+    Internal method to build the Jacobian for lmfit (Dfun) from a dictionary 
+    of partial derivatives, one column per varying parameter
+    '''
+    names = [key for key in params.keys() if params[key].vary]
+    return np.stack([np.ravel(derivs[key]) for key in names], axis=1)
+
+
 #==============================================================================
 # General fitting methods
 #==============================================================================
-def do_fit(x, y, model_func, guess_func, params=[], ROI=[], verbose=False, plotFit=False):
+def do_fit(x, y, model_func, guess_func, params=[], ROI=[], verbose=False, plotFit=False, jac_func=None):
     '''
     General fit func
     
     One could choose to put the initial guess by hand, or to use
     the automatic guess
+    
+    jac_func:       Analytic Jacobian (lmfit Dfun), by default the one 
+                    in model_jacobians for model_func if it exists
     '''
+    if jac_func is None:
+        jac_func = model_jacobians.get(model_func)
     if not ROI==[]:
         idmin, idmax = _lim_to_bounds(x, ROI)
         tx = x[idmin:idmax]
@@ -108,7 +124,7 @@ def do_fit(x, y, model_func, guess_func, params=[], ROI=[], verbose=False, plotF
     # minner = Minimizer(model_func, param, fcn_args=(x, y), fcn_kws={'ROI':ROI})
     
     minner = lmfit.Minimizer(model_func, params, fcn_args=(tx, ty))
-    result = minner.minimize()
+    result = minner.minimize(Dfun=jac_func)
     
     misfit = result.residual*(-1)
     # fitted = ty + result.residual
@@ -116,10 +132,9 @@ def do_fit(x, y, model_func, guess_func, params=[], ROI=[], verbose=False, plotF
     chisqr = result.redchi
     
     # Getting all parameters
-    fit_params = pd.DataFrame(index=params.keys(), columns=['value', 'err']).astype(float)
-    for key in params.keys():
-        fit_params['value'].loc[key] = result.params[key].value
-        fit_params['err'].loc[key] = result.params[key].stderr
+    fit_params = pd.DataFrame({'value':[result.params[key].value for key in params.keys()], 
+                               'err':[result.params[key].stderr for key in params.keys()]}, 
+                              index=list(params.keys()), dtype=float)
 
     if verbose:
         lmfit.report_fit(result)
@@ -147,7 +162,48 @@ def fitted_to_params(fit_params):
     return params
 
 
-def batch_fit(x, y, img, fit_ax, model_func, guess_func, params=[], ROI=[], mode='sequential', plotFit=False):
+def _fit_profiles(x, profiles, model_func, guess_func, params=[], mode='sequential'):
+    '''
+    Fits each row of profiles and returns the parameter names and
+    preallocated arrays with the values, errors and reduced chi-square
+    
+    x:              1D array
+    profiles:       2D array, one profile per row
+    mode:           'sequential' - the fitted params (including bounds) of each fit are the guess for the next
+                    'independent' - each fit starts from params (or guess_func if params==[])
+    '''
+    n = profiles.shape[0]
+    keys, vals, errs, chisqrs = None, None, None, np.full(n, np.nan)
+    jac_func = model_jacobians.get(model_func)
+    guess = params
+    for i in range(n):
+        if guess==[]:
+            guess = guess_func(x, profiles[i])
+        minner = lmfit.Minimizer(model_func, guess, fcn_args=(x, profiles[i]))
+        result = minner.minimize(Dfun=jac_func)
+        if keys is None:
+            keys = list(result.params.keys())
+            vals = np.full((n, len(keys)), np.nan)
+            errs = np.full((n, len(keys)), np.nan)
+        for j, key in enumerate(keys):
+            vals[i, j] = result.params[key].value
+            if result.params[key].stderr is not None:
+                errs[i, j] = result.params[key].stderr
+        chisqrs[i] = result.redchi
+        # Doing minner.minimize() will not change the input params
+        guess = result.params if mode=='sequential' else params
+    
+    return keys, vals, errs, chisqrs
+
+
+def _fit_profiles_chunk(args):
+    '''
+    Process pool worker for batch_fit
+    '''
+    return _fit_profiles(*args)
+
+
+def batch_fit(x, y, img, fit_ax, model_func, guess_func, params=[], ROI=[], mode='sequential', plotFit=False, nprocs=None):
     '''
     Batch fit to Fermi func with linear BG
     
@@ -158,7 +214,10 @@ def batch_fit(x, y, img, fit_ax, model_func, guess_func, params=[], ROI=[], mode
     ROI:            A list in the format [xmin, xmax, ymin, ymax]
     mode:           There are two modes:
                     1) 'sequential' - the results from the 1st fit goes to the 2nd, etc.
-                    2) 'independent' - each param is ...
+                    2) 'independent' - each profile starts from params (or its own guess),
+                       the profiles are split over nprocs processes
+    nprocs:         Number of processes for mode='independent' (default = os.cpu_count())
+                    model_func and guess_func need to be defined at the module level
     '''
     if not ROI==[]:
         xidmin, xidmax = _lim_to_bounds(x, ROI[:2])
@@ -175,53 +234,29 @@ def batch_fit(x, y, img, fit_ax, model_func, guess_func, params=[], ROI=[], mode
         timg = img
     
     if fit_ax=='x': # Fit along horizontal
-        fit_params, _, _, _, _, chisqr = do_fit(tx, timg[0], model_func, guess_func, 
-                                                params=params, verbose=False, plotFit=False)
-        fit_vals = fit_params['value']
-        fit_errs = fit_params['err']
-        fit_chisqrs = [chisqr]
-        for i in range(1, timg.shape[0]):
-            if mode=='sequential':
-                newguess = fitted_to_params(fit_params)
-            else:
-                # Doing minner.minimize() will not change the input params
-                newguess = params
-            fit_params, _, _, _, _, chisqr = do_fit(tx, timg[i], model_func, guess_func, 
-                                                params=newguess, verbose=False, plotFit=False)
-            fit_vals = pd.concat((fit_vals, fit_params['value']), axis=1)
-            fit_errs = pd.concat((fit_errs, fit_params['err']), axis=1)
-            fit_chisqrs += [chisqr]
-            
-        fit_vals.columns = ty
-        fit_vals = fit_vals.swapaxes('index', 'columns')
-        fit_errs.columns = ty
-        fit_errs = fit_errs.swapaxes('index', 'columns')
-        fit_chisqrs = pd.Series(data=fit_chisqrs, index=ty)
+        fx, index, profiles = tx, ty, timg
     elif fit_ax=='y': # Fit along vertical
-        
-        
-        fit_params, _, _, _, _, chisqr = do_fit(ty, timg[:, 0], model_func, guess_func, 
-                                                params=params, verbose=False, plotFit=False)
-        fit_vals = fit_params['value']
-        fit_errs = fit_params['err']
-        fit_chisqrs = [chisqr]
-        for i in range(1, timg.shape[1]):
-            if mode=='sequential':
-                newguess = fitted_to_params(fit_params)
-            else:
-                # Doing minner.minimize() will not change the input params
-                newguess = params
-            fit_params, _, _, _, _, chisqr = do_fit(ty, timg[:, i], model_func, guess_func, 
-                                                params=newguess, verbose=False, plotFit=False)
-            fit_vals = pd.concat((fit_vals, fit_params['value']), axis=1)
-            fit_errs = pd.concat((fit_errs, fit_params['err']), axis=1)
-            fit_chisqrs += [chisqr]
-            
-        fit_vals.columns = tx
-        fit_vals.swapaxes('index', 'columns')
-        fit_errs.columns = tx
-        fit_errs.swapaxes('index', 'columns')
-        fit_chisqrs = pd.Series(data=fit_chisqrs, index=tx)
+        fx, index, profiles = ty, tx, timg.T
+    
+    if nprocs is None:
+        nprocs = os.cpu_count()
+    nprocs = max(min(nprocs, profiles.shape[0]), 1)
+    
+    if mode=='independent' and nprocs>1:
+        chunks = np.array_split(np.arange(profiles.shape[0]), nprocs)
+        args = [(fx, profiles[c], model_func, guess_func, params, mode) for c in chunks]
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            results = list(pool.map(_fit_profiles_chunk, args))
+        keys = results[0][0]
+        vals = np.concatenate([r[1] for r in results])
+        errs = np.concatenate([r[2] for r in results])
+        chisqrs = np.concatenate([r[3] for r in results])
+    else:
+        keys, vals, errs, chisqrs = _fit_profiles(fx, profiles, model_func, guess_func, params, mode)
+    
+    fit_vals = pd.DataFrame(vals, index=index, columns=keys)
+    fit_errs = pd.DataFrame(errs, index=index, columns=keys)
+    fit_chisqrs = pd.Series(data=chisqrs, index=index)
         
     if plotFit:
         pNum = fit_vals.shape[1]+1
@@ -258,6 +293,26 @@ def FermiLinearBG(params, x, y):
     return model-y
 
 
+def FermiLinearBG_jac(params, x, y):
+    '''
+    Analytic Jacobian of FermiLinearBG (lmfit Dfun)
+    '''
+    Ef = params['Ef'].value
+    T = params['T'].value
+    A = params['Slope'].value
+    B = params['Intercept'].value
+    
+    f = expit(-(x-Ef)/kB/T)
+    df = f*(1-f)
+    derivs = {'Ef':A*(x-B)*df/kB/T,
+              'T':A*(x-B)*df*(x-Ef)/kB/T**2,
+              'Slope':(x-B)*f,
+              'Intercept':-A*f,
+              'Offset':np.ones_like(f),
+             }
+    return _params_jac(params, derivs)
+
+
 def guess_FermiLinearBG(x, y):
     '''
     Making initial guess
@@ -286,3 +341,7 @@ def guess_FermiLinearBG(x, y):
     return params
 
 
+# Analytic Jacobians used by do_fit and batch_fit
+model_jacobians = {
+    FermiLinearBG:FermiLinearBG_jac,
+}
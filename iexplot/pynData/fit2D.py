@@ -35,6 +35,7 @@ import glob
 import h5py
 import time
 import itertools
+from concurrent.futures import ProcessPoolExecutor
 
 # importing the workhorse
 import numpy as np
@@ -85,7 +86,7 @@ def _lim_to_bounds(x, ROI):
 # General fitting methods
 #==============================================================================
 
-def do_fit2D(x, y, z, model_func, guess_func, params=[], ROI=[], verbose=False, plotFit=False):
+def do_fit2D(x, y, z, model_func, guess_func, params=[], ROI=[], verbose=False, plotFit=False, jac_func=None):
     '''
     General 2D fit func
     
@@ -95,7 +96,11 @@ def do_fit2D(x, y, z, model_func, guess_func, params=[], ROI=[], verbose=False,
     x: 1D
     y: 1D
     z: 2D
+    jac_func: Analytic Jacobian (lmfit Dfun), by default the one 
+              in model_jacobians2D for model_func if it exists
     '''
+    if jac_func is None:
+        jac_func = model_jacobians2D.get(model_func)
     if not ROI==[]:
         xidmin, xidmax = _lim_to_bounds(x, [ROI[0], ROI[1]])
         yidmin, yidmax = _lim_to_bounds(y, [ROI[2], ROI[3]])
@@ -111,7 +116,7 @@ def do_fit2D(x, y, z, model_func, guess_func, params=[], ROI=[], verbose=False,
         params = guess_func(tx, ty, tz)
         
     minner = Minimizer(model_func, params, fcn_args=(tx, ty, tz))
-    result = minner.minimize()
+    result = minner.minimize(Dfun=jac_func)
     
     misfit = result.residual.reshape(tz.shape)*(-1)
     # fitted = tz + result.residual.reshape(tz.shape)
@@ -119,10 +124,9 @@ def do_fit2D(x, y, z, model_func, guess_func, params=[], ROI=[], verbose=False,
     chisqr = result.redchi
     
     # Getting all parameters
-    fit_params = pd.DataFrame(index=params.keys(), columns=['value', 'err']).astype(float)
-    for key in params.keys():
-        fit_params['value'].loc[key] = result.params[key].value
-        fit_params['err'].loc[key] = result.params[key].stderr
+    fit_params = pd.DataFrame({'value':[result.params[key].value for key in params.keys()], 
+                               'err':[result.params[key].stderr for key in params.keys()]}, 
+                              index=list(params.keys()), dtype=float)
 
     if verbose:
         report_fit(result)
@@ -179,6 +183,136 @@ def fitted_to_params2D(fit_params):
     return params
 
 
+def _fit_frames(x, y, frames, model_func, guess_func, params=[], ROI_size=[]):
+    '''
+    Fits each frame in order, seeding each fit with the result of the previous one
+    
+    x:              1D
+    y:              1D
+    frames:         3D, [frame, y, x]
+    ROI_size:       [half width x, half width y] in pixels of the ROI around the
+                    tracked center (cen_x, cen_y), the full frame is fit if ROI_size==[]
+    Returns the parameter names and arrays with the values, errors and reduced chi-square
+    '''
+    n = frames.shape[0]
+    keys, vals, errs, chisqrs = None, None, None, np.full(n, np.nan)
+    jac_func = model_jacobians2D.get(model_func)
+    guess = params
+    for i in range(n):
+        z = frames[i]
+        if ROI_size==[]:
+            tx, ty, tz = x, y, z
+        else:
+            if guess==[]:
+                iy, ix = np.unravel_index(np.nanargmax(z), z.shape)
+            else:
+                ix = _val_to_idx(x, guess['cen_x'].value)
+                iy = _val_to_idx(y, guess['cen_y'].value)
+            xidmin, xidmax = max(ix-ROI_size[0], 0), min(ix+ROI_size[0]+1, len(x))
+            yidmin, yidmax = max(iy-ROI_size[1], 0), min(iy+ROI_size[1]+1, len(y))
+            tx = x[xidmin:xidmax]
+            ty = y[yidmin:yidmax]
+            tz = z[yidmin:yidmax, xidmin:xidmax]
+        
+        try:
+            p = guess_func(tx, ty, tz) if guess==[] else guess
+            result = Minimizer(model_func, p, fcn_args=(tx, ty, tz)).minimize(Dfun=jac_func)
+        except (IndexError, ValueError):
+            # Bad frame (e.g. the peak left the ROI), keep the previous seed
+            continue
+        
+        if keys is None:
+            keys = list(result.params.keys())
+            vals = np.full((n, len(keys)), np.nan)
+            errs = np.full((n, len(keys)), np.nan)
+        for j, key in enumerate(keys):
+            vals[i, j] = result.params[key].value
+            if result.params[key].stderr is not None:
+                errs[i, j] = result.params[key].stderr
+        chisqrs[i] = result.redchi
+        guess = result.params
+    
+    return keys, vals, errs, chisqrs
+
+
+def _fit_frames_chunk(args):
+    '''
+    Process pool worker for batch_fit2D
+    '''
+    return _fit_frames(*args)
+
+
+def batch_fit2D(x, y, stack, model_func, guess_func, params=[], ROI_size=[], nprocs=None, plotFit=False):
+    '''
+    Fits a peak (e.g. Gauss2D or Lor2D) on every frame of an image stack
+    (AD tiff stack, 3D mda map ...)
+    
+    x:              1D
+    y:              1D
+    stack:          3D, [frame, y, x]
+    params:         Initial guess for the first frame, otherwise guess_func
+    ROI_size:       [half width x, half width y] in pixels, each frame is cropped 
+                    around the center found in the previous frame
+    nprocs:         Number of processes (default = os.cpu_count()), the frames are split 
+                    into consecutive chunks, each chunk is tracked from its first frame
+    
+    Returns fit_vals, fit_errs, fit_chisqrs 
+    fit_vals and fit_errs are dictionaries with an array (frame) for each parameter 
+    (e.g. fit_vals['cen_x'], fit_vals['sigma_x'])
+    '''
+    stack = np.asarray(stack)
+    if nprocs is None:
+        nprocs = os.cpu_count()
+    nprocs = max(min(nprocs, stack.shape[0]), 1)
+    
+    chunks = np.array_split(np.arange(stack.shape[0]), nprocs)
+    args = [(x, y, stack[c], model_func, guess_func, params, ROI_size) for c in chunks]
+    if nprocs>1:
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            results = list(pool.map(_fit_frames_chunk, args))
+    else:
+        results = [_fit_frames(*args[0])]
+    
+    keys = next((r[0] for r in results if r[0] is not None), None)
+    if keys is None:
+        print('No frame could be fit')
+        return
+    vals, errs = [], []
+    for r, c in zip(results, chunks):
+        vals.append(r[1] if r[0] is not None else np.full((len(c), len(keys)), np.nan))
+        errs.append(r[2] if r[0] is not None else np.full((len(c), len(keys)), np.nan))
+    vals = np.concatenate(vals)
+    errs = np.concatenate(errs)
+    fit_chisqrs = np.concatenate([r[3] for r in results])
+    fit_vals = {key:vals[:, j] for j, key in enumerate(keys)}
+    fit_errs = {key:errs[:, j] for j, key in enumerate(keys)}
+    
+    if plotFit:
+        pNum = len(keys)+1
+        color=iter(cm.rainbow(np.linspace(0,1,pNum)))
+        fig, frame_ax = plt.subplots(pNum, 1, sharex=True, figsize=(5, 1.5*pNum))
+        for j, key in enumerate(keys):
+            frame_ax[j].errorbar(np.arange(len(fit_chisqrs)), fit_vals[key], yerr=fit_errs[key], 
+                                 color=next(color), marker='.')
+            frame_ax[j].set_ylabel(key)
+            
+        frame_ax[pNum-1].plot(fit_chisqrs, color=next(color), marker='.')
+        frame_ax[pNum-1].set_ylabel('chisq')
+        frame_ax[pNum-1].set_xlabel('frame')
+    
+    return fit_vals, fit_errs, fit_chisqrs
+
+
+def _params_jac(params, derivs):
+    '''
+    Internal method to build the Jacobian for lmfit (Dfun) from a dictionary 
+    of partial derivatives (2D arrays are flattened like the residual), 
+    one column per varying parameter
+    '''
+    names = [key for key in params.keys() if params[key].vary]
+    return np.stack([np.ravel(derivs[key]) for key in names], axis=1)
+
+
 #==============================================================================
 # Anisotropic Gaussian
 #==============================================================================
@@ -210,6 +344,31 @@ def Gauss2D(params, x, y, z):
     return model-z
 
 
+def Gauss2D_jac(params, x, y, z):
+    '''
+    Analytic Jacobian of Gauss2D (lmfit Dfun)
+    '''
+    A = params['Area'].value
+    sx = params['sigma_x'].value
+    sy = params['sigma_y'].value
+    xc = params['cen_x'].value
+    yc = params['cen_y'].value
+    
+    xx, yy = np.meshgrid(x, y)
+    
+    g = np.exp(-(xx-xc)**2/2/sx**2-(yy-yc)**2/2/sy**2)/(2*np.pi*sx*sy)
+    derivs = {'Area':g,
+              'sigma_x':A*g*((xx-xc)**2/sx**3-1/sx),
+              'sigma_y':A*g*((yy-yc)**2/sy**3-1/sy),
+              'cen_x':A*g*(xx-xc)/sx**2,
+              'cen_y':A*g*(yy-yc)/sy**2,
+              'BG_slope_x':xx,
+              'BG_slope_y':yy,
+              'BG_const':np.ones_like(g),
+             }
+    return _params_jac(params, derivs)
+
+
 def guess_Gauss2D(x, y, z):
     '''
     Making initial guess
@@ -233,7 +392,7 @@ def guess_Gauss2D(x, y, z):
     sx_left = np.argwhere(templeft<bg_c+height/2)[-1,0]
     tempright = temp[cen[1]:]
     sx_right = np.argwhere(tempright<bg_c+height/2)[0,0]
-    sx = np.abs((x[sx_right]-x[sx_left])/2.)
+    sx = np.abs((x[cen[1]+sx_right]-x[sx_left])/2.)
     
     temp = z[:, cen[1]]
     bg_y = (temp[-1]-temp[0])/(y[-1]-y[0])
@@ -241,7 +400,7 @@ def guess_Gauss2D(x, y, z):
     sy_left = np.argwhere(templeft<bg_c+height/2)[-1,0]
     tempright = temp[cen[0]:]
     sy_right = np.argwhere(tempright<bg_c+height/2)[0,0]
-    sy = np.abs((y[sy_right]-y[sy_left])/2.)
+    sy = np.abs((y[cen[0]+sy_right]-y[sy_left])/2.)
     
     # Guessing the area
     A = 2*np.pi*sx*sy*height
@@ -285,6 +444,31 @@ def Lor2D(params, x, y, z):
     return model-z
 
 
+def Lor2D_jac(params, x, y, z):
+    '''
+    Analytic Jacobian of Lor2D (lmfit Dfun)
+    '''
+    H = params['Height'].value
+    fwhm_x = params['FWHM_x'].value
+    fwhm_y = params['FWHM_y'].value
+    xc = params['cen_x'].value
+    yc = params['cen_y'].value
+    
+    xx, yy = np.meshgrid(x, y)
+    
+    L = 1/(((xx-xc)*2/fwhm_x)**2+((yy-yc)*2/fwhm_y)**2+1)
+    derivs = {'Height':L,
+              'FWHM_x':8*H*L**2*(xx-xc)**2/fwhm_x**3,
+              'FWHM_y':8*H*L**2*(yy-yc)**2/fwhm_y**3,
+              'cen_x':8*H*L**2*(xx-xc)/fwhm_x**2,
+              'cen_y':8*H*L**2*(yy-yc)/fwhm_y**2,
+              'BG_slope_x':xx,
+              'BG_slope_y':yy,
+              'BG_const':np.ones_like(L),
+             }
+    return _params_jac(params, derivs)
+
+
 def guess_Lor2D(x, y, z):
     '''
     Making initial guess
@@ -308,7 +492,7 @@ def guess_Lor2D(x, y, z):
     sx_left = np.argwhere(templeft<bg_c+height/2)[-1,0]
     tempright = temp[cen[1]:]
     sx_right = np.argwhere(tempright<bg_c+height/2)[0,0]
-    fwhm_x = np.abs(x[sx_right]-x[sx_left])
+    fwhm_x = np.abs(x[cen[1]+sx_right]-x[sx_left])
     
     temp = z[:, cen[1]]
     bg_y = (temp[-1]-temp[0])/(y[-1]-y[0])
@@ -316,7 +500,7 @@ def guess_Lor2D(x, y, z):
     sy_left = np.argwhere(templeft<bg_c+height/2)[-1,0]
     tempright = temp[cen[0]:]
     sy_right = np.argwhere(tempright<bg_c+height/2)[0,0]
-    fwhm_y = np.abs(y[sy_right]-y[sy_left])
+    fwhm_y = np.abs(y[cen[0]+sy_right]-y[sy_left])
     
     params = Parameters()
     params.add('Height', value=height)
@@ -330,3 +514,9 @@ def guess_Lor2D(x, y, z):
     
     return params
 
+
+# Analytic Jacobians used by do_fit2D and batch_fit2D
+model_jacobians2D = {
+    Gauss2D:Gauss2D_jac,
+    Lor2D:Lor2D_jac,
+}
@@ -220,13 +220,9 @@ class nEA(nARPES):
         metadata.update({'spectraInfo':spectraInfo})
         
         #Calculating EDC/MDC:
-        EDC = nData(np.nansum(EA.data[:,:], axis=0))
-        ax=list(EA.scale)[0]
-        EDC.updateAx('x',EA.scale[ax],EA.unit[ax])
+        EDC = EA.reduce('y')
         
-        MDC = nData(np.nansum(EA.data[:,:], axis=1))
-        ax=list(EA.scale)[1]
-        MDC.updateAx('x',EA.scale[ax],EA.unit[ax])
+        MDC = EA.reduce('x')
         
         
         setattr(EA,"scanNum",scanNum)
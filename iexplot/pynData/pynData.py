@@ -48,6 +48,8 @@ import matplotlib.pyplot as plt
 
 # importing system packages
 import os
+import weakref
+import warnings
 #import sys
 #import glob
 import h5py
@@ -60,8 +62,12 @@ import numpy as np
 #from scipy import io, signal, interpolate, ndimage
 #from math import floor
 
-from iexplot.utilities import take_closest_value
-from iexplot.plotting import find_closest
+from iexplot.plotting import find_closest, rebin_array, downsample_factors
+
+try:
+    import bottleneck as bn
+except ImportError:
+    bn = None
 
 
 #==============================================================================
@@ -229,111 +235,293 @@ class nData:
         h.close()
         return
     
+    def concat(self, others, axis='z', scale='data'):
+        """
+        returns a new nData with self and others joined along axis in a single copy
+        2D data appended along z are added as planes of a volume, 1D data are rows along x (y = 1)
+        
+        others = nData object or list of nData objects
+        axis = 'x'|'y'|'z' (default: 'z')
+        scale = 'data' (default) joins the scales along axis (point number for data without that axis)
+              = 'point' point number along axis
+        """
+        others = [others] if isinstance(others, nData) else list(others)
+        ds = [self]+others
+        rank = max(len(d.data.shape) for d in ds)
+        if axis == 'z':
+            rank = 3
+        if axis == 'y':
+            rank = max(rank, 2)
+        i = _ax_index(axis, rank)
+        
+        vols = [_promote(np.asarray(d.data), rank, i) for d in ds]
+        frame = vols[0].shape[:i]+vols[0].shape[i+1:]
+        for n,v in enumerate(vols):
+            if v.shape[:i]+v.shape[i+1:] != frame:
+                print("Data sets must be the same size except along "+axis+", item "+str(n)+" has shape "+str(np.shape(ds[n].data)))
+                return
+        
+        sizes = [v.shape[i] for v in vols]
+        shape = list(vols[0].shape)
+        shape[i] = sum(sizes)
+        vol = np.empty(shape, dtype=np.result_type(*vols))
+        k = 0
+        for v,n in zip(vols,sizes):
+            vol[(slice(None),)*i+(slice(k,k+n),)] = v
+            k += n
+        
+        nVol = nData(vol)
+        for ax in nVol.scale.keys():
+            if ax != axis and ax in self.scale:
+                nVol.updateAx(ax, self.scale[ax], self.unit[ax])
+        if scale == 'data':
+            k = 0
+            parts = []
+            for d,n in zip(ds,sizes):
+                parts.append(np.asarray(d.scale[axis]) if axis in d.scale and len(d.scale[axis]) == n else np.arange(k,k+n))
+                k += n
+            nVol.updateAx(axis, np.concatenate(parts), self.unit.get(axis,''))
+        nVol.updateExtras(dict(self.extras))
+        return nVol
+
+    def append(self, other, axis='z', scale_val=None):
+        """
+        appends other to self along axis in place (i.e. live acquisition)
+        the data is a view into a buffer that doubles when it is full, so appending is O(1) on average
+        
+        other = nData or np.array (a plane for appending to a volume along z)
+        scale_val = scale value(s) for the appended data, None => other.scale[axis] or the point number
+        """
+        data = other.data if isinstance(other, nData) else np.asarray(other)
+        rank = len(self.data.shape)
+        if rank == 1 and axis != 'x':
+            print("1D data can only be appended along x, use concat to join along "+axis)
+            return
+        i = _ax_index(axis, rank)
+        data = _promote(data, rank, i)
+        if data.shape[:i]+data.shape[i+1:] != self.data.shape[:i]+self.data.shape[i+1:]:
+            print("Data sets must be the same size except along "+axis)
+            return
+        n_old = self.data.shape[i]
+        n = data.shape[i]
+        if scale_val is None:
+            if isinstance(other, nData) and axis in other.scale and len(other.scale[axis]) == n:
+                scale_val = other.scale[axis]
+            else:
+                scale_val = np.arange(n_old, n_old+n)
+        
+        buf = _append_buffers.get(self)
+        if buf is None or buf['view'] is not self.data or buf['axis'] != i:
+            #starting a new buffer from the current data
+            buf = {'axis':i, 'data':None, 'scale':None}
+            buf['data'] = np.asarray(self.data)
+            buf['scale'] = np.asarray(self.scale[axis], dtype=float)
+        if buf['data'].shape[i] < n_old+n:
+            capacity = max(2*(n_old+n), 8)
+            shape = list(self.data.shape)
+            shape[i] = capacity
+            grown = np.empty(shape, dtype=np.result_type(buf['data'], data))
+            grown[(slice(None),)*i+(slice(0,n_old),)] = self.data
+            scale = np.empty(capacity)
+            scale[:n_old] = self.scale[axis]
+            buf['data'], buf['scale'] = grown, scale
+        
+        buf['data'][(slice(None),)*i+(slice(n_old,n_old+n),)] = data
+        buf['scale'][n_old:n_old+n] = scale_val
+        self.data = buf['data'][(slice(None),)*i+(slice(0,n_old+n),)]
+        self.scale[axis] = buf['scale'][:n_old+n]
+        buf['view'] = self.data
+        _append_buffers[self] = buf
+
+    def reduce(self, ax, center=None, width=None, op='sum', index=False):
+        """
+        returns a new nData reduced along ax with op over a window [center-width, center+width] 
+        (both ends included), the remaining axes keep their order in data.shape
+        NaNs are ignored (all NaN => 0 for sum, NaN otherwise)
+        
+        ax = 'x'|'y'|'z'
+        center = None (default) for the whole axis, otherwise a scale value (index if index = True)
+        width = half width in scale units (pixels if index = True), None/0 => single point
+        op = 'sum' (default), 'mean', 'max' or 'min'
+        
+        1D data returns the reduced value
+        
+        usage:
+            EDC = EA.reduce('y')
+            MDC = EA.reduce('x', center=KE, width=0.1, op='mean')
+        """
+        dims = len(self.data.shape)
+        i = _ax_index(ax, dims)
+        scale = self.scale[ax]
+        lo, hi = 0, len(scale)
+        if center is not None:
+            c = int(center) if index else scale_index(scale, center)
+            if index or not width:
+                b = int(width or 0)
+            else:
+                step = abs(scale[1]-scale[0]) if len(scale) > 1 else 1
+                b = int(round(abs(width)/step))
+            lo, hi = max(c-b, 0), min(c+b+1, len(scale))
+        data = self.data[(slice(None),)*i+(slice(lo,hi),)]
+        red = _reduce_array(np.asarray(data), i, op)
+        
+        if dims == 1:
+            return red
+        axes = ['y','x','z'][:dims]
+        axes.remove(ax)
+        d = nData(red)
+        new_axes = ['x'] if dims == 2 else ['y','x']
+        for new_ax,old_ax in zip(new_axes,axes):
+            d.updateAx(new_ax, self.scale[old_ax], self.unit[old_ax])
+        d.updateExtras(dict(self.extras))
+        return d
+
+    def rebin(self, factors):
+        """
+        returns a new nData with the data block averaged (NaNs are ignored) and the scales
+        averaged the same way, the trailing points that do not fill a block are dropped
+        
+        factors = int for all axes or dictionary {'x':fx,'y':fy,'z':fz} (missing axes => 1)
+        """
+        dims = len(self.data.shape)
+        axes = ['x'] if dims == 1 else ['y','x','z'][:dims]
+        if type(factors) != dict:
+            factors = {ax:factors for ax in axes}
+        f = [int(factors.get(ax,1)) for ax in axes]
+        
+        d = nData(rebin_array(self.data, f))
+        for ax,fi in zip(axes,f):
+            d.updateAx(ax, rebin_array(self.scale[ax], fi), self.unit[ax])
+        d.updateExtras(dict(self.extras))
+        return d
+
+    def downsample_to(self, shape):
+        """
+        returns a new nData rebinned by the smallest integer factors so that the data fits in shape
+        shape = tuple in the same order as data.shape
+        """
+        dims = len(self.data.shape)
+        axes = ['x'] if dims == 1 else ['y','x','z'][:dims]
+        return self.rebin(dict(zip(axes,downsample_factors(self.data.shape, shape))))
+
+    def _crop(self, ax, crop_start, crop_end, index):
+        """
+        crops along ax with basic slicing, data and scale are views of the original arrays
+        """
+        if index:
+            px_min, px_max = crop_start, crop_end
+        else:
+            index_min = scale_index(self.scale[ax], crop_start)
+            index_max = scale_index(self.scale[ax], crop_end)
+            #if the axis is descending (i.e. for BE), need to flip bounds as well
+            px_min = min(index_min,index_max)
+            px_max = max(index_min,index_max)
+
+        dims = len(self.data.shape)
+        axis = {'x':min(dims-1,1),'y':0,'z':2}[ax]
+        self.data = self.data[(slice(None),)*axis+(slice(px_min,px_max),)]
+        self.scale[ax] = self.scale[ax][px_min:px_max]
+
     def crop_x(self, crop_start, crop_end, **kwargs):
         """
         crops nData object in the x dimension
         works for dim = 1,2,3
-        crop_start/end = index (default) or coordinate range to crop
+        crop_start/end = coordinate (default) or index range to crop
+        the cropped data is a view of the original (no copy)
 
         kwargs 
             index = False (default) to crop by coordinate
                   = True to crop by index
         """
         kwargs.setdefault('index', False)
-
-        if kwargs['coord']:
-            px_min = crop_start
-            px_max = crop_end
-        else:
-            coord_min = take_closest_value(self.scale['x'], crop_start)
-            index_min = np.where(self.scale['x'] == coord_min)[0][0]
-            
-            coord_max = take_closest_value(self.scale['x'], crop_end)
-            index_max = np.where(self.scale['x'] == coord_max)[0][0]
-
-            #if x-axis is flipped (i.e. for BE), need to flip bounds as well
-            px_min = min(index_min,index_max)
-            px_max = max(index_min,index_max)
-
-
         dims = len(self.data.shape)
-        if dims == 3:
-            self.data = self.data[:,px_min:px_max,:]
-            self.scale['x'] = self.scale['x'][px_min:px_max]
-        elif dims == 2:            
-            self.data = self.data[:,px_min:px_max]
-            self.scale['x'] = self.scale['x'][px_min:px_max]
-        elif dims == 1:
-            self.data = self.data[px_min:px_max]
-            self.scale['x'] = self.scale['x'][px_min:px_max]
+        if dims in [1,2,3]:
+            self._crop('x', crop_start, crop_end, kwargs['index'])
         else:
             print("Data needs to have 1, 2, or 3 dimensions, not ",str(dims))
-        
 
     def crop_y(self,crop_start, crop_end, **kwargs):
         """
-        crops nData object in the x dimension
-        works for dim = 1,2,3
+        crops nData object in the y dimension
+        works for dim = 2,3 (see crop_x)
         """
-
-        kwargs.setdefault('coord', False)
-
-        if kwargs['index']:
-            px_min = crop_start
-            px_max = crop_end
-        else:
-            coord_min = take_closest_value(self.scale['y'], crop_start)
-            index_min = np.where(self.scale['y'] == coord_min)[0][0]
-            
-            coord_max = take_closest_value(self.scale['y'], crop_end)
-            index_max = np.where(self.scale['y'] == coord_max)[0][0]
-
-            #if x-axis is flipped (i.e. for BE), need to flip bounds as well
-            px_min = min(index_min,index_max)
-            px_max = max(index_min,index_max)
-
-
+        kwargs.setdefault('index', False)
         dims = len(self.data.shape)
-
-        if dims == 3:
-            self.data = self.data[px_min:px_max,:,:]
-            self.scale['y'] = self.scale['y'][px_min:px_max]
-        elif dims == 2:
-            self.data = self.data[px_min:px_max,:]
-            self.scale['y'] = self.scale['y'][px_min:px_max]
+        if dims in [2,3]:
+            self._crop('y', crop_start, crop_end, kwargs['index'])
         else:
             print("Data needs to have 2 or 3 dimensions, not ",str(dims))
 
     def crop_z(self,crop_start, crop_end, **kwargs):
         """
-        crops nData object in the x dimension
-        works for dim = 1,2,3
+        crops nData object in the z dimension
+        works for dim = 3 (see crop_x)
         """
-        kwargs.setdefault('coord', False)
-
-        if kwargs['index']:
-            px_min = crop_start
-            px_max = crop_end
+        kwargs.setdefault('index', False)
+        dims = len(self.data.shape)
+        if dims == 3:
+            self._crop('z', crop_start, crop_end, kwargs['index'])
         else:
-            coord_min = take_closest_value(self.scale['z'], crop_start)
-            index_min = np.where(self.scale['z'] == coord_min)[0][0]
-            
-            coord_max = take_closest_value(self.scale['z'], crop_end)
-            index_max = np.where(self.scale['z'] == coord_max)[0][0]
+            print("Data needs to have 3 dimensions, not ",str(dims))
 
-            #if x-axis is flipped (i.e. for BE), need to flip bounds as well
-            px_min = min(index_min,index_max)
-            px_max = max(index_min,index_max)
 
+def _ax_index(ax, rank):
+    """
+    index in data.shape for ax, data.shape = (x), (y,x) or (y,x,z)
+    """
+    if rank == 1:
+        return 0
+    return {'y':0,'x':1,'z':2}[ax]
 
-        dims = len(self.data.shape)
+def _promote(a, rank, i):
+    """
+    adds the missing dimensions to a for joining along data axis i of rank data
+    1D data are rows along x when going to 3D, otherwise the new dimension is i
+    """
+    if len(a.shape) == 1 and rank == 3:
+        a = a[np.newaxis,:]
+    while len(a.shape) < rank:
+        a = np.expand_dims(a, i)
+    return a
 
-        if dims == 3:
-            self.data = self.data[:,:,px_min:px_max]
-            self.scale['z'] = self.scale['z'][px_min:px_max]
-        else:
-            print("Data needs to have 3 dimensions, not ",str(dims))
+_append_buffers = weakref.WeakKeyDictionary()
 
+def _reduce_array(a, axis, op='sum'):
+    """
+    NaN-aware reduction of a along axis, op = 'sum','mean','max','min'
+    uses bottleneck if installed, otherwise the plain numpy reduction when there are no NaNs 
+    """
+    if op not in ['sum','mean','max','min']:
+        print("Not a valid op: "+str(op)+", use 'sum','mean','max' or 'min'")
+        return
+    if a.shape[axis] == 0:
+        shape = a.shape[:axis]+a.shape[axis+1:]
+        return np.zeros(shape) if op == 'sum' else np.full(shape,np.nan)
+    if not np.issubdtype(a.dtype, np.floating):
+        return getattr(np, op)(a, axis=axis)
+    if bn is not None:
+        return getattr(bn, 'nan'+op)(a, axis=axis)
+    if not np.isnan(a).any():
+        return getattr(np, op)(a, axis=axis)
+    with warnings.catch_warnings():
+        #all NaN slices return NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return getattr(np, 'nan'+op)(a, axis=axis)
+
+def scale_index(scale, val):
+    """
+    returns the index of the value in a monotonic scale closest to val (ascending or descending)
+    binary search, use find_closest for non-monotonic scales
+    """
+    scale = np.asarray(scale)
+    n = len(scale)
+    if n > 1 and scale[-1] < scale[0]:
+        i = n - 1 - np.searchsorted(scale[::-1],val)
+        candidates = [max(i,0),min(i+1,n-1)]
+    else:
+        i = np.searchsorted(scale,val)
+        candidates = [max(i-1,0),min(i,n-1)]
+    return int(min(candidates,key=lambda j: abs(scale[j]-val)))
 
 #==============================================================================
 # Loading the nData class
@@ -426,82 +614,150 @@ def nData_h5Group_r(h):
 # Utils for appending/dstacking
 #==============================================================================
 
+class nStackView:
+    """
+    zero-copy stack of the data arrays in a list of nData objects, returned by ndstack(virtual=True)
+    behaves like the np.array from ndstack but the frames are only copied when indexed
+    
+    usage:
+        view[...,i] / view[i] => data array of the ith nData (no copy) for 2D (1D) data
+        view[:,:,10:20] => np.array with only the requested frames copied
+        np.asarray(view) => full stack (copies everything)
+    """
+    def __init__(self, arrays, axis):
+        self.arrays = arrays
+        self.axis = axis
+        frame = arrays[0].shape
+        shape = list(frame)
+        shape.insert(axis,len(arrays))
+        self.shape = tuple(shape)
+        self.ndim = len(shape)
+        self.dtype = np.result_type(*arrays)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.stack(self.arrays,axis=self.axis).astype(dtype or self.dtype,copy=False)
+
+    def __getitem__(self, key):
+        key = key if type(key) == tuple else (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),)*(self.ndim-len(key)+1) + key[i+1:]
+        key = key + (slice(None),)*(self.ndim-len(key))
+        frame_key = key[:self.axis]+key[self.axis+1:]
+        stack_key = key[self.axis]
+        if np.ndim(stack_key) == 0 and type(stack_key) != slice:
+            return self.arrays[stack_key][frame_key]
+        frames = np.arange(len(self.arrays))[stack_key]
+        #axes dropped by integer indexing before the stack axis
+        axis = self.axis - sum(np.ndim(k) == 0 and type(k) != slice for k in key[:self.axis])
+        return np.stack([self.arrays[i][frame_key] for i in frames],axis=axis)
+
 def ndstack(nData_list,dstack_scale=None,dstack_unit="", **kwargs):
     """
     returns a dstack of nData objects 
     nData_list = list of nData objects, where the first element is the base object 
+        1D => stacked along y, shape = (len(nData_list),x)
+        2D => stacked along z, shape = (y,x,len(nData_list)), 3D objects add all their z slices 
+        2D followed by 1D => the 1D data are added as rows, shape = (y+len(nData_list)-1,x)
     dstack_scale = np.array for scaling (does not need to be monotonic)
                 = None => index
+                for 1D rows added to 2D, the y scale of the result (None => the y scale of the first, continued with the same step)
    
     **kwargs
         extras: standard nData extras dictionary
+        memmap = None (default), file path to write the stack to disk as a memory-mapped .npy 
+                 (np.load(path, mmap_mode='r') to reopen), use for stacks larger than memory
+        virtual = False (default), True => data is an nStackView of the original arrays (no copy)
     """
     kwargs.setdefault('debug',False)
     kwargs.setdefault('extras',{})
-
-    if type(dstack_scale) == None:
-        dstack_scale = np.arange(1,len(nData_list)+1)
-
-    #dstacking the data
-    dstacklist = []
-    
-    
-
+    kwargs.setdefault('memmap',None)
+    kwargs.setdefault('virtual',False)
+
+    #validating the shapes before allocating
+    d0 = nData_list[0]
+    rank = len(d0.data.shape)
+    if rank not in [1,2,3]:
+        print('Can only dstack 1D, 2D and 3D data sets')
+        return
+    frame = d0.data.shape[:2]
+    if rank == 2 and len(nData_list) > 1 and all([len(d.data.shape) == 1 for d in nData_list[1:]]):
+        return _ndstack_rows(nData_list,dstack_scale,dstack_unit,**kwargs)
+    nframes = []
     for i,d in enumerate(nData_list):
         if kwargs['debug']:
             print(d.data.shape)
-        rank = len(d.data.shape)
-        if i==0:
-            dstacklist = []
-            if kwargs['debug'] == True:
-                print('rank = '+str(rank))
-            dstack = d.data
-            xscale = d.scale['x']
-            xunit = d.unit['x']
+        if d.data.shape[:2] != frame or (rank == 1) != (len(d.data.shape) == 1):
+            print('Shape mismatch, nData_list['+str(i)+'].data.shape = '+str(d.data.shape)+' but the first is '+str(d0.data.shape))
+            return
+        nframes.append(1 if len(d.data.shape) < 3 else d.data.shape[2])
+    N = sum(nframes)
+    axis = 0 if rank == 1 else 2
+    if kwargs['debug']:
+        print('rank = '+str(rank)+', frames = '+str(N))
+
+    if dstack_scale is None:
+        dstack_scale = np.arange(1,N+1)
+
+    #allocating once and copying in
+    if kwargs['virtual']:
+        if N != len(nData_list):
+            print('virtual stacks only work for lists of 1D or 2D data')
+            return
+        dstack = nStackView([d.data for d in nData_list],axis)
+    else:
+        dtype = np.result_type(*[d.data for d in nData_list])
+        shape = (N,)+frame if rank == 1 else frame+(N,)
+        if kwargs['memmap'] is not None:
+            dstack = np.lib.format.open_memmap(kwargs['memmap'],mode='w+',dtype=dtype,shape=shape)
+        else:
+            dstack = np.empty(shape,dtype=dtype)
+        k = 0
+        for d,n in zip(nData_list,nframes):
             if rank == 1:
-                yscale = np.array(dstack_scale[i])
-                yunit = dstack_unit
-            elif rank == 2:
-                yscale = d.scale['y']
-                yunit = d.unit['y']
-                if len(nData_list[i+1].data.shape) == 1: #adding 1D to image
-                    zscale = None
-                    zunit = ''
-                elif len(nData_list[i+1].data.shape) == 2: #adding 2D to image
-                    zscale = np.array(dstack_scale[i])
-                    zunit = dstack_unit   
-                elif len(nData_list[i+1].data.shape) == 3: #adding 2D to 3D
-                    zscale = d.scale['z']
-                    zunit = d.unit['z']
+                dstack[k] = d.data
             else:
-                print('Can only dstack 1D, 2D and 3D data sets')
-        else:
-            if rank == 1: #dstacking along y
-                dstack=np.vstack((dstack,d.data))
-                yscale=dstack_scale
-                yunit = dstack_unit
-
-            else: #dstacking along z
-                dstack=np.dstack((dstack,d.data))
-                zscale=dstack_scale
-                zunit = dstack_unit
-    
+                dstack[:,:,k:k+n] = d.data.reshape(frame+(n,))
+            k += n
 
     d = nData(dstack)
+    d.updateAx('x', d0.scale['x'], d0.unit['x'])
     if rank == 1:
         if kwargs['debug'] == True:
             print('updating scales rank 1')
-        d.updateAx('x', xscale, xunit)
-        d.updateAx('y', yscale, yunit)
-        
+        d.updateAx('y', dstack_scale, dstack_unit)
     else:
         if kwargs['debug'] == True:
             print('updating scales rank > 1')
-            print(xunit,yunit,zunit)
-        d.updateAx('z', zscale, zunit)
-        d.updateAx('y', yscale, yunit)
-        d.updateAx('x', xscale, xunit)
+        d.updateAx('y', d0.scale['y'], d0.unit['y'])
+        d.updateAx('z', dstack_scale, dstack_unit)
+    
+    stack_attributes(nData_list,d)
+    return d
+
+def _ndstack_rows(nData_list,dstack_scale=None,dstack_unit="",**kwargs):
+    """
+    ndstack of a 2D nData followed by 1D nData, which are added as rows (along y)
+    """
+    d0 = nData_list[0]
+    for i,d in enumerate(nData_list[1:]):
+        if d.data.shape[0] != d0.data.shape[1]:
+            print('Shape mismatch, nData_list['+str(i+1)+'].data.shape = '+str(d.data.shape)+' but the first is '+str(d0.data.shape))
+            return
+    dstack = np.vstack([d0.data]+[d.data for d in nData_list[1:]])
+    N = dstack.shape[0]
+    if dstack_scale is None:
+        y0 = np.asarray(d0.scale['y'],dtype=float)
+        step = y0[1]-y0[0] if len(y0) > 1 else 1
+        dstack_scale = np.concatenate((y0,y0[-1]+step*np.arange(1,N-len(y0)+1)))
+        dstack_unit = d0.unit['y']
     
+    d = nData(dstack)
+    d.updateAx('x', d0.scale['x'], d0.unit['x'])
+    d.updateAx('y', dstack_scale, dstack_unit)
     stack_attributes(nData_list,d)
     return d
 
@@ -511,112 +767,215 @@ def nAppend(data1,data2,**kwargs):
     appends  pynData data sets along ax axis
         2D(x,y)
         3D(x,y,z)
+    see nData.concat
 
-
-    sets the scaling --- still need to work on
-    nVol.extra['Append']=data1,data2
         kwargs:
             ax = 'x'|'y'|'z', axis to which to append, (default: ax='z')
             scale = 'data'|'point', sets the scaling base of the data or point number (default:data)
-            extra = 1|2|None, copies the meta data from (data1),(data2),None (default:1)
     """
     kwargs.setdefault('ax','z')
     kwargs.setdefault('scale','data')
 
     if (len(np.shape(data1.data)) <2 ) or (len(np.shape(data2.data)) <2 ):
         print("Append only works for 2D or 3D datasets")
-    else:
-    ## Making dstack1 a volume
-        if len(np.shape(data1.data)) <3:
-            if kwargs['ax'] == 'x':
-                vol1=data1.data[np.newaxis,:,:]
-            if kwargs['ax']  == 'y':
-                vol1=data1.data[:,np.newaxis,:]
-            if kwargs['ax']  == 'z':
-                vol1=data1.data[:,:,np.newaxis]
-        else:
-            vol1=data1.data
-    ## Making dstack2 a volume
-        if len(np.shape(data2.data)) <3:
-            if kwargs['ax']  == 'x':
-                vol2=data2.data[np.newaxis,:,:]
-            if kwargs['ax']  == 'y':
-                vol2=data2.data[:,np.newaxis,:]
-            if kwargs['ax']  == 'z':
-                vol2=data2.data[:,:,np.newaxis]
-        else:
-            vol2=data2.data
-    ## dStacking vol2 ontop of vol1
-        if kwargs['ax']  == 'x':
-            if (np.shape(vol1)[1]==np.shape(vol2)[1]) and (np.shape(vol1)[2]==np.shape(vol2)[2]):
-                vol1=np.ddstack((vol1,vol2))
-                xscale=np.append(data1.scale['x'],data2.scale['x'])
-                yscale=data1.scale['y']
-                zscale=data1.scale['z']
-            else:
-                print("Data sets must be the same size in y and z")
-        if kwargs['ax']  == 'y':
-            if (np.shape(vol1)[0]==np.shape(vol2)[0]) and (np.shape(vol1)[2]==np.shape(vol2)[2]):
-                vol1=np.hdstack((vol1,vol2))
-                xscale=data1.scale['x']
-                yscale=np.append(data1.scale['y'],data2.scale['y'])
-                zscale=data1.scale['z']
-            else:
-                print("Data sets must be the same size in x and z")
-        if kwargs['ax']  == 'z':
-            if (np.shape(vol1)[0]==np.shape(vol2)[0]) and (np.shape(vol1)[1]==np.shape(vol2)[1]):
-                vol1=np.vdstack((vol1,vol2))
-                xscale=data1.scale['x']
-                yscale=data1.scale['y']
-                zscale=np.append(data1.scale['z'],data2.scale['z'])
-            else:
-                print("Data sets must be the same size in x and y")
-        nVol=nData(vol1)
-        if kwargs['scale'] == 'data': 
-            nVol.updateAx('x',xscale,data1.unit['x'])
-            nVol.updateAx('y',yscale,data1.unit['y'])
-            nVol.updateAx('z',zscale,data1.unit['z'])
-        nVol.extras.update({'nDataAppend',['data1','data2']})
-        return nVol
-	
+        return
+    nVol = data1.concat([data2],axis=kwargs['ax'],scale=kwargs['scale'])
+    if nVol is not None:
+        nVol.extras.update({'nDataAppend':['data1','data2']})
+    return nVol
+
 def stack_dict(d,key,val_n):
     """
     used to stack dictionary values as in update attributes in a stack
     d = dictionary of stacked values, can be empty for first occurrance
     key is key for dictionary
     val_n is value to update 
-    return a stack of d[key] and val_n
+    collects the values in a list, d[key][n] = val_n for the nth call (see stack_columns)
     """
-    if key not in d:
-        d[key] = val_n
-    else:
-        if type(val_n) == list:
-            d[key] = d[key].append(val_n)
-        elif type(val_n) == tuple:    
-            d[key] = d[key].list(val_n)
-        elif type(val_n) == dict:
-            for dk in val_n.keys():
-                d[key] = stack_dict(val_n,dk,val_n[dk])
-        else: 
-            d[key] = np.vstack((d[key],val_n))
+    d.setdefault(key,[]).append(val_n)
     return d
-    
 
+def _stack_column(vals):
+    """
+    converts a list of per-object values into an array (nested dictionaries are stacked by key)
+    ragged or non-numeric values stay a list
+    """
+    if all(type(val) == dict for val in vals):
+        keys = []
+        for val in vals:
+            keys += [k for k in val.keys() if k not in keys]
+        return {k:_stack_column([val.get(k) for val in vals]) for k in keys}
+    try:
+        col = np.array(vals)
+    except ValueError:
+        return list(vals)
+    if col.dtype == object:
+        return list(vals)
+    return col
+
+def stack_columns(d):
+    """
+    converts a dictionary of collected values (see stack_dict) into columns,
+    d[key][n] is the value for the nth object in the stack
+    """
+    return {key:_stack_column(vals) for key,vals in d.items()}
 
 def stack_attributes(stack_list, dstack):
     """
     creates a stack of attributes in stack_list and adds them to stack
+    each attribute is an np.array (or list/dictionary of arrays) with the value 
+    of the nth object at index n, see unstack_attributes
+    for a single object the values are copied as is
     """
+    skip = set(['data', 'scale', 'unit'])
+    if len(stack_list) == 1:
+        for key in set(vars(stack_list[0]).keys()) - skip:
+            setattr(dstack,key,getattr(stack_list[0],key))
+        return
+
     metadata = {}
-    for key in set(vars(stack_list[0]).keys()) - set(['data', 'scale', 'unit']):
-        for n,nd in enumerate(stack_list):
-            val_n = getattr(nd,key)
-            metadata = stack_dict(metadata,key,val_n)
+    for key in set(vars(stack_list[0]).keys()) - skip:
+        for nd in stack_list:
+            metadata = stack_dict(metadata,key,getattr(nd,key,None))
+
+    for key,val in stack_columns(metadata).items():
+        setattr(dstack,key,val)
+
+def unstack_attributes(dstack,n,keys=None):
+    """
+    returns a dictionary with the attributes of the nth object in a stack (see stack_attributes)
+    keys = None (default) for all the stacked attributes
+    """
+    def _item(val):
+        if type(val) == dict:
+            return {k:_item(v) for k,v in val.items()}
+        return val[n]
+    
+    if keys is None:
+        keys = set(vars(dstack).keys()) - set(['data', 'scale', 'unit'])
+    attrs = {}
+    for key in keys:
+        try:
+            attrs[key] = _item(getattr(dstack,key))
+        except (TypeError, IndexError, KeyError):
+            pass
+    return attrs
+
+
+class nSlicer:
+    """
+    binned slices of a 3D nData object (shape = (y,x,z)) for interactive browsing
+    
+    the cumulative sums along each axis are calculated the first time an axis is sliced,
+    a slice binned over any width then costs the same as a single slice 
+    the sums are recalculated when nd.data is replaced (nd.data = ...), 
+    call invalidate() after changing nd.data in place
+    only weak references to nd and its data are kept, the sums are freed with nd
+
+    usage:
+        s = get_slicer(dstack)
+        img = s.slice('xy',c=[x,y,z],b=[bin_x,bin_y,bin_z])  (see slice_dstack)
+    """
+    data_axis = {'x':1,'y':0,'z':2}
 
-    for key in metadata.keys():
-        setattr(dstack,key,metadata[key])
+    def __init__(self,nd):
+        self._nd = weakref.ref(nd)
+        self.invalidate()
 
+    @property
+    def nd(self):
+        return self._nd()
 
+    @property
+    def _data(self):
+        return self.nd.data
+
+    def invalidate(self):
+        """
+        clears the cumulative sums
+        """
+        try:
+            self._data_ref = weakref.ref(self.nd.data)
+        except TypeError:
+            #data that can not be weak referenced (i.e. h5py datasets) is compared by id
+            self._data_ref = None
+            self._data_id = id(self.nd.data)
+        self._cumsum = {}
+
+    def _check(self):
+        if self._data_ref is not None:
+            replaced = self._data_ref() is not self.nd.data
+        else:
+            replaced = self._data_id != id(self.nd.data)
+        if replaced:
+            self.invalidate()
+
+    def cumsum(self,ax):
+        """
+        cumulative nansum along ax with a leading zero, sum(data[lo:hi]) = cumsum[hi]-cumsum[lo]
+        """
+        self._check()
+        if ax not in self._cumsum:
+            axis = self.data_axis[ax]
+            shape = list(self._data.shape)
+            shape[axis] += 1
+            cs = np.zeros(shape)
+            np.cumsum(np.nan_to_num(self._data),axis=axis,out=cs[(slice(None),)*axis+(slice(1,None),)])
+            self._cumsum[ax] = cs
+        return self._cumsum[ax]
+
+    def index(self,ax,val):
+        """
+        index of the scale value closest to val (scales must be monotonic)
+        """
+        return scale_index(self.nd.scale[ax],val)
+
+    def band(self,ax,val,width):
+        """
+        returns the sum of the data along ax over [val-width,val+width) (in scale units), as in slice_dstack
+        """
+        scale = self.nd.scale[ax]
+        i = self.index(ax,val)
+        step = abs(scale[1]-scale[0]) if len(scale) > 1 else 1
+        b = int(abs(width)/step)
+        lo, hi = max(i-b,0), min(i+max(b,1),len(scale))
+        cs = self.cumsum(ax)
+        axis = self.data_axis[ax]
+        take = lambda j: np.take(cs,j,axis=axis)
+        return take(hi) - take(lo)
+
+    def slice(self,axes,c,b):
+        """
+        axes = 'xy','yx','xz','zx','yz','zy' of desired slice
+        c = [x,y,z] where to slice in scale space
+        b = [bin_x,bin_y,bin_z], how much to bin
+        """
+        nd = self.nd
+        for i,ax in enumerate(['x','y','z']):
+            if ax not in axes:
+                img = self.band(ax,c[i],b[i])
+        #img is in data order: 'x' => (y,z), 'y' => (x,z), 'z' => (y,x)
+        img = nData(img.T) if axes in ['yz','xz','yx'] else nData(img)
+        img.updateAx('x', nd.scale[axes[0]], nd.unit[axes[0]])
+        img.updateAx('y', nd.scale[axes[1]], nd.unit[axes[1]])
+
+        extras = dict(nd.extras)
+        extras.update({'slice_cb':(c,b)})
+        img.updateExtras(extras)
+        return img
+
+_slicers = weakref.WeakKeyDictionary()
+
+def get_slicer(nd):
+    """
+    returns the nSlicer for a 3D nData object, creating it on first use
+    """
+    if nd not in _slicers:
+        _slicers[nd] = nSlicer(nd)
+    slicer = _slicers[nd]
+    #drops the sums of replaced data right away
+    slicer._check()
+    return slicer
 
 def slice_dstack(axes,dstack,c,b):
     """
@@ -627,60 +986,12 @@ def slice_dstack(axes,dstack,c,b):
     c = [x,y,z] where to slice in scale space
     b = [bin_x,bin_y,bin_z], how much to bin
 
+    uses the cumulative sums cached for dstack (see nSlicer)
+    chunked volumes only read the binned planes (see nDataChunked)
     """
-    #convert cursor from scale to pixel
-    c_px = []
-    for i,ax in enumerate(dstack.scale.keys()):
-        c_px.append(int(find_closest(dstack.scale[ax],c[i])[0]))
-    
-    #convert bin from scale to pixel
-    b_px = []
-    for i,ax in enumerate(dstack.scale.keys()):
-        b_px.append(int(b[i]/(dstack.scale[ax][1]-dstack.scale[ax][0])))
-    #note that dstack.data is  [y,x,z], while 
-    ar = dstack.data.transpose((1, 0, 2))
-
-    #slicing the dstack 
-    if axes == 'yz':
-        img = np.nansum(ar[c_px[0]-b_px[0]:c_px[0]+max(b_px[0],1),:,:],axis=0)
-        img = nData(img.T)
-        img.updateAx('x', dstack.scale['y'], dstack.unit['y'])
-        img.updateAx('y', dstack.scale['z'], dstack.unit['z'])
-    
-    elif axes == 'zy':
-        img = np.nansum(ar[c_px[0]-b_px[0]:c_px[0]+max(b_px[0],1),:,:],axis=0)
-        img = nData(img)
-        img.updateAx('y', dstack.scale['y'], dstack.unit['y'])
-        img.updateAx('x', dstack.scale['z'], dstack.unit['z'])
-    
-    elif axes == 'xz':
-        img = np.nansum(ar[:,c_px[1]-b_px[1]:c_px[1]+max(b_px[1],1),:],axis=1)
-        img = nData(img.T)
-        img.updateAx('x', dstack.scale['x'], dstack.unit['x'])
-        img.updateAx('y', dstack.scale['z'], dstack.unit['z'])
-
-    elif axes == 'zx':
-        img = np.nansum(ar[:,c_px[1]-b_px[1]:c_px[1]+max(b_px[1],1),:],axis=1)
-        img = nData(img)
-        img.updateAx('y', dstack.scale['x'], dstack.unit['x'])
-        img.updateAx('x', dstack.scale['z'], dstack.unit['z'])        
-    
-    elif axes == 'xy':
-        img = np.nansum(ar[:,:,c_px[2]-b_px[2]:c_px[2]+max(b_px[2],1)],axis=2)
-        img = nData(img.T)
-        img.updateAx('x', dstack.scale['x'], dstack.unit['x'])
-        img.updateAx('y', dstack.scale['y'], dstack.unit['y'])
-
-    elif axes == 'yx':
-        img = np.nansum(ar[:,:,c_px[2]-b_px[2]:c_px[2]+max(b_px[2],1)],axis=2)
-        img = nData(img)
-        img.updateAx('y', dstack.scale['x'], dstack.unit['x'])
-        img.updateAx('x', dstack.scale['y'], dstack.unit['y']) 
-
-    extras = dstack.extras
-    extras.update({'slice_cb':(c,b)})
-    img.updateExtras(extras)
-    return img    
+    if hasattr(dstack,'block_slice'):
+        return dstack.block_slice(axes,c,b)
+    return get_slicer(dstack).slice(axes,c,b)
 
 
 
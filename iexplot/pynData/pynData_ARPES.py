@@ -22,8 +22,12 @@
 #==============================================================================
 # imports
 #==============================================================================
+import os
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from scipy import interpolate
+from scipy import interpolate, ndimage
 
 from iexplot.pynData.pynData import nData, nData_h5Group_r, nData_h5Group_w, stack_attributes
 from iexplot.utilities import *
@@ -193,6 +197,86 @@ class nARPES(nData):
         self.angScale = newScale
 
 
+#==============================================================================
+# summing spectra/EDCs 
+#==============================================================================
+class EA_accumulator:
+    """
+    running sum of EA images, EDCs and MDCs in float64 buffers (nan are treated as zero like np.nansum)
+    the metadata is taken from the first EA that is added
+
+    keep_raw = True  => the added EA objects are kept in self.raw (dictionary)
+             = False => only the sums are kept, so memory is O(1 image) regardless of the number of sweeps
+    
+    usage:
+        acc = EA_accumulator(keep_raw=False)
+        for EAnum in EAlist:
+            acc.add(nEA(fpath),EAnum)
+        EAsummed = acc.result()
+    """
+    def __init__(self,keep_raw=True):
+        self.keep_raw = keep_raw
+        self.count = 0
+        self.data = None
+        self.EDC = None
+        self.MDC = None
+        self.raw = {}
+        self._first = None
+
+    def _add(self,buffer,val):
+        """
+        adds val to buffer, allocating the buffer on first use
+        """
+        val = np.asarray(val)
+        if buffer is None:
+            buffer = np.zeros(val.shape,dtype=np.float64)
+        np.add(buffer,val,out=buffer,where=~np.isnan(val))
+        return buffer
+
+    def add(self,EA,key=None):
+        """
+        adds an EA object to the running sum
+        key = key for self.raw (default: number of EAs already added)
+        """
+        if self._first is None:
+            self._first = {attr:val for attr,val in vars(EA).items() if attr not in ['data','EDC','MDC']}
+            self._first = copy.deepcopy(self._first)
+            self._EDCscale = (copy.deepcopy(EA.EDC.scale),dict(EA.EDC.unit))
+            self._MDCscale = (copy.deepcopy(EA.MDC.scale),dict(EA.MDC.unit))
+        elif np.shape(EA.data) != self.data.shape:
+            print('EA shape '+str(np.shape(EA.data))+' does not match '+str(self.data.shape))
+            return
+        
+        self.data = self._add(self.data,EA.data)
+        self.EDC = self._add(self.EDC,EA.EDC.data)
+        self.MDC = self._add(self.MDC,EA.MDC.data)
+        
+        if self.keep_raw:
+            self.raw[self.count if key is None else key] = EA
+        self.count += 1
+
+    def result(self,avg=False):
+        """
+        returns an nARPES object with the summed data, EDC and MDC
+        avg = True to divide by the number of EAs added
+        """
+        if self._first is None:
+            print('No EA has been added')
+            return
+        norm = self.count if avg else 1
+        
+        EAsummed = nARPES(self.data/norm)
+        for attr,val in self._first.items():
+            setattr(EAsummed,attr,copy.copy(val))
+        
+        EAsummed.EDC = nData(self.EDC/norm)
+        EAsummed.MDC = nData(self.MDC/norm)
+        for nd,(scale,unit) in [(EAsummed.EDC,self._EDCscale),(EAsummed.MDC,self._MDCscale)]:
+            for ax in scale:
+                nd.updateAx(ax,scale[ax],unit[ax])
+        return EAsummed
+
+
 #==============================================================================
 # stacking spectra/EDCs 
 #==============================================================================
@@ -294,6 +378,12 @@ def stack_EAs(EA_list,stack_scale,stack_unit,BE=True, **kwargs):
     #defining the angle scale    
     angle_scale = EA_list[0].scale['y']
     
+    #allocating the stack once
+    if kwargs['EDConly']:
+        stack = np.empty((len(EA_list),len(E_scale)))
+    else:
+        stack = np.empty((len(angle_scale),len(E_scale),len(EA_list)))
+
     for i,EA in enumerate(EA_list):
         if 'EA_offset' in kwargs:
             EA.set_E_offset(kwargs['E_offset'][i])
@@ -316,13 +406,10 @@ def stack_EAs(EA_list,stack_scale,stack_unit,BE=True, **kwargs):
             img_interp = interpolator.reshape(new_X.shape)
         
         # stack the interpolated 
-        if i == 0:
-            stack = img_interp
+        if kwargs['EDConly']:
+            stack[i] = img_interp
         else:
-            if kwargs['EDConly']:
-                stack = np.vstack((stack,img_interp))
-            else:
-                stack = np.dstack((stack,img_interp))
+            stack[:,:,i] = img_interp
     
     nd = nData(stack)
     stack_attributes(EA_list,nd)
@@ -346,55 +433,41 @@ def stack_EAs(EA_list,stack_scale,stack_unit,BE=True, **kwargs):
 
 def kmap_scan_thetaX(EAstack,**kwargs):
     '''
-    d type: pynData stack x: KE, y: thetaY, z: thetaX
-    returns pynData (x: ky, y: ky, z: BE)
+    EAstack type: pynData stack x: KE/BE, y: thetaY, z: thetaX (slitDir = 'V')
+    returns pynData (x: kx, y: ky, z: BE/KE)
+
+    **kwargs:
+        BE = True/False if x is the binding/kinetic energy (default: from the x unit)
+        E_offset = energy offset (default: 0.0)
+        chunk_MB, nthreads => see kmapPlan.apply
+        see kmapPlan for other kwargs (hv, wk, k_np, k1_range, k2_range)
     '''
-    KE = EAstack.scale['x']
-    thetaY = EAstack.scale['y']
-    thetaX = EAstack.scale['z'] #scan direction
-    
-    org = EAstack.data #data(thetaY, KE, thetaX)
-    EA = EAstack.data[:,:,0]
-    KE_min, KE_max, kx_min, kx_max, ky_min, ky_max, kz_min, kz_max = kmapping_boundaries_slice(EA)
-    
-    kx_scale  = np.linspace(kx_min,kx_max,len(list(thetaX)))
-    ky_scale  = np.linspace(ky_min,ky_max,len(list(thetaY)))
-
-    new = np.zeros((len(ky_scale),len(KE),len(kx_scale)))
-    new = interpolate.RegularGridInterpolator((ky_scale,KE,kx_scale),org, method = 'linear',bounds_error = False, fill_value = np.nan)
-    
-    dnew = nData(new.values.transpose(0,2,1))
+    kwargs.setdefault('BE','Binding' in EAstack.unit['x'])
+    kwargs.setdefault('slitDir','V')
+    apply_kwargs = {key:kwargs.pop(key) for key in ['chunk_MB','nthreads'] if key in kwargs}
     
-    BE = KE_to_BE(KE,EAstack.hv,EAstack.wk,EAstack.E_offset)
-    nData.updateAx(dnew,'x',kx_scale,'kx')
-    nData.updateAx(dnew,'y',ky_scale,'ky')
-    nData.updateAx(dnew,'z',BE,'BE')
+    plan = kmapPlan(EAstack,scan='angle',**kwargs)
+    dnew = plan.apply(EAstack,**apply_kwargs)
     
     return dnew
 
-def kmap_scan_hv(d,wk):
+def kmap_scan_hv(d,wk,**kwargs):
     '''
-    d type: pynData stack x: KE, y: thetaY, z: hv
-    returns pynData (x: ky, y: ky, z: BE)
+    d type: pynData stack x: BE, y: thetaY, z: hv
+    returns pynData (x: ky, y: kz, z: BE)
+
+    **kwargs:
+        V0 = inner potential (default: 10)
+        polar = manipulator polar angle (default: from d.thetaX)
+        E_offset = energy offset (default: 0.0)
+        chunk_MB, nthreads => see kmapPlan.apply
+        see kmapPlan for other kwargs (k_np, k1_range, k2_range)
     '''
-    KE = d.scale['x']
-    thetaY = d.scale['y']
-    hv = d.scale['z'] 
-    thetaX = np.zeros(len(hv))
-
-    org = d.data #data(thetaY, KE, hv)
+    kwargs.setdefault('slitDir','V')
+    apply_kwargs = {key:kwargs.pop(key) for key in ['chunk_MB','nthreads'] if key in kwargs}
 
-    kx_scale, ky_scale = nARPES.kScale(nARPES, KE, thetaY, thetaX)
-
-    new = np.zeros((len(ky_scale),len(KE),len(hv)))
-    new = interpolate.RegularGridInterpolator((ky_scale,KE,hv),org, method = 'linear')
-
-    dnew = nData(new.values.transpose(1,0,2))
-    
-    BE = KE_to_BE(KE,hv,wk)
-    nData.updateAx(dnew,'x',ky_scale,'ky')
-    nData.updateAx(dnew,'y',BE,'BE')
-    nData.updateAx(dnew,'z',hv,'hv')
+    plan = kmapPlan(d,scan='hv',BE=True,wk=wk,**kwargs)
+    dnew = plan.apply(d,**apply_kwargs)
 
     return dnew
 
@@ -455,77 +528,332 @@ def kmapping_boundaries(EA_list):
 
     
 
-def kmapping_stack(EA_list, BE=True, **kwargs):
+def _stack_attr(stack,key,default=None):
+    """
+    returns the first value of a stacked attribute (see stack_attributes) or default if missing
     """
-    creates a volume of stacked spectra in k-space
+    if hasattr(stack,key):
+        try:
+            return float(np.ravel(getattr(stack,key))[0])
+        except (TypeError, ValueError, IndexError):
+            pass
+    return default
 
-    EA_list = list of EA objects
 
-    kwargs =
-        KE_offset
+class kmapPlan:
     """
-    kwargs.setdefault('KE_offset',0.0)
+    precomputed k-space transform for a stack of EA images
+        source: data(angle,E,scan) as returned by stack_EAs 
+                (y: detector angle, x: BE or KE, z: manipulator angle or hv)
+        target: data(k2,k1,E)
+            scan = 'angle' (Fermi map) => x: kx, y: ky, z: E  
+                   slitDir = 'V' => scan is thetaX and angle is thetaY
+                   slitDir = 'H' => scan is thetaY and angle is thetaX - polar 
+            scan = 'hv'                => x: k along the slit, y: kz, z: E 
+                   (slitDir = 'H' assumes thetaY = 0)
+
+    The target grid and the pixel lookup for the source scales are calculated once.
+    apply() then evaluates the inverse mapping (k2,k1,E) => (angle,E,scan) for the
+    whole target grid and converts the stack in a single map_coordinates pass.
+    The coordinates are kept for the last E_offset/V0, re-rendering with a different 
+    E_offset or V0 only recalculates the coordinates.
+
+    usage:
+        stack = stack_EAs(EA_list,thetaX_list,'thetaX')
+        plan = kmapPlan(stack,scan='angle',hv=EA.hv,wk=EA.wk)
+        kmap = plan.apply(stack)
+        kmap = plan.apply(stack,E_offset=0.05)
+    """
+    def __init__(self,stack,scan='angle',BE=True,**kwargs):
+        """
+        stack = 3D nData object (y: angle, x: energy, z: scan) 
+        scan = 'angle' or 'hv'
+        BE = True/False if x is the binding/kinetic energy 
 
-    KE_min, KE_max, kx_min, kx_max, ky_min, ky_max, kz_min, kz_max = kmapping_boundaries(EA_list)
-    EA = EA_list[0]
-    
-    #energy BE/KE
-    BE_min = KE_to_BE(np.max(EA.KEscale),EA.hv,EA.wk)
-    BE_max = min(KE_to_BE(KE_min,EA.hv,EA.wk),KE_to_BE(KE_min,EA.hv,EA.wk))
-    if E_unit == 'KE':
-        E_new = np.arange(KE_min,KE_max,abs(BE_min-BE_max))
-    if E_unit == 'BE':
-        BE_np = EA.data.shape[1]
-        E_new = np.linspace(BE_max,BE_min,BE_np) #swap order for plotting
-    E_np = E_new.shape[0]
-    
-    #k
-    k_np = EA.angScale.shape[0]
-    if EA.slitDir == 'H':
-        k_new = np.linspace(kx_min,kx_max,k_np)
-    elif EA.slitDir == 'V':
-        k_new = np.linspace(ky_min,ky_max,k_np)
+        **kwargs:
+            slitDir = 'V' (default) or 'H'
+            polar = manipulator polar angle (thetaX), default from stack.thetaX (0 with a warning if missing)
+            hv = photon energy, default from stack.hv, required if stack has no hv (not used for scan = 'hv')
+            wk = work function, default from stack.wk, required if stack has no wk
+            E_offset = energy offset, scalar or one value per scan slice (default: 0.0)
+            V0 = inner potential (default: 10)
+            k_np = (k1_np,k2_np) number of points for the target grid (default: source shape)
+            k1_range = [k1_min,k1_max] (default: calculated from the source scales)
+            k2_range = [k2_min,k2_max] (default: calculated from the source scales)
+        """
+        kwargs.setdefault('slitDir','V')
+        kwargs.setdefault('polar',_stack_attr(stack,'thetaX'))
+        kwargs.setdefault('hv',_stack_attr(stack,'hv'))
+        kwargs.setdefault('wk',_stack_attr(stack,'wk'))
+        kwargs.setdefault('E_offset',0.0)
+        kwargs.setdefault('V0',10)
+        kwargs.setdefault('k_np',(stack.data.shape[2],stack.data.shape[0]))
+
+        if scan not in ['angle','hv']:
+            print('scan needs to be "angle" or "hv"')
+            return
+        if scan == 'hv' and not BE:
+            print('scan = "hv" needs a binding energy stack (BE=True)')
+            return
+        for key in (['wk','hv'] if scan == 'angle' else ['wk']):
+            if kwargs[key] is None:
+                print(key+' could not be read from the stack, specify it: kmapPlan(stack,'+key+'=...)')
+                return
+        if kwargs['polar'] is None:
+            print('Warning: thetaX could not be read from the stack, using polar = 0')
+            kwargs['polar'] = 0.0
+
+        self.scan = scan
+        self.BE = BE
+        self.slitDir = kwargs['slitDir']
+        self.polar = kwargs['polar']
+        self.hv = kwargs['hv']
+        self.wk = kwargs['wk']
+        self.E_offset = kwargs['E_offset']
+        self.V0 = kwargs['V0']
+        
+        self.angle_scale = np.array(stack.scale['y'],dtype=float)
+        self.E_scale = np.array(stack.scale['x'],dtype=float)
+        self.scan_scale = np.array(stack.scale['z'],dtype=float)
+        self.E_unit = stack.unit['x']
+        
+        #pixel lookup for the source scales
+        self._angle_lookup = self._lookup(self.angle_scale)
+        self._scan_lookup = self._lookup(self.scan_scale)
+
+        #target grid
+        k1_range, k2_range = self._boundaries()
+        if 'k1_range' in kwargs:
+            k1_range = kwargs['k1_range']
+        if 'k2_range' in kwargs:
+            k2_range = kwargs['k2_range']
+        self.k1_scale = np.linspace(k1_range[0],k1_range[1],kwargs['k_np'][0])
+        self.k2_scale = np.linspace(k2_range[0],k2_range[1],kwargs['k_np'][1])
+        if scan == 'angle':
+            self.k1_unit, self.k2_unit = 'kx', 'ky'
+        else:
+            self.k1_unit = 'ky' if self.slitDir == 'V' else 'kx'
+            self.k2_unit = 'kz'
 
-    #hv
-    z_np = len(EA_list)
-    z_new = []
-    
-    #make new stack
-    if EA.slitDir == 'H':
-        data_new = np.empty((E_np,k_np,z_np))
-        data_xx,data_yy = np.meshgrid(k_new,E_new)
-    elif EA.slitDir == 'V':
-        data_new = np.empty((k_np,E_np,z_np))
-        data_xx,data_yy = np.meshgrid(E_new,k_new)
+        self._coords = None
+        self._coords_key = None
 
-    for n, EA in enumerate(EA_list):
-        #convert single slice
-        if type(kwargs['KE_offset']) == float:
-            KE_offset = kwargs['KE_offset']
-        else:
-            KE_offset = kwargs['KE_offset'][n]
-        img = ARPES_angle_k(k_new,EA.data,EA.KEscale,EA.angScale,EA.thetaX,KE_offset,EA.slitDir)
+    def _lookup(self,scale):
+        """
+        returns (scale,pixel) sorted so that scale is increasing, used by np.interp
+        """
+        pix = np.arange(scale.shape[0],dtype=float)
+        if scale[0] > scale[-1]:
+            return scale[::-1], pix[::-1]
+        return scale, pix
+
+    def _pix(self,val,lookup):
+        """
+        converts val to fractional pixel, points outside of the scale are set to -1
+        """
+        pix = np.interp(val,lookup[0],lookup[1],left=-1,right=-1)
+        pix[np.isnan(pix)] = -1
+        return pix
+
+    def _KE(self,E_offset):
+        """
+        kinetic energy for each pixel in E_scale (scan = 'angle')
+        """
+        if self.BE:
+            return BE_to_KE(self.E_scale,self.hv,self.wk,E_offset)
+        return self.E_scale + E_offset
+    
+    def _boundaries(self):
+        """
+        returns k1_range, k2_range by evaluating the forward transform at the edges of the source grid
+        """
+        def _edges(scale):
+            edges = [np.min(scale),np.max(scale)]
+            if edges[0] < 0 < edges[1]:
+                edges.append(0.0)
+            return np.array(edges)
         
-        E_scale,E_unit = EA_Escale(EA,BE=True,**kwargs)
-        if EA.slitDir == 'H':
-            img_y = E_scale
-            img_x = k_new     
+        E_offset = np.ravel(self.E_offset)[:,np.newaxis]
+        if self.scan == 'angle':
+            KE = _edges(self._KE(E_offset))
+            if self.slitDir == 'V':
+                tx, ty = _edges(self.scan_scale), _edges(self.angle_scale)
+            else:
+                tx, ty = _edges(self.angle_scale+self.polar), _edges(self.scan_scale)
+            KE, tx, ty = np.meshgrid(KE,tx,ty)
+            k1 = theta_to_kx(KE,tx)
+            k2 = theta_to_ky(KE,tx,ty)
+        else:
+            hv, BE = np.meshgrid(_edges(self.scan_scale),_edges(self.E_scale))
+            KE = _edges(BE_to_KE(BE,hv,self.wk,E_offset[:,:,np.newaxis]))
+            if self.slitDir == 'V':
+                KE, ty = np.meshgrid(KE,_edges(self.angle_scale))
+                k1 = theta_to_ky(KE,self.polar,ty)
+                kx = theta_to_kx(KE,self.polar)
+            else:
+                KE, tx = np.meshgrid(KE,_edges(self.angle_scale+self.polar))
+                k1 = theta_to_kx(KE,tx)
+                kx = 0
+            k2 = k_to_kz(kx,k1,KE,self.V0)
+        return [np.nanmin(k1),np.nanmax(k1)], [np.nanmin(k2),np.nanmax(k2)]
+
+    def coords(self,E_offset=None,V0=None,rows=slice(None)):
+        """
+        returns the source pixel coordinates, shape = (3,len(k2_scale[rows]),len(k1_scale),len(E_scale))
+        for use with ndimage.map_coordinates on data(angle,E,scan)
+
+        E_offset = energy offset (default: self.E_offset)
+            scalar or one value per scan slice
+        V0 = inner potential (default: self.V0)
+        rows = slice of the k2 axis to calculate (default: all)
+        """
+        E_offset = self.E_offset if E_offset is None else E_offset
+        V0 = self.V0 if V0 is None else V0
         
-        elif EA.slitDir == 'V':
-            img_x = E_scale
-            img_y = k_new
+        offsets = np.asarray(E_offset,dtype=float)
+        if offsets.ndim == 0:
+            return self._coords_offset(offsets,V0,rows)
+        #per slice offsets: the slice is only known after the transform,
+        #so solve with the mean offset and again with the offset at each point's scan pixel
+        coords = self._coords_offset(np.mean(offsets),V0,rows)
+        scan_pix = np.arange(offsets.shape[0],dtype=float)
+        for i in range(2):
+            coords = self._coords_offset(np.interp(coords[2],scan_pix,offsets),V0,rows)
+        return coords
+
+    def _coords_offset(self,E_offset,V0,rows):
+        """
+        coords for a scalar E_offset or an E_offset with the shape of the target grid
+        """
+        c = np.sqrt(2*me)/hbar
+        deg = 180/np.pi
+
+        k2 = self.k2_scale[rows][:,np.newaxis,np.newaxis]
+        k1 = self.k1_scale[np.newaxis,:,np.newaxis]
+        shape = (k2.shape[0],k1.shape[1],self.E_scale.shape[0])
+        E_pix = np.arange(self.E_scale.shape[0],dtype=float)[np.newaxis,np.newaxis,:]
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            if self.scan == 'angle':
+                s = c*np.sqrt(np.broadcast_to(self._KE(E_offset),shape))
+                tx = np.arcsin(k1/s)
+                ty = np.arcsin(k2/(s*np.cos(tx)))*deg
+                tx = tx*deg
+                if self.slitDir == 'V':
+                    angle, scan = ty, tx
+                else:
+                    angle, scan = tx - self.polar, ty
+            else:
+                cos2 = np.cos(self.polar/deg)**2 if self.slitDir == 'V' else 1
+                KE = ((k1**2+k2**2)/c**2 - V0)/cos2
+                if self.slitDir == 'V':
+                    angle = np.arcsin(k1/(c*np.sqrt(KE)*np.cos(self.polar/deg)))*deg
+                else:
+                    angle = np.arcsin(k1/(c*np.sqrt(KE)))*deg - self.polar
+                BE = self.E_scale[np.newaxis,np.newaxis,:]
+                scan = KE + self.wk + BE - E_offset
+
+        coords = np.empty((3,)+shape)
+        coords[0] = self._pix(angle,self._angle_lookup)
+        coords[1] = E_pix
+        coords[2] = self._pix(scan,self._scan_lookup)
+        return coords
+
+    def apply(self,stack,E_offset=None,V0=None,**kwargs):
+        """
+        returns a new nData object with the stack converted to k-space 
+
+        stack = 3D nData with the same scaling as the one used to make the plan
+        E_offset = energy offset (default: self.E_offset)
+            scalar or a list with one value per scan slice (stack z)
+        V0 = inner potential (default: self.V0)
 
+        **kwargs:
+            chunk_MB = memory limit for the coordinates in MB (default: 256)
+                if the coordinates for the whole grid fit, they are calculated once and kept,
+                otherwise they are calculated on the fly for blocks of k2 rows  
+            nthreads = number of threads for the blocks (default: os.cpu_count())
+        """
+        if not hasattr(self,'k1_scale'):
+            print('kmapPlan was not created, see the message above')
+            return
+        kwargs.setdefault('chunk_MB',256)
+        kwargs.setdefault('nthreads',os.cpu_count())
+
+        E_offset = self.E_offset if E_offset is None else E_offset
+        V0 = self.V0 if V0 is None else V0
+        if np.ndim(E_offset) and np.size(E_offset) != self.scan_scale.shape[0]:
+            print('E_offset needs to be a scalar or have one value per scan slice ('+str(self.scan_scale.shape[0])+')')
+            return
+        
+        data = np.asarray(stack.data,dtype=float)
+        shape = (self.k2_scale.shape[0],self.k1_scale.shape[0],self.E_scale.shape[0])
+        row_MB = 3*8*shape[1]*shape[2]/1e6
+        
+        if row_MB*shape[0] <= kwargs['chunk_MB']:
+            key = (tuple(np.ravel(E_offset)),V0)
+            if self._coords_key != key:
+                self._coords = self.coords(E_offset,V0)
+                self._coords_key = key
+            data_new = ndimage.map_coordinates(data,self._coords,order=1,mode='constant',cval=np.nan)
+        else:
+            #bounded memory: each thread holds the coordinates for one block of rows 
+            nthreads = max(int(kwargs['nthreads'] or 1),1)
+            nrows = max(int(kwargs['chunk_MB']/nthreads/row_MB),1)
+            data_new = np.empty(shape)
+            
+            def _block(start):
+                rows = slice(start,min(start+nrows,shape[0]))
+                ndimage.map_coordinates(data,self.coords(E_offset,V0,rows),output=data_new[rows],
+                                        order=1,mode='constant',cval=np.nan)
             
-        #now we need to interp image into 3D array
-        img_xx,img_yy = np.meshgrid(img_x,img_y)
-        data_new[:,:,n] = interpolate.griddata((np.ravel(img_xx),np.ravel(img_yy)),np.ravel(img),(data_xx,data_yy),fill_value=np.nanmin(img),rescale=True,method='nearest')
+            with ThreadPoolExecutor(max_workers=nthreads) as pool:
+                list(pool.map(_block,range(0,shape[0],nrows)))
         
-        data_new = np.nan_to_num(data_new, nan = np.nanmin(img))
+        d = nData(data_new)
+        d.updateAx('x',self.k1_scale,self.k1_unit)
+        d.updateAx('y',self.k2_scale,self.k2_unit)
+        d.updateAx('z',self.E_scale,self.E_unit)
+        d.updateExtras(dict(stack.extras))
+        return d
+
 
-    d = nData(data_new)
-    d.updateAx('x',E_scale,E_unit)
-    d.updateAx('y',k_new,'ky')
-    stack_attributes(EA_list,d)
+def kmapping_stack(EA_list, BE=True, **kwargs):
+    """
+    creates a volume in k-space from a Fermi map, 
+        returns nData (x: kx, y: ky, z: BE/KE)
+
+    EA_list = list of EA objects (scan of thetaX for slitDir = 'V', thetaY for slitDir = 'H')
+    BE = True/False for BE/KE scaling
+
+    kwargs =
+        KE_offset = energy offset, scalar or one value per EA (default: 0.0)
+        plan = kmapPlan from a previous call to reuse (default: None => new plan)
+        see kmapPlan for other kwargs
+    """
+    kwargs.setdefault('KE_offset',0.0)
+    kwargs.setdefault('plan',None)
+
+    EA = EA_list[0]
+    if EA.slitDir == 'H':
+        stack_scale = [EA.thetaY for EA in EA_list]
+        stack_unit = 'thetaY'
+    else:
+        stack_scale = [EA.thetaX for EA in EA_list]
+        stack_unit = 'thetaX'
+    stack = stack_EAs(EA_list,stack_scale,stack_unit,BE=BE)
+    
+    plan = kwargs['plan']
+    if plan is None:
+        plan_kwargs = {key:kwargs[key] for key in kwargs if key not in ['KE_offset','plan']}
+        plan_kwargs.setdefault('slitDir',EA.slitDir)
+        plan_kwargs.setdefault('polar',EA.thetaX)
+        plan_kwargs.setdefault('hv',EA.hv)
+        plan_kwargs.setdefault('wk',EA.wk)
+        plan_kwargs.setdefault('E_offset',kwargs['KE_offset'])
+        plan = kmapPlan(stack,scan='angle',BE=BE,**plan_kwargs)
+
+    d = plan.apply(stack,E_offset=kwargs['KE_offset'])
     return d
         
 ##########################################
@@ -0,0 +1,359 @@
+#==============================================================================
+# Out-of-core nData
+# the data stays in a chunked array on disk (HDF5 or zarr) and the common
+# reductions are done block by block, so volumes larger than memory can be
+# cropped, sliced, summed and rotated
+#
+# file layout is the same as nData.save / nData_h5Group_w:
+#     dataset: 'data'
+#     group: 'scale' => dataset for each axis
+#     group: 'unit' => attrs[ax]
+#     group: 'extras' => attrs[key]
+# so the files can also be loaded in memory with load_nData
+#==============================================================================
+
+import h5py
+import numpy as np
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+from iexplot.pynData.pynData import nData, scale_index
+from iexplot.pynData.pynData_imgProc import _rotate_coords, _map_plane, _rotate_planes
+
+#bytes of data read at once when streaming
+BLOCK_BYTES = 2**28
+
+#axis in data for each scale, data.shape = (y,x,z)
+_data_axis = {'y':0,'x':1,'z':2}
+
+def _is_zarr(path):
+    return str(path).rstrip('/').endswith('.zarr')
+
+def _open_store(path,mode):
+    """
+    returns the root group of an HDF5 file or zarr store
+    """
+    if _is_zarr(path):
+        if zarr is None:
+            print("zarr is not installed, use an .h5 file or install zarr \nhttps://zarr.readthedocs.io\r")
+            return
+        return zarr.open_group(path,mode=mode)
+    return h5py.File(path,mode)
+
+def _write_meta(root,scale,unit,extras):
+    """
+    writes the scales, units and extras in the nData_h5Group_w layout
+    """
+    g_scale = root.require_group('scale')
+    for ax in scale.keys():
+        if ax in g_scale:
+            del g_scale[ax]
+        g_scale.create_dataset(ax, data=np.asarray(scale[ax],dtype='f'))
+    g_unit = root.require_group('unit')
+    for ax in unit.keys():
+        g_unit.attrs[ax] = unit[ax]
+    g_extras = root.require_group('extras')
+    for key in extras.keys():
+        try:
+            g_extras.attrs[key] = extras[key]
+        except (TypeError, ValueError):
+            g_extras.attrs[key] = str(extras[key])
+
+def _create_data(root,shape,dtype,chunks=True):
+    if 'data' in root:
+        del root['data']
+    return root.create_dataset('data',shape=shape,dtype=dtype,chunks=chunks)
+
+class nDataChunked(nData):
+    """
+    nData where .data is a chunked array on disk (h5py.Dataset or zarr.Array)
+    only the blocks needed for an operation are read into memory
+
+    usage:
+        d = open_chunked('volume.h5')
+        img = slice_dstack('xy',d,c,b) => reads only the binned planes
+        d.crop_z(20,30,out='volume_crop.h5')
+        s = d.sum('z') => np.array summed block by block
+        d_rot = d.rotate3D('z',10,[0,0],out='volume_rot.h5')
+        d.load() => in memory nData
+
+    see ndstack_chunked to build a stack on disk
+    """
+    def __init__(self,root):
+        self.root = root
+        data = root['data']
+        nData.__init__(self,data)
+        for ax in root['scale'].keys():
+            self.updateAx(ax, np.array(root['scale'][ax]), root['unit'].attrs.get(ax,''))
+        for key in root['extras'].attrs.keys():
+            self.updateExtrasByKey(key, root['extras'].attrs[key])
+
+    def close(self):
+        """
+        closes the file (HDF5)
+        """
+        if hasattr(self.root,'close'):
+            self.root.close()
+
+    def load(self):
+        """
+        returns an in memory nData copy
+        """
+        d = nData(self.data[...])
+        for ax in self.scale.keys():
+            d.updateAx(ax, self.scale[ax], self.unit[ax])
+        d.updateExtras(dict(self.extras))
+        return d
+
+    def block_slices(self,ax='z',block_bytes=None):
+        """
+        yields the index slices along ax for streaming, BLOCK_BYTES at a time (default)
+        the block size follows the chunking so each chunk is read once
+        """
+        block_bytes = BLOCK_BYTES if block_bytes is None else block_bytes
+        axis = _data_axis[ax] if len(self.data.shape) > 1 else 0
+        shape = self.data.shape
+        plane = np.prod(shape)//shape[axis]*np.dtype(self.data.dtype).itemsize
+        step = max(int(block_bytes//max(plane,1)),1)
+        chunks = getattr(self.data,'chunks',None)
+        if chunks:
+            step = max(step//chunks[axis],1)*chunks[axis]
+        for i in range(0,shape[axis],step):
+            yield slice(i,min(i+step,shape[axis]))
+
+    def blocks(self,ax='z',block_bytes=None):
+        """
+        iterates over the data in blocks along ax
+        yields (index slice, np.array)
+        """
+        axis = _data_axis[ax] if len(self.data.shape) > 1 else 0
+        for s in self.block_slices(ax,block_bytes):
+            yield s, np.asarray(self.data[(slice(None),)*axis+(s,)])
+
+    def _new(self,path,shape,dtype,scale,unit):
+        """
+        creates a new chunked file with the same extras
+        """
+        root = _open_store(path,'w')
+        data = _create_data(root,shape,dtype)
+        _write_meta(root,scale,unit,self.extras)
+        return root, data
+
+    def sum(self,ax='z',nan=True,block_bytes=None):
+        """
+        sums the data along ax, streaming over the other axis
+        returns an np.array (a scalar for 1D data)
+        """
+        if len(self.data.shape) == 1:
+            parts = [np.nansum(block) if nan else np.sum(block) for s,block in self.blocks(ax,block_bytes)]
+            return np.sum(parts)
+        axis = _data_axis[ax]
+        over = [k for k,i in _data_axis.items() if i < len(self.data.shape) and k != ax][0]
+        total = None
+        for s,block in self.blocks(over,block_bytes):
+            part = np.nansum(block,axis=axis) if nan else np.sum(block,axis=axis)
+            if total is None:
+                out_axis = _data_axis[over] - (1 if _data_axis[over] > axis else 0)
+                shape = list(part.shape)
+                shape[out_axis] = self.data.shape[_data_axis[over]]
+                total = np.zeros(shape,dtype=part.dtype)
+            key = (slice(None),)*out_axis+(s,)
+            total[key] = part
+        return total
+
+    def band(self,ax,center,width):
+        """
+        nansum of the data along ax over [center-width, center+width) in scale units
+        only the planes in the band are read
+        """
+        scale = self.scale[ax]
+        i = scale_index(scale,center)
+        step = abs(scale[1]-scale[0]) if len(scale) > 1 else 1
+        b = int(abs(width)/step)
+        lo, hi = max(i-b,0), min(i+max(b,1),len(scale))
+        axis = _data_axis[ax]
+        key = (slice(None),)*axis+(slice(lo,hi),)
+        return np.nansum(np.asarray(self.data[key]),axis=axis)
+
+    def block_slice(self,axes,c,b):
+        """
+        slice_dstack for a chunked 3D volume, reads only the binned planes
+        """
+        ax = [k for k in ['x','y','z'] if k not in axes][0]
+        img = self.band(ax,c[['x','y','z'].index(ax)],b[['x','y','z'].index(ax)])
+        #img is in data order: 'x' => (y,z), 'y' => (x,z), 'z' => (y,x)
+        img = nData(img.T) if axes in ['yz','xz','yx'] else nData(img)
+        img.updateAx('x', self.scale[axes[0]], self.unit[axes[0]])
+        img.updateAx('y', self.scale[axes[1]], self.unit[axes[1]])
+        extras = dict(self.extras)
+        extras.update({'slice_cb':(c,b)})
+        img.updateExtras(extras)
+        return img
+
+    def block_avg(self,ax='y',Cen=np.nan,WidthPix=np.nan,**kwargs):
+        """
+        nd_avg for a chunked 2D image, same window as nData.reduce: 
+        sum over CenPix-WidthPix to CenPix+WidthPix, whole axis if WidthPix=np.nan
+        only the rows in the window are read, the whole axis is streamed with sum
+
+        **kwargs:
+            block_bytes = bytes read at once when streaming (default: BLOCK_BYTES)
+        """
+        if np.isnan(WidthPix):
+            bx = 'x' if ax == 'y' else 'y'
+            avg = nData(self.sum(ax,block_bytes=kwargs.get('block_bytes')))
+            avg.updateAx('x', self.scale[bx], self.unit[bx])
+            avg.updateExtras(dict(self.extras))
+            return avg
+        Scale = self.scale[ax]
+        CenPix = len(Scale)//2 if np.isnan(Cen) else int(np.argmin((Scale-Cen)**2))
+        return self.reduce(ax,center=CenPix,width=WidthPix,index=True)
+
+    def _crop(self,ax,crop_start,crop_end,index,out):
+        scale = self.scale[ax]
+        if index:
+            px_min, px_max = crop_start, crop_end
+        else:
+            i0 = scale_index(scale,crop_start)
+            i1 = scale_index(scale,crop_end)
+            px_min, px_max = min(i0,i1), max(i0,i1)
+        axis = _data_axis[ax] if len(self.data.shape) > 1 else 0
+        key = (slice(None),)*axis+(slice(px_min,px_max),)
+        scale_new = dict(self.scale)
+        scale_new[ax] = scale[px_min:px_max]
+        if out is None:
+            self.data = np.asarray(self.data[key])
+        else:
+            shape = list(self.data.shape)
+            shape[axis] = px_max-px_min
+            root, data = self._new(out,tuple(shape),self.data.dtype,scale_new,self.unit)
+            #streaming over an axis that is not cropped
+            over = [k for k,i in _data_axis.items() if i < len(shape) and i != axis]
+            if not over:
+                data[...] = self.data[key]
+            for s in (self.block_slices(over[0]) if over else []):
+                bkey = [slice(None)]*len(shape)
+                bkey[axis] = slice(px_min,px_max)
+                bkey[_data_axis[over[0]]] = s
+                data[(slice(None),)*_data_axis[over[0]]+(s,)] = self.data[tuple(bkey)]
+            self.close()
+            self.root = root
+            self.data = data
+        self.scale[ax] = scale[px_min:px_max]
+
+    def crop_x(self,crop_start,crop_end,index=False,out=None):
+        """
+        crops in x, out = None => the cropped data is read into memory
+                        = path => the cropped data is streamed to a new chunked file
+        """
+        self._crop('x',crop_start,crop_end,index,out)
+
+    def crop_y(self,crop_start,crop_end,index=False,out=None):
+        """
+        crops in y (see crop_x)
+        """
+        self._crop('y',crop_start,crop_end,index,out)
+
+    def crop_z(self,crop_start,crop_end,index=False,out=None):
+        """
+        crops in z (see crop_x)
+        """
+        self._crop('z',crop_start,crop_end,index,out)
+
+    def rotate3D(self,ax,CCWdeg,center,out,newhscale=[],newvscale=[]):
+        """
+        rotate3D (see pynData_imgProc) one plane at a time, written to a new chunked file at out
+        returns an nDataChunked
+        """
+        axis, h, v = _rotate_planes[ax]
+        newX, newY, coords = _rotate_coords(self.scale[h], self.scale[v], CCWdeg, center,
+                                            newhscale=newhscale, newvscale=newvscale)
+        shape = [len(newY), len(newX)]
+        shape.insert(axis,self.data.shape[axis])
+        scale = dict(self.scale)
+        scale[h], scale[v] = newX, newY
+        root, data = self._new(out,tuple(shape),np.float64,scale,self.unit)
+        for i in range(self.data.shape[axis]):
+            plane = (slice(None),)*axis+(i,)
+            data[plane] = _map_plane(np.asarray(self.data[plane]), coords)
+        return nDataChunked(root)
+
+def open_chunked(path,mode='r'):
+    """
+    opens an .h5 file (nData.save / nData_h5Group_w layout) or a .zarr store as an nDataChunked
+    mode = 'r' (default) or 'r+' to modify in place
+    """
+    root = _open_store(path,mode)
+    if root is None:
+        return
+    return nDataChunked(root)
+
+def save_chunked(d,path,chunks=True):
+    """
+    writes an nData object to a chunked .h5 file or .zarr store and returns it as an nDataChunked
+    chunks = True (default) for automatic chunking or a tuple with the chunk shape
+    """
+    root = _open_store(path,'w')
+    if root is None:
+        return
+    data = _create_data(root,d.data.shape,d.data.dtype,chunks)
+    data[...] = d.data
+    _write_meta(root,d.scale,d.unit,d.extras)
+    return nDataChunked(root)
+
+def ndstack_chunked(nData_iter,path,dstack_scale=None,dstack_unit="",chunks=True):
+    """
+    stacks nData objects directly into a chunked file, only one object is in memory at a time
+    same stacking as ndstack: 1D => along y, 2D => along z
+
+    nData_iter = list or generator of nData objects (i.e. loading each EA/tiff in a generator)
+    path = .h5 or .zarr
+    dstack_scale = np.array for scaling, None => index
+    returns an nDataChunked
+    """
+    root = _open_store(path,'w')
+    if root is None:
+        return
+    data = None
+    n = 0
+    for d in nData_iter:
+        if data is None:
+            d0 = d
+            rank = len(d.data.shape)
+            frame = d.data.shape
+            if rank == 1:
+                shape, maxshape = (0,)+frame, (None,)+frame
+            else:
+                shape, maxshape = frame+(0,), frame+(None,)
+            if isinstance(root,h5py.Group):
+                data = root.create_dataset('data',shape=shape,maxshape=maxshape,dtype=d.data.dtype,chunks=chunks)
+            else:
+                data = root.create_dataset('data',shape=shape,dtype=d.data.dtype)
+        if d.data.shape != frame:
+            print('Shape mismatch, item '+str(n)+' has shape '+str(d.data.shape)+' but the first is '+str(frame))
+            return
+        if rank == 1:
+            data.resize((n+1,)+frame)
+            data[n] = d.data
+        else:
+            data.resize(frame+(n+1,))
+            data[:,:,n] = d.data
+        n += 1
+
+    if data is None:
+        print('Nothing to stack')
+        return
+    if dstack_scale is None:
+        dstack_scale = np.arange(1,n+1)
+    scale = {'x':d0.scale['x']}
+    unit = {'x':d0.unit['x']}
+    if rank == 1:
+        scale['y'], unit['y'] = dstack_scale, dstack_unit
+    else:
+        scale['y'], unit['y'] = d0.scale['y'], d0.unit['y']
+        scale['z'], unit['z'] = dstack_scale, dstack_unit
+    _write_meta(root,scale,unit,d0.extras)
+    return nDataChunked(root)
@@ -1,7 +1,7 @@
 
 import numpy as np
 
-from iexplot.fitting import fit_box,fit_gaussian,fit_lorentzian,fit_poly,fit_step
+from iexplot.fitting import fit_box,fit_gaussian,fit_lorentzian,fit_poly,fit_step,fit_stack,_plot_fit,fit_cache
 from iexplot.plotting import plot_1D
 from iexplot.pynData.pynData_plot import plot_nd
 
@@ -21,22 +21,27 @@ def fit_nd(nd,fit_type,**kwargs):
         plot_fits2D = True/False (default = False), image + center
         
         show_legend = True/False (default = False)
+        cache = True/False reuses previous fits of the same data (default = False), see FitCache
         see fit_box, fit_gaussian... for other kwargs   
     fit_vals = dictionary of arrays with dict_keys(['Amp', 'center', 'FWHM'])      
     """
     kwargs.setdefault('plot_fits1D',False)
     kwargs.setdefault('show_legend',False)
+    kwargs.setdefault('cache',False)
     
     fit_funcs = {
         'box':fit_box,
         'gaussian':fit_gaussian,
         'lorentzian':fit_lorentzian,
         'poly':fit_poly,
-        'step:':fit_step,
+        'step':fit_step,
     }
     if fit_type not in fit_funcs.keys():
-        print('Not a valid fit_type use one of the following'+list(fit_funcs.keys()) )
-        #return
+        print('Not a valid fit_type use one of the following: '+str(list(fit_funcs.keys())))
+        return
+    
+    if kwargs.pop('cache'):
+        return fit_cache.fit(nd.scale['x'],nd.data,fit_type,**kwargs)
     
     fit_func = fit_funcs[fit_type]
     x_fit,y_fit,coefs,covar,fit_vals  = fit_func(nd.scale['x'],nd.data,**kwargs)
@@ -52,56 +57,47 @@ def fit_nd_stack(nd,fit_type,**kwargs):
     nd is a pndata object (such as EA_stack or data.mda_det[detNum])
     fit_type = 'box','gaussian','lorentzian','poly','step'
     
+    all rows are fit at the same time (see iexplot.fitting.fit_stack)
+
     **kwargs
         xrange=[x_first,x_last] to fit subrange 
         plot_fits1D = True/False (default = False), line profiles + fits
         plot_fits2D = True/False (default = True), image + center
+        nprocs = 1 (default); number of processes to split the rows over
         
         show_legend = True/False (default = False)
-        see fit_box, fit_gaussian... for other kwargs
+        see fit_stack for other kwargs
 
-    fit_vals = dictionary of arrays with dict_keys(['Amp', 'center', 'FWHM'])      
+    x_fit, y_fit = np.array (rows,n)
+    coefs = np.array (rows,k)
+    covar = np.array (k,k,rows)
+    fit_vals = dictionary of arrays (rows,1) with dict_keys(['Amp', 'center', 'FWHM'])      
     """
     kwargs.setdefault('plot_fits1D',False)
     kwargs.setdefault('show_legend',False)
     kwargs.setdefault('plot_fits2D',True)
 
-    if kwargs['plot_fits1D']:
-        kwargs.update({'plot':True})
-    else:
-        kwargs.update({'plot':False})
-    kwargs.pop('plot_fits1D',None)
+    plot_fits1D = kwargs.pop('plot_fits1D')
+    plot_fits2D = kwargs.pop('plot_fits2D')
+    show_legend = kwargs.pop('show_legend')
 
-    
-    fit_funcs = {
-        'box':fit_box,
-        'gaussian':fit_gaussian,
-        'lorentzian':fit_lorentzian,
-        'poly':fit_poly,
-        'step:':fit_step,
-    }
-    if fit_type not in fit_funcs.keys():
-        print('Not a valid fit_type use one of the following'+list(fit_funcs.keys()) )
-        #return
-    
-    fit_func = fit_funcs[fit_type]
+    fits = fit_stack(nd.scale['x'],nd.data,fit_type,**kwargs)
+    if fits is None:
+        return
+    x_fit,y_fit,coefs,covar,fit_vals,success = fits
+
+    x_fit = np.tile(x_fit,(y_fit.shape[0],1))
+    covar = np.moveaxis(covar,0,-1)
+    for key in fit_vals.keys():
+        fit_vals[key] = fit_vals[key][:,np.newaxis]
 
-    for j,y in enumerate(nd.scale['y']):
-        ff = fit_func(nd.scale['x'],nd.data[j,:],**kwargs)
-        if j == 0:
-            x_fit,y_fit,coefs,covar,fit_vals = ff
-            for key in fit_vals.keys():
-                fit_vals[key]=np.array(fit_vals[key])
-        else:           
-            x_fit = np.vstack((x_fit,ff[0]))
-            y_fit = np.vstack((y_fit,ff[1]))
-            coefs = np.vstack((coefs,ff[2]))
-            covar = np.dstack((covar,ff[3]))
-            for key in fit_vals.keys():
-                fit_vals[key] = np.vstack((fit_vals[key],ff[4][key]))
+    if plot_fits1D:
+        for j in range(y_fit.shape[0]):
+            vals = {key:fit_vals[key][j,0] for key in fit_vals}
+            _plot_fit(nd.scale['x'],nd.data[j,:],x_fit[j],y_fit[j],vals,show_legend=show_legend)
     
-    if kwargs['plot_fits2D']:
+    if plot_fits2D:
         plot_nd(nd)
         plot_1D(fit_vals['center'],nd.scale['y'],marker='x',color='red',linestyle='None')
     
-    return x_fit,y_fit,coefs,covar,fit_vals
\ No newline at end of file
+    return x_fit,y_fit,coefs,covar,fit_vals
@@ -1,6 +1,9 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy import interpolate
+from scipy import interpolate, ndimage
 from iexplot.pynData import nData
 
 #==============================================================================
@@ -131,47 +134,28 @@ def rotatePlot2D(d, CCWdeg, center, plotRot=False):
     return rotxx, rotyy
 
 
-def _rotate2D(img, xScale, yScale, CCWdeg, center, newhscale=[], newvscale=[], plotRot=False):
+def _rotate_coords(xScale, yScale, CCWdeg, center, newhscale=[], newvscale=[]):
     '''
     Internal methods
     
-    Rotate CCW relative to a point in the 2D plane. Use negative value for CW rotation
-    
-    The coordinate transformation for the unit vectors:
-                            |cos(deg)   -sin(deg)|
-    (e_x' e_y') = (e_x e_y) |                    |
-                            |sin(deg)    cos(deg)|
-    And for the coordinates:
-    
-    |x'|   |cos(deg)   -sin(deg)| |x|
-    |  | = |                    | | |
-    |y'|   |sin(deg)    cos(deg)| |y|
-    
-    With a simple for loop, 3D rotation could be performed.
-    
-    Inputs:
-    CCWdeg:         In degrees and has to be in [-90 deg, 90 deg]
-    center:         The center of rotation. A list.
-    newhscale:      Optional. Default is []. For a customized new horizontal scale
-                    for output. The format is [vmin, vmax, num]
-    plotRot:        Optional. Whether or not to compare the 'before' and 'after'
+    The new grid and the pixel coordinates in the original image for each new pixel
+    (inverse rotation), see _rotate2D. Calculated once and reused for every plane of a stack.
+
+    Returns:
+    newX, newY:     The new scales
+    coords:         np.array (2, len(newY), len(newX)) with the (row, column) pixel positions
+                    in the original image for map_coordinates
     '''
-    # ndimage.rotate(img2D, deg_in_pix) will not work. 
-    # The shape of the rotated 2D img and the rotated scales
-    # cannot be determined easily
-    
     xCenter = center[0]
     yCenter = center[1]
+    c = np.cos(CCWdeg*np.pi/180)
+    s = np.sin(CCWdeg*np.pi/180)
 
-    # If we only want to plot a figure rotated, we then just need rotxx, rotyy
-    xx, yy = np.meshgrid(xScale, yScale)
-    rotxx = np.cos(CCWdeg*np.pi/180)*(xx-xCenter)-np.sin(CCWdeg*np.pi/180)*(yy-yCenter)+xCenter
-    rotyy = np.sin(CCWdeg*np.pi/180)*(xx-xCenter)+np.cos(CCWdeg*np.pi/180)*(yy-yCenter)+yCenter
-
-    # As the rotxx, rotyy are not linear grids, we need to flatten them into (x,y) pairs
-
-    points = np.vstack((rotxx.flatten(), rotyy.flatten())).transpose()
-    values = img.flatten()
+    # The rotated grid extent only depends on the corners
+    xx = np.array([xScale[0], xScale[-1], xScale[0], xScale[-1]])
+    yy = np.array([yScale[0], yScale[0], yScale[-1], yScale[-1]])
+    rotxx = c*(xx-xCenter)-s*(yy-yCenter)+xCenter
+    rotyy = s*(xx-xCenter)+c*(yy-yCenter)+yCenter
 
     # Setting up the new grid
     rotXmin = rotxx.min()
@@ -188,13 +172,78 @@ def _rotate2D(img, xScale, yScale, CCWdeg, center, newhscale=[], newvscale=[], p
 
     if not newvscale==[]:
         newY = np.linspace(newvscale[0], newvscale[1], num=newvscale[2])
-    
+
+    # Inverse rotation of the new grid back to the original scales, then to pixels
     newXX, newYY = np.meshgrid(newX, newY)
+    x0 = c*(newXX-xCenter)+s*(newYY-yCenter)+xCenter
+    y0 = -s*(newXX-xCenter)+c*(newYY-yCenter)+yCenter
+    coords = np.array([(y0-yScale[0])/(yScale[1]-yScale[0]), (x0-xScale[0])/(xScale[1]-xScale[0])])
+    
+    return newX, newY, coords
+
+
+def _map_plane(img, coords, order=3):
+    '''
+    Internal methods
+    
+    Interpolates img at the pixel coordinates from _rotate_coords, NaN outside of img.
+    NaNs in img are kept as NaNs in the output.
+    '''
+    # Points on the border within rounding are inside
+    coords = np.where(np.abs(coords) < 1e-9, 0, coords)
+    for i,n in enumerate(img.shape):
+        coords[i] = np.where(np.abs(coords[i]-(n-1)) < 1e-9, n-1, coords[i])
+    outside = (coords[0] < 0) | (coords[0] > img.shape[0]-1) | (coords[1] < 0) | (coords[1] > img.shape[1]-1)
+
+    nans = np.isnan(img)
+    newImg = ndimage.map_coordinates(np.where(nans, 0, img), coords, order=order, mode='nearest')
+    if nans.any():
+        newImg[ndimage.map_coordinates(nans.astype(float), coords, order=1, mode='nearest') > 0] = np.nan
+    newImg[outside] = np.nan
+    return newImg
+
+
+def _rotate2D(img, xScale, yScale, CCWdeg, center, newhscale=[], newvscale=[], plotRot=False, order=3):
+    '''
+    Internal methods
+    
+    Rotate CCW relative to a point in the 2D plane. Use negative value for CW rotation
+    
+    The coordinate transformation for the unit vectors:
+                            |cos(deg)   -sin(deg)|
+    (e_x' e_y') = (e_x e_y) |                    |
+                            |sin(deg)    cos(deg)|
+    And for the coordinates:
+    
+    |x'|   |cos(deg)   -sin(deg)| |x|
+    |  | = |                    | | |
+    |y'|   |sin(deg)    cos(deg)| |y|
+    
+    The rotation is affine, so each pixel on the new grid is interpolated from the original
+    regular grid at the inverse rotated position (ndimage.map_coordinates, cubic spline
+    for order = 3)
+    
+    Inputs:
+    CCWdeg:         In degrees and has to be in [-90 deg, 90 deg]
+    center:         The center of rotation. A list.
+    newhscale:      Optional. Default is []. For a customized new horizontal scale
+                    for output. The format is [vmin, vmax, num]
+    plotRot:        Optional. Whether or not to compare the 'before' and 'after'
+    order:          Optional. Spline order for the interpolation, default is 3
+    '''
+    newX, newY, coords = _rotate_coords(xScale, yScale, CCWdeg, center, newhscale=newhscale, newvscale=newvscale)
 
     # Interpolate
-    newImg = interpolate.griddata(points, values, (newXX, newYY), method='cubic')
+    newImg = _map_plane(img, coords, order=order)
     
     if plotRot:
+        xCenter = center[0]
+        yCenter = center[1]
+        xx, yy = np.meshgrid(xScale, yScale)
+        rotxx = np.cos(CCWdeg*np.pi/180)*(xx-xCenter)-np.sin(CCWdeg*np.pi/180)*(yy-yCenter)+xCenter
+        rotyy = np.sin(CCWdeg*np.pi/180)*(xx-xCenter)+np.cos(CCWdeg*np.pi/180)*(yy-yCenter)+yCenter
+        newXX, newYY = np.meshgrid(newX, newY)
+
         fig, ax = plt.subplots(1,3)
         ax[0].pcolormesh(xx, yy, img)
         ax[0].set_aspect(1)
@@ -238,14 +287,22 @@ def rotate2D(d, CCWdeg, center, newhscale=[], newvscale=[], plotRot=False):
     
     return d_rot
 
+# Planes perpendicular to each axis for data.shape = (y,x,z): 
+# (data axis, horizontal scale, vertical scale) of the plane images
+_rotate_planes = {'z':(2,'x','y'), 'y':(0,'z','x'), 'x':(1,'z','y')}
+
 def rotate3D(d, ax, CCWdeg, center, newhscale=[], newvscale=[], plotRot=False):
     '''
     Rotate CCW relative to a point in the 2D plane for a 3D stack.
     Note we have to rotate along x, y or z axis.
+    The interpolation coordinates are calculated once for all the planes.
     
     Inputs:
-    d:              nData instance
+    d:              nData instance, data.shape = (y,x,z)
     ax:             Use 'x', 'y' or 'z'
+                    'z' rotates the x-y planes (center = [x,y])
+                    'y' rotates the z-x planes (center = [z,x])
+                    'x' rotates the z-y planes (center = [z,y])
     CCWdeg:         In degrees and has to be in [-90 deg, 90 deg].
                     Use negative value for CW rotation
     center:         The center of rotation. A list.
@@ -254,64 +311,87 @@ def rotate3D(d, ax, CCWdeg, center, newhscale=[], newvscale=[], plotRot=False):
     plotRot:        Optional. Whether or not to compare the 'before' and 'after'
                     Only the first image 
     '''
-    if ax=='z':
-        newImg, newX, newY = _rotate2D(d.data[0], d.scale['x'], d.scale['y'], CCWdeg, center, 
-                                       newhscale=newhscale, newvscale=newvscale, plotRot=plotRot)
-        newStk = np.zeros((d.data.shape[0], newImg.shape[0], newImg.shape[1]))
-        newStk[0] = newImg
-        
-        for i in range(1, d.data.shape[0]):
-            # Pass on the scales to be consistent
-            newImg, _, _ = _rotate2D(d.data[i], d.scale['x'], d.scale['y'], CCWdeg, center, 
-                                     newhscale=[newX[0], newX[-1], len(newX)], 
-                                     newvscale=[newY[0], newY[-1], len(newY)], plotRot=False)
-            newStk[i] = newImg
-            
-        d_rot = nData(newStk)
-        d_rot.updateAx('x', newX, d.unit['x'])
-        d_rot.updateAx('y', newY, d.unit['y'])
-        d_rot.updateAx('z', d.scale['z'], d.unit['z'])
-    elif ax=='y':
-        newImg, newX, newY = _rotate2D(d.data[:,0,:], d.scale['x'], d.scale['z'], CCWdeg, center, 
-                                       newhscale=newhscale, newvscale=newvscale, plotRot=plotRot)
-        newStk = np.zeros((newImg.shape[0], d.data.shape[1], newImg.shape[1]))
-        newStk[:,0,:] = newImg
-        
-        for i in range(1, d.data.shape[1]):
-            # Pass on the scales to be consistent
-            newImg, _, _ = _rotate2D(d.data[:,i,:], d.scale['x'], d.scale['z'], CCWdeg, center, 
-                                     newhscale=[newX[0], newX[-1], len(newX)], 
-                                     newvscale=[newY[0], newY[-1], len(newY)], plotRot=False)
-            newStk[:,i,:] = newImg
-            
-        d_rot = nData(newStk)
-        d_rot.updateAx('x', newX, d.unit['x'])
-        d_rot.updateAx('y', d.scale['y'], d.unit['y'])
-        d_rot.updateAx('z', newY, d.unit['z'])
-    elif ax=='x':
-        newImg, newX, newY = _rotate2D(d.data[:,:,0], d.scale['y'], d.scale['z'], CCWdeg, center, 
-                                       newhscale=newhscale, newvscale=newvscale, plotRot=plotRot)
-        newStk = np.zeros((newImg.shape[0], newImg.shape[1], d.data.shape[2]))
-        newStk[:,:,0] = newImg
-        
-        for i in range(1, d.data.shape[2]):
-            # Pass on the scales to be consistent
-            newImg, _, _ = _rotate2D(d.data[:,:,i], d.scale['y'], d.scale['z'], CCWdeg, center, 
-                                     newhscale=[newX[0], newX[-1], len(newX)], 
-                                     newvscale=[newY[0], newY[-1], len(newY)], plotRot=False)
-            newStk[:,:,i] = newImg
+    axis, h, v = _rotate_planes[ax]
+    newX, newY, coords = _rotate_coords(d.scale[h], d.scale[v], CCWdeg, center, newhscale=newhscale, newvscale=newvscale)
+    
+    shape = [len(newY), len(newX)]
+    shape.insert(axis, d.data.shape[axis])
+    newStk = np.zeros(shape)
+    for i in range(d.data.shape[axis]):
+        plane = (slice(None),)*axis+(i,)
+        newStk[plane] = _map_plane(d.data[plane], coords)
+    
+    if plotRot:
+        _rotate2D(d.data[(slice(None),)*axis+(0,)], d.scale[h], d.scale[v], CCWdeg, center, 
+                  newhscale=[newX[0], newX[-1], len(newX)], newvscale=[newY[0], newY[-1], len(newY)], plotRot=True)
             
-        d_rot = nData(newStk)
-        d_rot.updateAx('x', d.scale['x'], d.unit['x'])
-        d_rot.updateAx('y', newX, d.unit['y'])
-        d_rot.updateAx('z', newY, d.unit['z'])
+    d_rot = nData(newStk)
+    k = [k for k in ['x','y','z'] if k not in [h,v]][0]
+    d_rot.updateAx(k, d.scale[k], d.unit[k])
+    d_rot.updateAx(h, newX, d.unit[h])
+    d_rot.updateAx(v, newY, d.unit[v])
     
     return d_rot
 
 
-def sym2D(d, nfold, center, newhscale, newvscale, plotSym=False):
+def _sym_coords(xScale, yScale, nfold, center, newhscale, newvscale, mirror=None):
+    '''
+    Internal methods
+    
+    Pixel coordinates in the original image for all the symmetry operations at once:
+    the nfold rotations by 360/nfold and, for a mirror plane, the nfold reflections
+    
+    Returns:
+    newX, newY:     The new scales
+    coords:         np.array (2, nops, len(newY), len(newX)), see _rotate_coords
+    '''
+    newX, newY, coords = _rotate_coords(xScale, yScale, 0., center, newhscale=newhscale, newvscale=newvscale)
+    newXX, newYY = np.meshgrid(newX, newY)
+    dx = newXX-center[0]
+    dy = newYY-center[1]
+    
+    ops = []
+    for i in range(nfold):
+        # inverse rotation as in _rotate_coords
+        t = 2*np.pi/nfold*i
+        ops.append([[np.cos(t), np.sin(t)], [-np.sin(t), np.cos(t)]])
+    if mirror is not None:
+        # reflection through a line at mirror degrees from the x axis, combined with each rotation
+        m = 2*mirror*np.pi/180
+        M = np.array([[np.cos(m), np.sin(m)], [np.sin(m), -np.cos(m)]])
+        ops += [np.array(R) @ M for R in ops]
+    ops = np.array(ops)
+
+    x0 = ops[:,0,0,None,None]*dx + ops[:,0,1,None,None]*dy + center[0]
+    y0 = ops[:,1,0,None,None]*dx + ops[:,1,1,None,None]*dy + center[1]
+    coords = np.array([(y0-yScale[0])/(yScale[1]-yScale[0]), (x0-xScale[0])/(xScale[1]-xScale[0])])
+
+    return newX, newY, coords
+
+
+def _sym_plane(img, coords, order=3):
+    '''
+    Internal methods
+    
+    Samples img for all the symmetry operations in one map_coordinates call and averages them
+    '''
+    return np.mean(_map_plane(img, coords, order=order), axis=0)
+
+
+def _sym_chunk(args):
+    '''
+    Internal methods
+    
+    Symmetrizes a chunk of planes (for the process pool in sym3D)
+    '''
+    planes, coords = args
+    return np.array([_sym_plane(planes[i], coords) for i in range(planes.shape[0])])
+
+
+def sym2D(d, nfold, center, newhscale, newvscale, plotSym=False, mirror=None):
     '''
     Symmetrizing in 2D. 
+    All the rotated (and mirrored) images are sampled in a single map_coordinates pass.
     
     Inputs:
     nfold:          A integer - 4 for 4-fold, 6 for 6-fold.
@@ -321,20 +401,16 @@ def sym2D(d, nfold, center, newhscale, newvscale, plotSym=False):
                     The format is [vmin, vmax, num].
                     Unlike rotate2D, this is a mandatory input.
     plotRot:        Optional. Whether or not to compare the 'before' and 'after'
+    mirror:         Optional. Default is None. Angle in degrees from the x axis of a mirror 
+                    plane through the center, adds the nfold reflections (i.e. 6mm for nfold=6)
     '''
     img = d.data
     xScale = d.scale['x']
     yScale = d.scale['y']
     
     if type(nfold)==int and nfold>1:
-        newImg, newX, newY = _rotate2D(img, xScale, yScale, 0., center, newhscale=newhscale, newvscale=newvscale, plotRot=False)
-        symImg = newImg
-
-        for i in range(1, nfold):
-            newImg, _, _ = _rotate2D(img, xScale, yScale, 360./nfold*i, center, newhscale=newhscale, newvscale=newvscale, plotRot=False)
-            symImg += newImg
-
-        symImg /= nfold
+        newX, newY, coords = _sym_coords(xScale, yScale, nfold, center, newhscale, newvscale, mirror=mirror)
+        symImg = _sym_plane(img, coords)
         
         d_sym = nData(symImg)
         d_sym.updateAx('x', newX, d.unit['x'])
@@ -356,4 +432,49 @@ def sym2D(d, nfold, center, newhscale, newvscale, plotSym=False):
     else:
         print('Warning: {}-fold symmetry is invalid.'.format(nfold))
         d_sym = d
-    return d_sym
\ No newline at end of file
+    return d_sym
+
+
+def sym3D(d, nfold, center, newhscale, newvscale, ax='z', mirror=None, nprocs=None):
+    '''
+    Symmetrizing in 2D for every plane of a 3D stack (i.e. every BE slice of a kmap),
+    the symmetry coordinates are calculated once for all the planes.
+    
+    Inputs:
+    d:              nData instance, data.shape = (y,x,z)
+    nfold:          A integer - 4 for 4-fold, 6 for 6-fold (see sym2D)
+    center:         The center of rotation. A list.
+    newhscale:      A customized new horizontal scale for output.
+                    The format is [vmin, vmax, num].
+    ax:             Optional. Default is 'z' (x-y planes), see rotate3D
+    mirror:         Optional. Angle of a mirror plane, see sym2D
+    nprocs:         Optional. Number of processes (default = os.cpu_count()), the planes
+                    are split into chunks
+    '''
+    if not (type(nfold)==int and nfold>1):
+        print('Warning: {}-fold symmetry is invalid.'.format(nfold))
+        return d
+    
+    axis, h, v = _rotate_planes[ax]
+    newX, newY, coords = _sym_coords(d.scale[h], d.scale[v], nfold, center, newhscale, newvscale, mirror=mirror)
+    
+    planes = np.moveaxis(np.asarray(d.data), axis, 0)
+    if nprocs is None:
+        nprocs = os.cpu_count()
+    nprocs = max(min(nprocs, planes.shape[0]), 1)
+    
+    chunks = np.array_split(np.arange(planes.shape[0]), nprocs)
+    args = [(planes[c], coords) for c in chunks]
+    if nprocs>1:
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            results = list(pool.map(_sym_chunk, args))
+    else:
+        results = [_sym_chunk(args[0])]
+    
+    d_sym = nData(np.moveaxis(np.concatenate(results), 0, axis))
+    k = [k for k in ['x','y','z'] if k not in [h,v]][0]
+    d_sym.updateAx(k, d.scale[k], d.unit[k])
+    d_sym.updateAx(h, newX, d.unit[h])
+    d_sym.updateAx(v, newY, d.unit[v])
+    
+    return d_sym
@@ -69,29 +69,24 @@ def plot_nd(*ds,**kwargs):
 def nd_avg(d,ax='y',Cen=np.nan,WidthPix=np.nan,**kwargs):
     """
     returns avg (an ndata object) which
-    bins 2D data in ax, with Center, and WidthPix 
+    bins 2D data in ax, with Center, and WidthPix (sum over CenPix-WidthPix to CenPix+WidthPix)
     if Center=np.nan then center is the midpoint
     if WidthPix=np.nan then whole image is binned    
+    see nData.reduce
 
-	**kwargs are plot kwargs
+	**kwargs are plot kwargs, and are passed to block_avg for chunked data (see nDataChunked.block_avg)
     """
+    if hasattr(d,'block_avg') and len(d.data.shape)==2:
+        return d.block_avg(ax,Cen,WidthPix,**kwargs)
     if(len(d.data.shape)==2):
+        if np.isnan(WidthPix):
+            return d.reduce(ax)
         Scale=d.scale[ax]
         if np.isnan(Cen):
             CenPix = len(Scale)//2
         else:
             CenPix = np.argmin((Scale-Cen)**2)
-        if np.isnan(WidthPix):
-            WidthPix=len(Scale)//2
-        if(ax == 'x'):
-            img_avg = np.nansum(d.data[:,CenPix-WidthPix:CenPix+WidthPix], axis=1)
-            bx='y'
-        elif(ax == 'y'):
-            img_avg = np.nansum(d.data[CenPix-WidthPix:CenPix+WidthPix,:], axis=0)
-            bx='x'
-        avg=nData(img_avg)
-        avg.updateAx('x', d.scale[bx], d.unit[bx])
-        return avg
+        return d.reduce(ax,center=CenPix,width=WidthPix,index=True)
     else:
         print('only works for 2D data')
 